@@ -0,0 +1,70 @@
+# tests/engine/test_candidates.py
+
+import pytest
+from valai.engine.llamaflow import FlowEngine
+from tests.config import default_config, EngineTestConfig
+
+PROMPT = "### Instruction: Say hello to Novara\n### Response:\n"
+
+@pytest.fixture
+def test_config() -> EngineTestConfig:
+    """
+    Pytest fixture to create a EngineTestConfig instance with default parameters.
+    """
+    return default_config()
+
+@pytest.fixture
+def default_flow_engine(test_config : EngineTestConfig) -> FlowEngine:
+    """
+    Pytest fixture to create a FlowEngine instance with default parameters.
+    """
+    return FlowEngine.from_config(seed=1234, **test_config)
+
+def test_read_candidates(default_flow_engine : FlowEngine, test_config : EngineTestConfig):
+    """
+    Test candidates are distinct, ranked, and leave the sequence they continue alone.
+    """
+    default_flow_engine.execute(prompt=PROMPT, **test_config)
+    n_past = default_flow_engine.n_past
+    candidates = default_flow_engine.read_candidates(n_candidates=4, max_tokens=20, n_temp=1.0, **test_config)
+    assert 1 < len(candidates) <= 4
+    assert [c.score for c in candidates] == sorted([c.score for c in candidates], reverse=True)
+    assert len(set(tuple(c.ids) for c in candidates)) == len(candidates)
+    assert default_flow_engine.n_past == n_past
+    assert all(c.sequence in default_flow_engine.sequences for c in candidates)
+    # Moving on frees them
+    default_flow_engine.execute(prompt="\n", **test_config)
+    assert list(default_flow_engine.sequences.keys()) == ['default']
+
+def test_accept_candidate(default_flow_engine : FlowEngine, test_config : EngineTestConfig):
+    """
+    Test an accepted candidate continues exactly as if its tokens had been decoded into the sequence.
+    """
+    default_flow_engine.execute(prompt=PROMPT, **test_config)
+    n_past = default_flow_engine.n_past
+    candidates = default_flow_engine.read_candidates(n_candidates=3, max_tokens=20, n_temp=1.0, **test_config)
+    candidate = default_flow_engine.accept_candidate(len(candidates) - 1)
+    assert default_flow_engine.session_tokens[n_past:] == candidate.ids
+    expected = FlowEngine.from_config(**test_config)
+    expected.execute(prompt=PROMPT, **test_config)
+    expected.decode(candidate.ids)
+    assert default_flow_engine.read(max_tokens=10, n_temp=0, **test_config) == expected.read(max_tokens=10, n_temp=0, **test_config)
+
+def test_accept_keeps_forks(default_flow_engine : FlowEngine, test_config : EngineTestConfig):
+    """
+    Test accepting a candidate keeps the forks the sequence had before it was read, so we can still roll back.
+    """
+    engine = default_flow_engine
+    # Each fork is taken before its prompt
+    engine.execute(prompt="### Instruction: Say hello\n", **test_config)
+    n_scene = engine.n_past
+    engine.execute(prompt="### Scene: Novara\n", checkpoint='scene', **test_config)
+    n_turn = engine.n_past
+    engine.execute(prompt=PROMPT, checkpoint='turn', **test_config)
+    engine.read_candidates(n_candidates=3, max_tokens=10, n_temp=1.0, **test_config)
+    engine.accept_candidate(1)
+    assert sorted(engine.sequence.forks.keys()) == ['scene', 'turn']
+    assert engine.reload_turn('turn') == 0
+    assert engine.n_past == n_turn
+    assert engine.reload_turn('scene') == 0
+    assert engine.n_past == n_scene
@@ -0,0 +1,96 @@
+# tests/engine/test_checkpoint.py
+
+import pytest
+from valai.engine.checkpoint import Checkpoint, CheckpointStore
+
+@pytest.fixture
+def checkpoint_store(tmp_path) -> CheckpointStore:
+    """
+    Pytest fixture to create a CheckpointStore with room for two 100 byte checkpoints.
+    """
+    return CheckpointStore(checkpoint_path=str(tmp_path), checkpoint_budget=200)
+
+def make_checkpoint(name : str, size : int = 100) -> Checkpoint:
+    return Checkpoint(name=name, state=bytearray(size), n_past=3, tokens=[1, 2, 3])
+
+def test_put_get(checkpoint_store : CheckpointStore):
+    """
+    Test storing and retrieving a checkpoint from memory.
+    """
+    checkpoint = make_checkpoint("turn")
+    checkpoint_store.put(checkpoint)
+    assert checkpoint_store.get("turn") is checkpoint
+    assert checkpoint_store.total == 100
+
+def test_eviction(checkpoint_store : CheckpointStore):
+    """
+    Test the least recently used checkpoint is spilled to disk, and read back on demand.
+    """
+    checkpoint_store.put(make_checkpoint("game"))
+    checkpoint_store.put(make_checkpoint("scene"))
+    checkpoint_store.get("game")
+    checkpoint_store.put(make_checkpoint("turn"))
+    assert "scene" not in checkpoint_store.checkpoints
+    assert checkpoint_store.total == 200
+    scene = checkpoint_store.get("scene")
+    assert scene is not None
+    assert scene.tokens == [1, 2, 3]
+    assert scene.n_past == 3
+    assert "game" not in checkpoint_store.checkpoints
+
+def test_discard(checkpoint_store : CheckpointStore):
+    """
+    Test discarding a checkpoint from memory and disk.
+    """
+    checkpoint_store.put(make_checkpoint("game"))
+    assert checkpoint_store.save("game")
+    assert checkpoint_store.discard("game")
+    assert checkpoint_store.get("game") is None
+    assert checkpoint_store.total == 0
+
+@pytest.mark.parametrize("codec", ['none', 'zlib', 'bz2', 'lzma'])
+def test_codec(tmp_path, codec : str):
+    """
+    Test spilled checkpoints are compressed on disk, and read back whole.
+    """
+    store = CheckpointStore(checkpoint_path=str(tmp_path), checkpoint_budget=0, checkpoint_codec=codec)
+    checkpoint = Checkpoint(name="game", state=bytearray(b"kv cells " * 1000), n_past=3, tokens=[1, 2, 3])
+    size = store.write(checkpoint)
+    assert (size < checkpoint.size) == (codec != 'none')
+    assert store.read("game").state == checkpoint.state
+    with pytest.raises(ValueError):
+        CheckpointStore(checkpoint_path=str(tmp_path), checkpoint_codec='zip')
+
+def test_expire(tmp_path):
+    """
+    Test checkpoints unused for max_age seconds are spilled, and the stats count how lookups were served.
+    """
+    store = CheckpointStore(checkpoint_path=str(tmp_path), checkpoint_budget=200, checkpoint_max_age=60)
+    store.put(make_checkpoint("game"))
+    store.put(make_checkpoint("scene"))
+    store.used["game"] -= 120
+    assert store.expire() == 1
+    assert list(store.checkpoints.keys()) == ["scene"]
+    assert store.total == 100
+    assert store.get("scene") is not None
+    assert store.get("game").tokens == [1, 2, 3]
+    assert store.get("turn") is None
+    store.put(make_checkpoint("turn"))
+    assert store.stats.hits == 1
+    assert store.stats.disk_hits == 1
+    assert store.stats.misses == 1
+    assert store.stats.expirations == 1
+    assert store.stats.evictions == 1
+    assert store.stats.bytes_written > 0
+
+def test_damaged(tmp_path):
+    """
+    Test a spilled checkpoint that can't be decoded is a miss, and doesn't collide with a saved state file.
+    """
+    store = CheckpointStore(checkpoint_path=str(tmp_path), checkpoint_budget=0)
+    store.write(make_checkpoint("game"))
+    assert store.filename("game") != str(tmp_path / "game.context.dat")
+    with open(store.filename("game"), "wb") as fp:
+        fp.write(b"VALS not a zlib stream")
+    assert store.get("game") is None
+    assert store.stats.misses == 1
@@ -0,0 +1,52 @@
+# tests/engine/test_embedding.py
+
+import numpy as np
+import pytest
+from valai.engine.llamaflow import FlowEngine
+from valai.engine.registry import model_registry
+from tests.config import default_config, EngineTestConfig
+
+TEXTS = ["The tavern is warm and loud", "The tavern is cold", "Novara draws her sword", "The tavern is warm and loud"]
+
+@pytest.fixture
+def test_config() -> EngineTestConfig:
+    """
+    Pytest fixture to create a EngineTestConfig instance with default parameters.
+    """
+    return default_config()
+
+@pytest.fixture
+def default_flow_engine(test_config : EngineTestConfig) -> FlowEngine:
+    """
+    Pytest fixture to create a FlowEngine instance with default parameters.
+    """
+    return FlowEngine.from_config(**test_config)
+
+def test_embed(default_flow_engine : FlowEngine, test_config : EngineTestConfig):
+    """
+    Test each text gets a unit row, which doesn't depend on the other texts, or disturb our sequence.
+    """
+    engine = default_flow_engine
+    engine.execute(prompt="Hello World", **test_config)
+    tokens = engine.session_tokens.copy()
+    vectors = engine.embed(TEXTS)
+    n_embd = engine.embedder.n_embd
+    assert vectors.shape == (len(TEXTS), n_embd)
+    assert np.linalg.norm(vectors, axis=1) == pytest.approx([1.0] * len(TEXTS), abs=1e-4)
+    assert (vectors[0] == vectors[3]).all()
+    assert not np.allclose(vectors[0], vectors[1])
+    for text, vector in zip(TEXTS, vectors):
+        assert engine.embed([text]) == pytest.approx(vector[None, :], abs=1e-4)
+    assert engine.session_tokens == tokens
+    assert engine.read(max_tokens=5, n_temp=0, **test_config) is not None
+
+def test_embedder_refs(default_flow_engine : FlowEngine):
+    """
+    Test the embedding context holds a reference to the model, and gives it back.
+    """
+    engine = default_flow_engine
+    refs = model_registry.refs(engine.model)
+    engine.embed(["Hello"])
+    assert model_registry.refs(engine.model) == refs + 1
+    engine.embedder = None
+    assert model_registry.refs(engine.model) == refs
@@ -0,0 +1,53 @@
+# tests/engine/test_fork.py
+
+import pytest
+from valai.engine.llamaflow import FlowEngine
+from tests.config import default_config, EngineTestConfig
+
+@pytest.fixture
+def test_config() -> EngineTestConfig:
+    """
+    Pytest fixture to create a EngineTestConfig instance with default parameters.
+    """
+    return default_config()
+
+@pytest.fixture
+def default_flow_engine(test_config : EngineTestConfig) -> FlowEngine:
+    """
+    Pytest fixture to create a FlowEngine instance with default parameters.
+    """
+    return FlowEngine.from_config(**test_config)
+
+def test_rollback(default_flow_engine : FlowEngine, test_config : EngineTestConfig):
+    """
+    Test rolling back a turn gives the same generation as the first time, without saving any state.
+    """
+    engine = default_flow_engine
+    engine.execute(prompt="### Instruction: Say hello to Novara\n### Response:\n", **test_config)
+    n_past = engine.n_past
+    engine.execute(prompt="Novara:", checkpoint='turn', **test_config)
+    first = engine.read(max_tokens=20, n_temp=0, **test_config)
+    tokens = engine.session_tokens.copy()
+    assert engine.checkpoints.get('turn') is None
+    assert engine.reload_turn(checkpoint='turn') >= 0
+    assert engine.n_past == n_past
+    engine.execute(prompt="Novara:", **test_config)
+    assert engine.read(max_tokens=20, n_temp=0, **test_config) == first
+    assert engine.session_tokens == tokens
+
+def test_fork_invalidated(default_flow_engine : FlowEngine, test_config : EngineTestConfig):
+    """
+    Test a fork is dropped once the tokens before it change, and kept when only later tokens do.
+    """
+    engine = default_flow_engine
+    engine.execute(prompt="Hello World the player said to Novara.", **test_config)
+    n_past = engine.n_past
+    engine.fork('early')
+    engine.execute(prompt=" Novara said hello back.", **test_config)
+    engine.fork('late')
+    engine.truncate_sequence(n_past + 1)
+    assert engine.rollback('late') == -1
+    assert engine.rollback('early') == 1
+    assert engine.n_past == n_past
+    engine.reset()
+    assert engine.rollback('early') == -1
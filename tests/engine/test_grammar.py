@@ -1,10 +1,12 @@
 # tests/engine/test_read.py
 
 import logging
+import os
+import numpy as np
 import pytest
 from valai.ioutil import CaptureFD
 from valai.engine.llamaflow import FlowEngine
-from valai.engine.grammar import load_grammar
+from valai.engine.grammar import GrammarCache, load_grammar
 from tests.config import default_config, EngineTestConfig
 
 logger = logging.getLogger(__name__)
@@ -32,18 +34,70 @@ def test_grammar(default_flow_engine : FlowEngine, test_config : EngineTestConfi
     Test reading a prompt from the engine using grammar.
     """
     prompt = "### Instruction: Output Goodnight Moon\n### Response:\n"
+    # The tokens the model's tokenizer gives the response following the prompt; ['Hello', ' World', '\n'] for llama
+    engine = default_flow_engine
+    n_prompt = len(engine.tokenize(prompt))
+    expected = [engine.vocab.pieces[id] for id in engine.tokenize(prompt + 'Hello World\n')[n_prompt:]]
+    assert ''.join(expected) == 'Hello World\n'
     grammar = load_grammar(**test_config)
     logger.info(f"Grammar rules: {grammar._n_rules}")
-    rc = default_flow_engine.feed(prompt=prompt, **test_config)
+    rc = engine.feed(prompt=prompt, **test_config)
     assert rc >= 0
-    results = default_flow_engine.read(grammar=grammar, **test_config)
+    results = engine.read(grammar=grammar, **test_config)
     logger.info(f"Results: {results}")
-    assert all([a.strip() == b.strip() for a, b in zip(results, ['Hello', 'World', '\n'])])
-    results = default_flow_engine.read(grammar=grammar, **test_config)
+    assert results == expected
+    results = engine.read(grammar=grammar, **test_config)
     logger.info(f"Results: {results}")
     assert len(results) == 0
     # Reset the grammar
     grammar.reset()
-    results = default_flow_engine.read(grammar=grammar, **test_config)
+    results = engine.read(grammar=grammar, **test_config)
     logger.info(f"Results: {results}")
-    assert all([a.strip() == b.strip() for a, b in zip(results, ['Hello', 'World', '\n'])])
+    assert results == expected
+
+def test_forced_text(default_flow_engine : FlowEngine, test_config : EngineTestConfig):
+    """
+    Test a grammar with only one continuation is jumped forward, without sampling.
+    """
+    grammar = load_grammar(**test_config)
+    assert default_flow_engine.grammar_filter.forced_text(grammar.grammar, max_chars=100) == 'Hello World\n'
+    assert default_flow_engine.grammar_filter.forced_text(grammar.grammar, max_chars=5) == 'Hello'
+    rc = default_flow_engine.feed(prompt="### Instruction: Output Goodnight Moon\n### Response:\n", **test_config)
+    assert rc >= 0
+    n_past = default_flow_engine.n_past
+    results = default_flow_engine.read(grammar=grammar, **test_config)
+    assert ''.join(results) == 'Hello World\n'
+    assert default_flow_engine.n_past == n_past + len(results)
+
+def test_mask_grammar(default_flow_engine : FlowEngine, test_config : EngineTestConfig):
+    """
+    Test masking the top candidates keeps exactly the best tokens the grammar allows.
+    """
+    grammar = load_grammar(grammar_file='pinnacle_turn_s.gbnf', grammar_path=test_config['grammar_path'])
+    engine = default_flow_engine
+    logits = np.random.default_rng(0).standard_normal(engine.n_vocab).astype(np.single)
+    allowed = engine.grammar_filter.allowed(grammar.grammar, np.arange(engine.n_vocab, dtype=np.intc))
+    masked = logits.copy()
+    assert engine.mask_grammar(masked, grammar.grammar, 10)
+    best = np.argsort(-np.where(allowed, logits, -np.inf))[:10]
+    assert np.array_equal(np.argsort(-masked)[:10], best)
+    assert np.isinf(masked[~allowed]).all()
+
+def test_grammar_cache(tmp_path):
+    """
+    Test a grammar file is parsed once, handing out independent copies, until it changes.
+    """
+    grammar_file = tmp_path / "line.gbnf"
+    grammar_file.write_text('root ::= "Hello"\n')
+    cache = GrammarCache()
+    first = cache.load(str(grammar_file))
+    second = cache.load(str(grammar_file))
+    assert first.template is second.template
+    assert first.grammar is not None and first.grammar != second.grammar
+    old = first.grammar
+    first.reset()
+    assert first.grammar is not None
+    grammar_file.write_text('root ::= "World"\n')
+    stat = grammar_file.stat()
+    os.utime(grammar_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+    assert cache.load(str(grammar_file)).template is not first.template
@@ -119,3 +119,86 @@ def test_feed(default_flow_engine : FlowEngine, test_config : EngineTestConfig):
     prompt = "Test prompt"
     rc = default_flow_engine.feed(prompt=prompt, **test_config)
     assert rc >= 0
+
+def test_sequences(default_flow_engine : FlowEngine, test_config : EngineTestConfig):
+    """
+    Test feeding, copying, truncating and dropping named sequences.
+    """
+    seq = default_flow_engine.add_sequence("player_2")
+    assert seq.seq_id != default_flow_engine.sequence.seq_id
+    rc = default_flow_engine.feed(prompt="Test prompt", sequence="player_2", **test_config)
+    assert rc > 0
+    assert default_flow_engine.n_past == 0
+    assert seq.n_past == rc
+    copy = default_flow_engine.copy_sequence("player_2", "player_3")
+    assert copy.session_tokens == seq.session_tokens
+    default_flow_engine.truncate_sequence(1, sequence="player_3")
+    assert copy.n_past == 1
+    assert seq.n_past == rc
+    default_flow_engine.drop_sequence("player_3")
+    assert "player_3" not in default_flow_engine.sequences
+
+def test_restore_after_reset(default_flow_engine : FlowEngine, test_config : EngineTestConfig):
+    """
+    Test restoring a checkpoint whose tokens are still cached after a reset moves forward over them.
+    """
+    engine = default_flow_engine
+    engine.feed(prompt="Test prompt", **test_config)
+    tokens = engine.session_tokens.copy()
+    checkpoint = engine.snapshot('test')
+    engine.reset()
+    assert engine.n_past == 0
+    assert engine.restore(checkpoint) > 0
+    assert engine.n_past == len(tokens)
+    assert engine.session_tokens == tokens
+    # The next feed continues after the checkpoint, rather than writing over it
+    engine.feed(prompt=" more", **test_config)
+    assert engine.session_tokens[:len(tokens)] == tokens
+
+def test_restore_sequences(default_flow_engine : FlowEngine, test_config : EngineTestConfig):
+    """
+    Test restoring the whole llama state empties every other sequence, whose cells it replaced.
+    """
+    engine = default_flow_engine
+    engine.feed(prompt="Test prompt", **test_config)
+    tokens = engine.session_tokens.copy()
+    checkpoint = engine.snapshot('test')
+    other = engine.add_sequence("player_2")
+    engine.feed(prompt="Another prompt", sequence="player_2", **test_config)
+    assert other.n_past > 0
+    # Dropping our own cached tokens, so the checkpoint is restored rather than rewound to
+    engine.truncate_sequence(0)
+    assert engine.restore(checkpoint) >= 0
+    assert engine.session_tokens == tokens
+    assert other.n_past == 0 and other.cache_tokens == []
+    assert engine.feed(prompt="Another prompt", sequence="player_2", **test_config) > 0
+    assert other.session_tokens == engine.tokenize("Another prompt")
+
+def test_feed_reuse(default_flow_engine : FlowEngine, test_config : EngineTestConfig):
+    """
+    Test feeding a prompt that is already in the KV cache reuses it.
+    """
+    prompt = "Test prompt"
+    rc = default_flow_engine.feed(prompt=prompt, **test_config)
+    tokens = default_flow_engine.session_tokens.copy()
+    default_flow_engine.reset(system=False)
+    assert default_flow_engine.n_past == 0
+    assert default_flow_engine.sequence.cached_prefix(tokens) == len(tokens)
+    assert default_flow_engine.feed(prompt=prompt, **test_config) == rc
+    assert default_flow_engine.session_tokens == tokens
+    assert default_flow_engine.sequence.needs_logits
+
+def test_shift_context(default_flow_engine : FlowEngine, test_config : EngineTestConfig):
+    """
+    Test shifting history out of the context keeps the pinned prefix.
+    """
+    default_flow_engine.feed(prompt="Test system", **test_config)
+    n_keep = default_flow_engine.pin()
+    default_flow_engine.feed(prompt="Test history that is long enough to shift", **test_config)
+    tokens = default_flow_engine.session_tokens.copy()
+    n_discarded = default_flow_engine.shift_context(4)
+    assert n_discarded == 4
+    assert default_flow_engine.n_past == len(tokens) - 4
+    assert default_flow_engine.session_tokens == tokens[:n_keep] + tokens[n_keep + 4:]
+    results = default_flow_engine.read(max_tokens=5, **test_config)
+    assert results is not None
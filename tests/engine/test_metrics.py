@@ -0,0 +1,101 @@
+# tests/engine/test_metrics.py
+
+import json
+import pytest
+from valai.engine.llamaflow import FlowEngine
+from valai.engine.metrics import Histogram, MetricsRegistry
+from tests.config import default_config, EngineTestConfig
+
+@pytest.fixture
+def test_config() -> EngineTestConfig:
+    """
+    Pytest fixture to create a EngineTestConfig instance with default parameters.
+    """
+    return default_config()
+
+def test_disabled():
+    """
+    Test a disabled registry records nothing.
+    """
+    metrics = MetricsRegistry()
+    metrics.count('prefill_tokens', 10)
+    metrics.elapsed('read', metrics.now())
+    assert metrics.end_turn() == {}
+    assert metrics.snapshot() == {'turns': 0, 'counters': {}, 'histograms': {}, 'collected': {}}
+
+def test_histogram():
+    """
+    Test a histogram's quantiles are bounded by its buckets and its largest observation.
+    """
+    histogram = Histogram(buckets=(0.1, 1.0, 10.0))
+    for value in [0.05, 0.5, 0.5, 5.0]:
+        histogram.observe(value)
+    assert histogram.count == 4
+    assert histogram.counts == [1, 2, 1, 0]
+    assert histogram.quantile(0.5) == 1.0
+    assert histogram.quantile(1.0) == 5.0
+
+def test_export():
+    """
+    Test counters and timings export as JSON and Prometheus text, and turns reset.
+    """
+    metrics = MetricsRegistry(enabled=True)
+    metrics.count('prefill_tokens', 10)
+    metrics.observe('read_seconds', 0.2)
+    turn = metrics.end_turn()
+    assert turn == {'prefill_tokens': 10, 'read_seconds': 0.2}
+    metrics.count('prefill_tokens', 5)
+    assert metrics.end_turn() == {'prefill_tokens': 5}
+
+    snapshot = json.loads(metrics.to_json())
+    assert snapshot['turns'] == 2
+    assert snapshot['counters'] == {'prefill_tokens': 15}
+    assert snapshot['histograms']['read_seconds']['count'] == 1
+
+    text = metrics.to_prometheus()
+    assert '# TYPE valai_prefill_tokens_total counter\nvalai_prefill_tokens_total 15\n' in text
+    assert 'valai_read_seconds_bucket{le="0.25"} 1\n' in text
+    assert 'valai_read_seconds_bucket{le="+Inf"} 1\n' in text
+    assert 'valai_read_seconds_count 1\n' in text
+
+def test_engine_metrics(test_config : EngineTestConfig):
+    """
+    Test an engine with metrics enabled records its prefill and generation.
+    """
+    engine = FlowEngine.from_config(metrics=True, **test_config)
+    engine.execute(prompt="Hello World", **test_config)
+    engine.read(max_tokens=4, **test_config)
+    engine.read(max_tokens=4, **test_config)
+    # A turn is whatever the caller ends, not each read
+    turn = engine.metrics.end_turn()
+    assert turn['prefill_tokens'] > 0 and turn['read_seconds'] > 0
+
+    snapshot = engine.metrics.snapshot()
+    assert snapshot['turns'] == 1
+    assert snapshot['counters']['prefill_tokens'] > 0
+    assert snapshot['counters']['generated_tokens'] > 0
+    for name in ['prefill_seconds', 'sample_seconds', 'decode_seconds', 'read_seconds']:
+        assert snapshot['histograms'][name]['count'] > 0
+    assert snapshot['histograms']['read_seconds']['count'] == 2
+
+def test_engine_disabled(test_config : EngineTestConfig):
+    """
+    Test an engine records nothing by default.
+    """
+    engine = FlowEngine.from_config(**test_config)
+    engine.execute(prompt="Hello World", **test_config)
+    engine.read(max_tokens=4, **test_config)
+    assert engine.metrics.snapshot()['counters'] == {}
+
+def test_checkpoint_stats(test_config : EngineTestConfig):
+    """
+    Test checkpoint stats are exported with our metrics, even when timings are disabled.
+    """
+    engine = FlowEngine.from_config(**test_config)
+    engine.execute(prompt="Hello World", **test_config)
+    assert engine.set_checkpoint('turn')
+    assert engine.checkpoints.get('turn') is not None
+    assert engine.checkpoints.get('missing') is None
+    collected = engine.metrics.snapshot()['collected']['checkpoint']
+    assert collected['hits'] == 1 and collected['misses'] == 1 and collected['lookups'] == 2
+    assert 'valai_checkpoint_hits_total 1\n' in engine.metrics.to_prometheus()
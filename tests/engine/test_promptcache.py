@@ -0,0 +1,81 @@
+# tests/engine/test_promptcache.py
+
+import os
+import pytest
+from valai.engine.checkpoint import Checkpoint
+from valai.engine.promptcache import PromptCache
+
+@pytest.fixture
+def prompt_cache(tmp_path) -> PromptCache:
+    """
+    Pytest fixture to create a PromptCache with room for two 100 byte (uncompressed) states.
+    """
+    return PromptCache(fingerprint="test", prompt_cache_path=str(tmp_path), prompt_cache_budget=200,
+                       prompt_cache_codec='none')
+
+def make_checkpoint(tokens : list, size : int = 100) -> Checkpoint:
+    return Checkpoint(name="prompt", state=bytearray(size), n_past=len(tokens), tokens=tokens)
+
+def test_longest_prefix(prompt_cache : PromptCache):
+    """
+    Test the longest cached prefix of a prompt is found.
+    """
+    prompt_cache.put(make_checkpoint([1, 2]))
+    prompt_cache.put(make_checkpoint([1, 2, 3, 4]))
+    checkpoint = prompt_cache.lookup([1, 2, 3, 4, 5])
+    assert checkpoint is not None
+    assert checkpoint.tokens == [1, 2, 3, 4]
+    checkpoint = prompt_cache.lookup([1, 2, 3, 5])
+    assert checkpoint is not None
+    assert checkpoint.tokens == [1, 2]
+    assert prompt_cache.lookup([1, 2, 3], n_min=3) is None
+    assert prompt_cache.lookup([2, 3]) is None
+
+def test_persistence(prompt_cache : PromptCache):
+    """
+    Test the cache is read back by a new instance, but not for another model.
+    """
+    prompt_cache.put(make_checkpoint([1, 2, 3]))
+    reloaded = PromptCache(fingerprint="test", prompt_cache_path=prompt_cache.path)
+    assert reloaded.lookup([1, 2, 3]) is not None
+    other = PromptCache(fingerprint="other", prompt_cache_path=prompt_cache.path)
+    assert other.lookup([1, 2, 3]) is None
+
+def test_eviction(prompt_cache : PromptCache):
+    """
+    Test the least recently used state is evicted when we are over budget.
+    """
+    prompt_cache.put(make_checkpoint([1]))
+    prompt_cache.put(make_checkpoint([2]))
+    prompt_cache.lookup([1])
+    prompt_cache.put(make_checkpoint([3]))
+    assert prompt_cache.total == 200
+    assert prompt_cache.lookup([2]) is None
+    assert prompt_cache.lookup([1]) is not None
+
+def test_shared(prompt_cache : PromptCache):
+    """
+    Test two caches on one directory (as two processes would be) keep each other's entries, within one budget.
+    """
+    other = PromptCache(fingerprint="test", prompt_cache_path=prompt_cache.path, prompt_cache_budget=200,
+                        prompt_cache_codec='none')
+    prompt_cache.put(make_checkpoint([1]))
+    other.put(make_checkpoint([2]))
+    assert prompt_cache.lookup([2]) is not None
+    prompt_cache.put(make_checkpoint([3]))
+    assert other.lookup([1]) is None
+    assert other.total == 200
+    # Nothing is left on disk for the entries that were evicted
+    assert len([name for name in os.listdir(prompt_cache.path) if name.endswith('.checkpoint')]) == 2
+
+def test_sweep(prompt_cache : PromptCache):
+    """
+    Test files missing from the index are removed, rather than left outside the budget.
+    """
+    prompt_cache.store.write(make_checkpoint([9]))
+    with open(os.path.join(prompt_cache.path, 'old.context.dat'), 'wb') as fp:
+        fp.write(bytes(100))
+    prompt_cache.put(make_checkpoint([1]))
+    assert sorted(os.listdir(prompt_cache.path)) == sorted([f"{prompt_cache.key([1])}.checkpoint",
+                                                           f"{prompt_cache.key([1])}.checkpoint.json",
+                                                           'index.json', 'index.lock'])
@@ -55,3 +55,13 @@ def test_read(default_flow_engine : FlowEngine, test_config : EngineTestConfig):
     assert rc >= 0
     results = default_flow_engine.read(**test_config)
     assert results is not None and len(results) > 0
+
+def test_read_mask_abort(default_flow_engine : FlowEngine, test_config : EngineTestConfig):
+    """
+    Test masked abort tokens are never sampled.
+    """
+    default_flow_engine.feed(prompt="Test prompt", **test_config)
+    abort_tokens = ['.', ',', '\n']
+    results = default_flow_engine.read(max_tokens=10, abort_tokens=abort_tokens, mask_abort=True, **test_config)
+    assert results is not None
+    assert not any(r in abort_tokens for r in results)
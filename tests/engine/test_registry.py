@@ -0,0 +1,29 @@
+# tests/engine/test_registry.py
+
+import gc
+from valai.engine.llamaflow import FlowEngine
+from valai.engine.registry import model_registry
+from tests.config import default_config
+
+def test_shared_model():
+    """
+    Test engines on the same model share it, each with their own context, and the last one frees it.
+    """
+    config = default_config()
+    gc.collect()
+    first = FlowEngine.from_config(**config)
+    # Engines from other tests may still be holding the model
+    refs = model_registry.refs(first.model) - 1
+    second = FlowEngine.from_config(**{**config, 'n_ctx': config['n_ctx'] // 2})
+    model = first.model
+    assert second.model == model
+    assert second.ctx != first.ctx
+    assert second.n_ctx == config['n_ctx'] // 2
+    assert second.vocab is first.vocab
+    assert model_registry.refs(model) == refs + 2
+    del first
+    gc.collect()
+    assert model_registry.refs(model) == refs + 1
+    del second
+    gc.collect()
+    assert model_registry.refs(model) == refs
@@ -0,0 +1,85 @@
+# tests/engine/test_sampler.py
+
+from ctypes import c_float, c_int, c_size_t, pointer
+import llama_cpp
+import numpy as np
+import pytest
+from valai.engine.llamaflow import TOKEN_DATA_DTYPE
+from valai.engine.sampler import Sampler, TokenRing
+
+@pytest.fixture
+def sampler() -> Sampler:
+    """
+    Pytest fixture to create a seeded Sampler with every penalty enabled.
+    """
+    return Sampler(repeat_penalty=1.1, frequency_penalty=0.1, presence_penalty=0.2, seed=1234)
+
+def llama_distribution(logits : np.ndarray, last_tokens : list, temp : float, top_k : int, tfs_z : float,
+                       typical_p : float, top_p : float, min_p : float) -> dict:
+    """Run the llama.cpp sampler chain, returning the probability of every candidate left"""
+    n_vocab = len(logits)
+    data = np.zeros(n_vocab, dtype=TOKEN_DATA_DTYPE)
+    data['id'] = np.arange(n_vocab)
+    data['logit'] = logits
+    candidates = llama_cpp.llama_token_data_array(data=data.ctypes.data_as(llama_cpp.llama_token_data_p),
+                                                  size=n_vocab, sorted=False)
+    candidates_p = pointer(candidates)
+    min_keep = c_size_t(1)
+    last_n = (c_int * len(last_tokens))(*last_tokens)
+    llama_cpp.llama_sample_repetition_penalties(None, candidates_p, last_n, c_size_t(len(last_tokens)),
+                                                c_float(1.1), c_float(0.1), c_float(0.2))
+    llama_cpp.llama_sample_top_k(None, candidates_p, top_k, min_keep)
+    llama_cpp.llama_sample_tail_free(None, candidates_p, c_float(tfs_z), min_keep)
+    llama_cpp.llama_sample_typical(None, candidates_p, c_float(typical_p), min_keep)
+    llama_cpp.llama_sample_top_p(None, candidates_p, c_float(top_p), min_keep)
+    llama_cpp.llama_sample_min_p(None, candidates_p, c_float(min_p), min_keep)
+    llama_cpp.llama_sample_temperature(None, candidates_p, c_float(temp))
+    llama_cpp.llama_sample_softmax(None, candidates_p)
+    return {int(data['id'][i]): float(data['p'][i]) for i in range(candidates.size)}
+
+def test_token_ring():
+    """
+    Test the ring buffer keeps the most recent tokens, oldest first, padded with zeros.
+    """
+    ring = TokenRing(4)
+    ring.push([1, 2])
+    assert ring.tokens().tolist() == [0, 0, 1, 2]
+    ring.push([3, 4, 5])
+    assert ring.tokens().tolist() == [2, 3, 4, 5]
+    copy = ring.copy()
+    ring.fill([7])
+    assert ring.tokens().tolist() == [0, 0, 0, 7]
+    assert copy.tokens().tolist() == [2, 3, 4, 5]
+
+@pytest.mark.parametrize("params", [
+    dict(temp=0.7, top_k=40, tfs_z=1.0, typical_p=1.0, top_p=1.0, min_p=0.0),
+    dict(temp=1.2, top_k=0, tfs_z=0.0, typical_p=0.0, top_p=0.0, min_p=0.0),
+    dict(temp=0.7, top_k=100, tfs_z=0.95, typical_p=1.0, top_p=0.9, min_p=0.05),
+    dict(temp=0.5, top_k=600, tfs_z=1.0, typical_p=0.9, top_p=0.5, min_p=0.2),
+])
+def test_matches_llama(sampler : Sampler, params : dict):
+    """
+    Test our sampler chain leaves the same candidates, with the same probabilities, as llama.cpp.
+    """
+    rng = np.random.default_rng(0)
+    for _ in range(20):
+        logits = (rng.standard_normal(500) * 3).astype(np.single)
+        last_tokens = rng.integers(0, 500, 64).astype(np.intc)
+        expected = llama_distribution(logits.copy(), last_tokens.tolist(), **params)
+        sampler.penalize(logits, last_tokens)
+        ids, p = sampler.distribution(logits, **params)
+        assert set(ids.tolist()) == set(expected.keys())
+        for id, q in zip(ids.tolist(), p.tolist()):
+            assert q == pytest.approx(expected[id], abs=1e-4)
+
+def test_seeded(sampler : Sampler):
+    """
+    Test a seeded sampler is reproducible, and only samples from the top k.
+    """
+    logits = np.random.default_rng(0).standard_normal(1000).astype(np.single)
+    first = [sampler.sample(logits, temp=1.0, top_k=5) for _ in range(50)]
+    sampler.seed(1234)
+    second = [sampler.sample(logits, temp=1.0, top_k=5) for _ in range(50)]
+    assert first == second
+    assert set(first) <= set(np.argsort(-logits)[:5].tolist())
+    assert sampler.greedy(logits) == int(np.argmax(logits))
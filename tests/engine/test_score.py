@@ -0,0 +1,78 @@
+# tests/engine/test_score.py
+
+import numpy as np
+import pytest
+from valai.engine.llamaflow import FlowEngine
+from tests.config import default_config, EngineTestConfig
+
+PREFIX = "### Instruction: Who speaks next?\n### Response: The next speaker is"
+OPTIONS = [" Novara", " the player", " Grug the barbarian", " nobody"]
+
+@pytest.fixture
+def test_config() -> EngineTestConfig:
+    """
+    Pytest fixture to create a EngineTestConfig instance with default parameters.
+    """
+    return default_config()
+
+@pytest.fixture
+def default_flow_engine(test_config : EngineTestConfig) -> FlowEngine:
+    """
+    Pytest fixture to create a FlowEngine instance with default parameters.
+    """
+    return FlowEngine.from_config(**test_config)
+
+def sequential_score(engine : FlowEngine, prefix : str, option : str) -> float:
+    """Score an option one token at a time, the slow way"""
+    shared = engine.tokenize(prefix)
+    tokens = engine.tokenize(prefix + option)
+    n_shared = 0
+    while n_shared < min(len(shared), len(tokens)) and tokens[n_shared] == shared[n_shared]:
+        n_shared += 1
+    engine.reset()
+    engine.decode(tokens[:n_shared])
+    total = 0.0
+    for token in tokens[n_shared:]:
+        logits = engine.current_logits(engine.sequence).astype(np.float64)
+        total += logits[token] - logits.max() - np.log(np.exp(logits - logits.max()).sum())
+        engine.decode([token])
+    return total
+
+def test_score(default_flow_engine : FlowEngine, test_config : EngineTestConfig):
+    """
+    Test batched scores match scoring each option on its own, and leave the sequence alone.
+    """
+    engine = default_flow_engine
+    engine.execute(prompt="Hello", **test_config)
+    tokens = engine.session_tokens.copy()
+    scores = engine.score(PREFIX, OPTIONS)
+    assert engine.session_tokens == tokens
+    assert list(engine.sequences.keys()) == ['default']
+    assert all(s < 0 for s in scores)
+    # Scores are against the sequence so far, so compare from an empty one
+    engine.reset()
+    scores = engine.score(PREFIX, OPTIONS)
+    expected = [sequential_score(engine, PREFIX, option) for option in OPTIONS]
+    assert scores == pytest.approx(expected, abs=1e-3)
+
+def test_score_groups(test_config : EngineTestConfig):
+    """
+    Test options are scored the same when there are too few sequence ids to decode them all at once.
+    """
+    engine = FlowEngine.from_config(n_seq_max=3, **test_config)
+    scores = engine.score(PREFIX, OPTIONS)
+    single = FlowEngine.from_config(**test_config).score(PREFIX, OPTIONS)
+    assert scores == pytest.approx(single, abs=1e-3)
+    assert engine.score(PREFIX, []) == []
+
+def test_score_merged_prefix(default_flow_engine : FlowEngine):
+    """
+    Test options that merge with the last token of the prefix (a trailing space) are scored from the right place.
+    """
+    engine = default_flow_engine
+    prefix = "### Response: The next speaker is "
+    options = ["the player", "Novara"]
+    scores = engine.score(prefix, options)
+    engine.reset()
+    expected = [sequential_score(engine, prefix, option) for option in options]
+    assert scores == pytest.approx(expected, abs=1e-3)
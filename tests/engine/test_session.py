@@ -0,0 +1,68 @@
+# tests/engine/test_session.py
+
+import os
+import pytest
+from valai.engine.llamaflow import FlowEngine
+from valai.engine.session import Session, SessionLocked, atomic_write
+from tests.config import default_config, EngineTestConfig
+
+@pytest.fixture
+def test_config() -> EngineTestConfig:
+    """
+    Pytest fixture to create a EngineTestConfig instance with default parameters.
+    """
+    return default_config()
+
+def test_paths(tmp_path):
+    """
+    Test a session without an id uses the session path itself, and ids can't escape it.
+    """
+    assert Session(session_path=str(tmp_path)).filename('game.context.dat') == str(tmp_path / 'game.context.dat')
+    session = Session(session_id='game-1', session_path=str(tmp_path))
+    assert session.filename('game.context.dat') == str(tmp_path / 'sessions' / 'game-1' / 'game.context.dat')
+    for session_id in ['../game', 'a/b', '..', '']:
+        with pytest.raises(ValueError):
+            Session(session_id=session_id, session_path=str(tmp_path))
+
+def test_lock(tmp_path):
+    """
+    Test only one holder at a time can lock a session, and others are free to lock theirs.
+    """
+    first = Session(session_id='one', session_path=str(tmp_path)).lock()
+    with pytest.raises(SessionLocked):
+        Session(session_id='one', session_path=str(tmp_path)).lock()
+    other = Session(session_id='two', session_path=str(tmp_path)).lock()
+    first.unlock()
+    again = Session(session_id='one', session_path=str(tmp_path)).lock()
+    assert again.locked
+    again.unlock()
+    other.unlock()
+
+def test_atomic_write(tmp_path):
+    """
+    Test a failed write leaves the old file alone, with nothing beside it.
+    """
+    path = str(tmp_path / 'savegame.txt')
+    with atomic_write(path, 'w') as fp:
+        fp.write('old')
+    with pytest.raises(RuntimeError):
+        with atomic_write(path, 'w') as fp:
+            fp.write('new')
+            raise RuntimeError('disk full')
+    with open(path) as fp:
+        assert fp.read() == 'old'
+    assert os.listdir(tmp_path) == ['savegame.txt']
+
+def test_engine_session(test_config : EngineTestConfig, tmp_path):
+    """
+    Test an engine keeps its context and checkpoints in its session.
+    """
+    session = Session(session_id='game-1', session_path=str(tmp_path))
+    engine = FlowEngine.from_config(session=session, **test_config)
+    engine.execute(prompt="Hello World", **test_config)
+    assert engine.save_context() > 0
+    assert engine.set_checkpoint('turn')
+    assert engine.checkpoints.save('turn')
+    engine.writer.flush()
+    assert sorted(os.listdir(session.path)) == ['game.context.dat', 'turn.checkpoint', 'turn.checkpoint.json']
+    assert engine.load_context() > 0
@@ -0,0 +1,65 @@
+# tests/engine/test_speculative.py
+
+import pytest
+from valai.engine.llamaflow import FlowEngine
+from valai.engine.speculative import PromptLookup, SpeculationStats
+from tests.config import default_config
+
+def test_speculation_stats():
+    """
+    Test acceptance is tracked per verification step.
+    """
+    stats = SpeculationStats()
+    assert stats.acceptance == 0.0
+    stats.record(4, 4)
+    stats.record(4, 1)
+    assert stats.n_steps == 2
+    assert stats.n_accepted == 5
+    assert stats.acceptance == pytest.approx(5 / 8)
+    assert stats.per_step == pytest.approx(2.5)
+
+def test_speculative_read():
+    """
+    Test reading with a draft model gives exactly what we read without one.
+    """
+    config = default_config()
+    plain = FlowEngine.from_config(**config)
+    spec = FlowEngine.from_config(draft_model_file=config['model_file'], n_draft=4, **config)
+    prompt = "Hello World the player said to Novara. " * 4
+    results = []
+    for engine in (plain, spec):
+        engine.sampler.seed(7)
+        engine.feed(prompt=prompt, **config)
+        results.append((engine.read(max_tokens=40, n_temp=0.7, top_k=40, **config), engine.session_tokens[:]))
+    assert results[0] == results[1]
+    assert spec.speculation.n_steps > 0
+    # The draft is the same model, so it should mostly be right
+    assert spec.speculation.n_accepted > 0
+
+def test_prompt_lookup():
+    """
+    Test prompt lookup drafts what followed the longest, most recent match of our tail.
+    """
+    lookup = PromptLookup(n_gram_max=3)
+    # "1 2 3" was followed by 4 5, then later by 9; the most recent match wins
+    assert lookup.propose([1, 2, 3, 4, 5, 1, 2, 3, 9, 7, 1, 2, 3], 2) == [9, 7]
+    # Only the longer match "8 2 3" counts, even though "2 3" is more recent
+    assert lookup.propose([8, 2, 3, 6, 2, 3, 5, 8, 2, 3], 3) == [6, 2, 3]
+    assert lookup.propose([1, 2, 3], 4) == []
+    assert PromptLookup(n_gram_min=2).propose([5, 1, 6, 1], 2) == []
+
+def test_prompt_lookup_read():
+    """
+    Test reading with prompt lookup gives exactly what we read without it.
+    """
+    config = default_config()
+    plain = FlowEngine.from_config(**config)
+    spec = FlowEngine.from_config(prompt_lookup=True, n_draft=4, **config)
+    prompt = "Hello World the player said to Novara. " * 4
+    results = []
+    for engine in (plain, spec):
+        engine.sampler.seed(7)
+        engine.feed(prompt=prompt, **config)
+        results.append((engine.read(max_tokens=40, n_temp=0.7, top_k=40, **config), engine.session_tokens[:]))
+    assert results[0] == results[1]
+    assert spec.speculation.n_steps > 0
@@ -0,0 +1,53 @@
+# tests/engine/test_stream.py
+
+import asyncio
+import pytest
+from valai.engine.llamaflow import FlowEngine
+from tests.config import default_config, EngineTestConfig
+
+@pytest.fixture
+def test_config() -> EngineTestConfig:
+    """
+    Pytest fixture to create a EngineTestConfig instance with default parameters.
+    """
+    return default_config()
+
+@pytest.fixture
+def default_flow_engine(test_config : EngineTestConfig) -> FlowEngine:
+    """
+    Pytest fixture to create a FlowEngine instance with default parameters.
+    """
+    return FlowEngine.from_config(**test_config)
+
+async def collect(engine : FlowEngine, limit : int = -1, **kwargs) -> list:
+    tokens = []
+    async for token in engine.stream(**kwargs):
+        tokens.append(token)
+        if len(tokens) == limit:
+            break
+    return tokens
+
+def test_stream(default_flow_engine : FlowEngine, test_config : EngineTestConfig):
+    """
+    Test streaming yields the same tokens as a read, with the prompt executed on the worker.
+    """
+    prompt = "### Instruction: Say hello to Novara\n### Response:\n"
+    default_flow_engine.execute(prompt=prompt, **test_config)
+    expected = default_flow_engine.read(max_tokens=30, n_temp=0, **test_config)
+    default_flow_engine.reset()
+    tokens = asyncio.run(collect(default_flow_engine, prompt=prompt, max_tokens=30, n_temp=0, max_queue=2, **test_config))
+    assert tokens == expected
+
+def test_stream_cancel(default_flow_engine : FlowEngine, test_config : EngineTestConfig):
+    """
+    Test leaving a stream early stops the read, and leaves the engine usable.
+    """
+    prompt = "### Instruction: Say hello to Novara\n### Response:\n"
+    default_flow_engine.execute(prompt=prompt, **test_config)
+    n_past = default_flow_engine.n_past
+    tokens = asyncio.run(collect(default_flow_engine, limit=2, max_tokens=200, n_temp=0, n_draft=0, max_queue=1,
+                                 stop_tokens=[], **test_config))
+    assert len(tokens) == 2
+    # The reader may be a token or two ahead of us when we stop, but no further
+    assert default_flow_engine.n_past <= n_past + 4
+    assert len(default_flow_engine.read(max_tokens=5, n_temp=0, **test_config)) > 0
@@ -0,0 +1,57 @@
+# tests/engine/test_vocab.py
+
+import pytest
+from valai.engine.vocab import Vocabulary
+
+@pytest.fixture
+def vocab() -> Vocabulary:
+    """
+    Pytest fixture to create a small Vocabulary, with a character split across two tokens.
+    """
+    return Vocabulary([b'', b'\n', b'[', b'>', b'\n', b'hello', 'é'.encode('utf-8')[:1], 'é'.encode('utf-8')[1:]])
+
+def test_token_ids(vocab : Vocabulary):
+    """
+    Test pieces map back to every token id that produces them.
+    """
+    assert vocab.token_ids(['\n']) == {1, 4}
+    assert vocab.newline_ids == {1, 4}
+    assert vocab.token_ids(['missing']) == set()
+
+def test_compile(vocab : Vocabulary):
+    """
+    Test guidance tokens compile into id sets and transitions, and are cached.
+    """
+    matcher = vocab.compile(abort_tokens=['>'], stop_tokens=['\n'], sequence_tokens=[['\n', '[']])
+    assert matcher.abort_ids == {3}
+    assert matcher.stop_ids == {1, 4}
+    assert matcher.is_sequence(4, 2)
+    assert not matcher.is_sequence(2, 4)
+    assert vocab.compile(abort_tokens=['>'], stop_tokens=['\n'], sequence_tokens=[['\n', '[']]) is matcher
+
+def test_decoder(vocab : Vocabulary):
+    """
+    Test a multi-byte character split across tokens is reassembled.
+    """
+    decoder = vocab.decoder()
+    assert decoder.decode(vocab.piece_bytes[6]) == ''
+    assert decoder.decode(vocab.piece_bytes[7]) == 'é'
+
+def test_abort_bias(vocab : Vocabulary):
+    """
+    Test abort tokens are masked with a -inf bias, and nothing else is.
+    """
+    matcher = vocab.compile(abort_tokens=['>', '['])
+    bias = matcher.abort_bias
+    assert bias.shape == (len(vocab),)
+    assert list(bias[[2, 3]]) == [float('-inf')] * 2
+    assert (bias[[0, 1, 4, 5, 6, 7]] == 0).all()
+    assert matcher.abort_bias is bias
+
+def test_encode(vocab : Vocabulary):
+    """
+    Test greedy tokenization takes the longest pieces, and stops at anything it can't match.
+    """
+    assert vocab.encode('hello\n[') == [5, 4, 2]
+    assert vocab.encode('[x>') == [2]
+    assert vocab.char_ids == {'\n': 4, '[': 2, '>': 3}
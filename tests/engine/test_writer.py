@@ -0,0 +1,71 @@
+# tests/engine/test_writer.py
+
+import os
+import llama_cpp
+import pytest
+from valai.engine.llamaflow import FlowEngine
+from valai.engine.session import Session
+from valai.engine.writer import StateWriter
+from tests.config import default_config, EngineTestConfig
+
+@pytest.fixture
+def test_config() -> EngineTestConfig:
+    """
+    Pytest fixture to create a EngineTestConfig instance with default parameters.
+    """
+    return default_config()
+
+def test_writer(tmp_path):
+    """
+    Test writes land whole, in order, and the two buffers are reused rather than reallocated.
+    """
+    writer = StateWriter()
+    path = str(tmp_path / "state" / "game.context.dat")
+    buffers = set()
+    for i in range(6):
+        buffer = writer.buffer(16)
+        buffers.add(id(buffer))
+        buffer[:] = bytes([i] * len(buffer))
+        writer.submit(path, buffer, [b'head', memoryview(buffer)[:8]])
+    writer.flush(path)
+    assert not writer.busy()
+    assert len(buffers) <= 2
+    with open(path, "rb") as fp:
+        assert fp.read() == b'head' + bytes([5] * 8)
+    assert os.listdir(tmp_path / "state") == ["game.context.dat"]
+    writer.close()
+    assert writer.thread is None
+
+def test_save_load_context(test_config : EngineTestConfig, tmp_path):
+    """
+    Test a context saved in the background loads back, and leaves the engine able to carry on.
+    """
+    # Clearing also discards the game checkpoint, which must be ours, not the one in local/
+    engine = FlowEngine.from_config(session=Session(session_path=str(tmp_path)), **test_config)
+    save_file = str(tmp_path / "game.context.dat")
+    engine.execute(prompt="Hello World the player said to Novara.", **test_config)
+    assert engine.save_context(save_file=save_file) > 0
+    assert engine.load_context(save_file) > 0
+    assert engine.read(max_tokens=5, n_temp=0, **test_config) is not None
+    assert engine.clear_saved_context(save_file=save_file) == 0
+    assert not os.path.exists(save_file)
+
+def test_compact_state(test_config : EngineTestConfig, tmp_path):
+    """
+    Test a state file only holds what is in use, restores our tokens, and is refused by another context size.
+    """
+    engine = FlowEngine.from_config(session=Session(session_path=str(tmp_path)), **test_config)
+    save_file = str(tmp_path / "game.context.dat")
+    engine.execute(prompt="Hello World the player said to Novara.", **test_config)
+    tokens = engine.session_tokens.copy()
+    expected = engine.read(max_tokens=10, n_temp=0, **test_config)
+    engine.truncate_sequence(len(tokens))
+    engine.save_context(save_file=save_file)
+    engine.writer.flush()
+    assert os.path.getsize(save_file) < llama_cpp.llama_get_state_size(engine.ctx) // 4
+    engine.reset()
+    assert engine.load_context(save_file) > 0
+    assert engine.session_tokens == tokens
+    assert engine.read(max_tokens=10, n_temp=0, **test_config) == expected
+    other = FlowEngine.from_config(**{**test_config, 'n_ctx': 2048})
+    assert other.load_context(save_file) == -1
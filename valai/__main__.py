@@ -87,6 +87,16 @@ if __name__ == '__main__':
     charm_parser.add_argument('--batch', type=int, default=DEFAULT_BATCH_SIZE, dest='n_batch', help='LLAMA Batch Size')
     charm_parser.add_argument('--layers', type=int, default=DEFAULT_GPU_LAYERS, dest="n_gpu_layers", help='LLAMA GPU Layers')
     charm_parser.add_argument('--ctx', type=int, default=DEFAULT_CONTEXT_SIZE, dest="n_ctx", help='LLAMA Context Size')
+    charm_parser.add_argument('--checkpoint-age', type=float, default=None, dest="checkpoint_max_age", help='Spill checkpoints unused for this many seconds to disk')
+    charm_parser.add_argument('--checkpoint-codec', type=str, default='zlib', dest="checkpoint_codec", help='Compression for spilled checkpoints (none, zlib, bz2, lzma)')
+    charm_parser.add_argument('--prompt-cache', action='store_true', dest="prompt_cache", help='Cache decoded prompts on disk between runs')
+    charm_parser.add_argument('--mask-abort', action='store_true', dest="mask_abort", help='Never sample the guidance abort tokens')
+    charm_parser.add_argument('--draft-model', type=str, dest="draft_model_file", default=None, help='Draft model file (gguf) for speculative decoding')
+    charm_parser.add_argument('--candidates', type=int, default=1, dest="n_candidates", help='Read this many alternatives for each line, for instant retries')
+    charm_parser.add_argument('--prompt-lookup', action='store_true', dest="prompt_lookup", help='Draft tokens from n-grams in the history for speculative decoding')
+    charm_parser.add_argument('--draft', type=int, default=5, dest="n_draft", help='Max tokens to draft per decode')
+    charm_parser.add_argument('--session', type=str, default=None, dest="session_id", help='Keep this game\'s files in a session of their own')
+    charm_parser.add_argument('--metrics', action='store_true', dest="metrics", help='Record engine timings and token counts, logged each turn')
     charm_parser.add_argument('-v', '--verbose', action='store_true', help='Verbose output')
 
     pinnacle_parser = argparse.ArgumentParser(add_help=False)
@@ -101,6 +111,17 @@ if __name__ == '__main__':
     pinnacle_parser.add_argument('--batch', type=int, default=DEFAULT_BATCH_SIZE, dest='n_batch', help='LLAMA Batch Size')
     pinnacle_parser.add_argument('--layers', type=int, default=DEFAULT_GPU_LAYERS, dest="n_gpu_layers", help='LLAMA GPU Layers')
     pinnacle_parser.add_argument('--ctx', type=int, default=DEFAULT_CONTEXT_SIZE, dest="n_ctx", help='LLAMA Context Size')
+    pinnacle_parser.add_argument('--shift', action='store_true', dest="context_shift", help='Shift old history out of a full context')
+    pinnacle_parser.add_argument('--checkpoint-age', type=float, default=None, dest="checkpoint_max_age", help='Spill checkpoints unused for this many seconds to disk')
+    pinnacle_parser.add_argument('--checkpoint-codec', type=str, default='zlib', dest="checkpoint_codec", help='Compression for spilled checkpoints (none, zlib, bz2, lzma)')
+    pinnacle_parser.add_argument('--prompt-cache', action='store_true', dest="prompt_cache", help='Cache decoded prompts on disk between runs')
+    pinnacle_parser.add_argument('--mask-abort', action='store_true', dest="mask_abort", help='Never sample the guidance abort tokens')
+    pinnacle_parser.add_argument('--draft-model', type=str, dest="draft_model_file", default=None, help='Draft model file (gguf) for speculative decoding')
+    pinnacle_parser.add_argument('--prompt-lookup', action='store_true', dest="prompt_lookup", help='Draft tokens from n-grams in the history for speculative decoding')
+    pinnacle_parser.add_argument('--draft', type=int, default=5, dest="n_draft", help='Max tokens to draft per decode')
+    pinnacle_parser.add_argument('--candidates', type=int, default=1, dest="n_candidates", help='Read this many alternatives for each line, for instant retries')
+    pinnacle_parser.add_argument('--session', type=str, default=None, dest="session_id", help='Keep this game\'s files in a session of their own')
+    pinnacle_parser.add_argument('--metrics', action='store_true', dest="metrics", help='Record engine timings and token counts, logged each turn')
     pinnacle_parser.add_argument('-v', '--verbose', action='store_true', help='Verbose output')
 
     summ_cmd = subparsers.add_parser('summarize', parents=[summary_parser], help='Summarize an article')
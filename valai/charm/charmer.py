@@ -5,6 +5,7 @@ import logging
 import os
 from typing import List, Optional
 
+from ..engine.session import Session, atomic_write
 from .shadow import ContextShadowing
 from .prompt import Librarian
 from .guidance import GuidanceStrategy
@@ -16,7 +17,8 @@ class Charmer:
     """The Charmer is the main interface to the Charm system. It is responsible for
     managing the game state, and the interaction between the player and the system.
     """
-    def __init__(self, library : Librarian, shadow : ContextShadowing, guidance : GuidanceStrategy, history_threshold : int = 100) -> None:
+    def __init__(self, library : Librarian, shadow : ContextShadowing, guidance : GuidanceStrategy, history_threshold : int = 100,
+                 session : Optional[Session] = None) -> None:
         self.library = library
         self.shadow = shadow
         self.turn_count = 0
@@ -26,11 +28,13 @@ class Charmer:
         self.current_history = []
         self.char_dialog = defaultdict(list)
         self.guidance = guidance
+        # Where our save game goes
+        self.session = session or Session()
 
     def init_history(self, load : bool = False, **kwargs) -> bool:
         history = None
         if load: 
-            history = self.load_game_text()
+            history = self.load_game_text(save_file=self.session.filename('savegame.txt'))
         initial_q = "> New Game"
         initial_a = "Narrator: (informative) Welcome to Verana"
         if history is None:
@@ -145,7 +149,7 @@ class Charmer:
         return items
 
     @classmethod
-    def from_config(cls, **kwargs) -> 'Charmer':
+    def from_config(cls, session : Optional[Session] = None, **kwargs) -> 'Charmer':
         config = { 
             'resources_path': 'resources',
             'scene_name': 'verana',
@@ -157,11 +161,11 @@ class Charmer:
         library = Librarian.from_config(**config)
         shadow = ContextShadowing.from_file(**config)
         guidance = GuidanceStrategy.from_config(**config)
-        return cls(library=library, shadow=shadow, guidance=guidance)
+        return cls(library=library, shadow=shadow, guidance=guidance, session=session or Session.from_config(**config))
     
     def save_game(self, **kwargs) -> str:
         history = self.past_history + self.current_history
-        return self.save_game_text(history, **kwargs)
+        return self.save_game_text(history, **{'save_file': self.session.filename('savegame.txt'), **kwargs})
 
     @classmethod
     def save_game_text(cls, history: list[str], **kwargs) -> str:
@@ -171,7 +175,7 @@ class Charmer:
         }
 
         save_file = config['save_file']
-        with open(save_file, 'w') as f:
+        with atomic_write(save_file, 'w') as f:
             for h in history:
                 f.write(h + '\n')
 
@@ -204,7 +208,7 @@ class Charmer:
             **kwargs
         }
 
-        with open(config['save_file'], 'wb') as f:
+        with atomic_write(config['save_file'], 'wb') as f:
             separator = b'\x1E'  # custom separator byte
             for entry in history:
                 f.write(entry.encode() + separator)
@@ -9,6 +9,7 @@ from ..analysis.summarizer import ChainOfAnalysis
 from ..ioutil import CaptureFD
 from ..engine.llamaflow import FlowEngine, EngineException, OutputHandler
 from ..engine.grammar import load_grammar
+from ..engine.session import Session, SessionLocked
 
 from .charmer import Charmer
 from .token import TokenFeatures
@@ -57,12 +58,14 @@ class CharmWizard:
     @classmethod
     def from_config(cls, **kwargs):
         output = OutputHandler()
-        charmer = Charmer.from_config(**kwargs)
+        # Our game files are ours alone while we run
+        session = Session.from_config(**kwargs).lock()
+        charmer = Charmer.from_config(session=session, **kwargs)
         if not kwargs.get('verbose', False):
             with CaptureFD() as co:
-                engine = FlowEngine.from_config(output=output, **kwargs)
+                engine = FlowEngine.from_config(output=output, session=session, **kwargs)
         else:
-            engine = FlowEngine.from_config(output=output, **kwargs)
+            engine = FlowEngine.from_config(output=output, session=session, **kwargs)
 
         self = cls(charmer=charmer, engine=engine, output=output)
         self.current_system = self.charmer.system(**kwargs)
@@ -133,13 +136,15 @@ class CharmWizard:
             data = f.read()
         return data
 
-    def run_charm(self, r_length : int, r_temp : float, refresh_threshold : int = 10, **kwargs):
+    def run_charm(self, r_length : int, r_temp : float, refresh_threshold : int = 10, n_candidates : int = 1, **kwargs):
         self.println("Starting Game...")
         grammar = load_grammar(grammar_file='charm.gbnf', **kwargs)
         self.init(**kwargs)
 
         running = True
         retry = False
+        # Which of the engine's alternatives for the last line we are showing
+        candidate_ix = 0
         self.show_history(**kwargs)
         refresh = refresh_threshold
         last_input = ''
@@ -221,6 +226,24 @@ class CharmWizard:
                         self.println(f"Tokens {self.engine.n_past}")
                         self.println(f"System {self.engine.n_system}")
                         self.println(f"Context {self.engine.n_ctx}")
+                        self.println(f"Checkpoints {self.engine.checkpoints.stats}")
+                        continue
+                    elif asplit[0] == 'metrics':
+                        if not self.engine.metrics.enabled:
+                            self.println("Timings are disabled, run with --metrics")
+                        if len(asplit) > 1 and asplit[1].strip() == 'prom':
+                            self.println(self.engine.metrics.to_prometheus())
+                        else:
+                            self.println(self.engine.metrics.to_json(indent=2))
+                        continue
+                    elif asplit[0] == 'retry' and len(asplit) == 1 and candidate_ix + 1 < len(self.engine.alternatives):
+                        # Show the next alternative we read for the last line, rather than reading again
+                        candidate_ix += 1
+                        candidate = self.engine.accept_candidate(candidate_ix, grammar=grammar)
+                        self.charmer.current_history.pop()
+                        self.charmer.add_history('model', candidate.text.strip())
+                        self.println(f"Alternative {candidate_ix + 1} of {len(self.engine.alternatives)}:")
+                        self.output.handle_token(candidate.text)
                         continue
                     elif asplit[0] == 'retry':
                         self.charmer.pop()
@@ -363,7 +386,7 @@ class CharmWizard:
                         self.println('  chapter, show, load, renew, save, last, expand, pop, restart, retry, history, quit, help')
                         self.println('  read, readall, write, wipe, prompt, prompt_reset, historyinfo, play_history')
                         self.println('  scene, summary, improve, resummarize')
-                        self.println('  context, back')
+                        self.println('  context, back, metrics')
                         continue
                     else:
                         player_input = f"> {action.strip()}"
@@ -391,7 +414,15 @@ class CharmWizard:
                 zx = False
                 grammar.reset()
                 for i in range(3):
-                    result = self.engine.read(max_tokens=r_length, n_temp=r_temp, grammar=grammar, **self.charmer.guidance.tokens, **kwargs)
+                    if n_candidates > 1:
+                        candidates = self.engine.read_candidates(n_candidates=n_candidates, max_tokens=r_length, n_temp=r_temp,
+                                                                 grammar=grammar, **self.charmer.guidance.tokens, **kwargs)
+                        candidate_ix = 0
+                        candidate = self.engine.accept_candidate(candidate_ix, grammar=grammar)
+                        result = [] if candidate is None else candidate.tokens
+                        self.output.handle_token(''.join(result))
+                    else:
+                        result = self.engine.read(max_tokens=r_length, n_temp=r_temp, grammar=grammar, **self.charmer.guidance.tokens, **kwargs)
                     if result is None:
                         # Rollback
                         self.engine.reload_turn(**kwargs)
@@ -405,6 +436,8 @@ class CharmWizard:
                     # self.println(f"{response}")
                     self.charmer.add_history('model', response)
                     check_input = True
+                # Everything since the player's input, from the prepare to the last read
+                self.engine.metrics.end_turn()
             except EngineException as e:
                 # We have too many tokens in our prompt.  Lets halve our history and
                 # try again.
@@ -414,7 +447,11 @@ class CharmWizard:
 
 def run_charm(**kwargs):
     config = CharmWizard.expand_config(kwargs)
-    app = CharmWizard.from_config(**config)
+    try:
+        app = CharmWizard.from_config(**config)
+    except SessionLocked as e:
+        logger.error(f"{e}, pick another with --session")
+        return
     app.run_charm(**config)
 
 if __name__ == "__main__":
@@ -1,4 +1,5 @@
 # valai/flow/__init__.py
 
 from .output import OutputHandler
+from .sequence import FlowSequence
 from .llamaflow import FlowEngine, EngineException
\ No newline at end of file
@@ -0,0 +1,217 @@
+# valai/engine/checkpoint.py
+
+import bz2
+from collections import OrderedDict
+import json
+import logging
+import lzma
+import os
+import time
+import zlib
+from typing import Callable, Dict, List, Optional, Tuple
+
+from .session import atomic_write
+
+logger = logging.getLogger(__name__)
+
+# How each codec compresses and decompresses a spilled state, by name.  Most of a state is the KV cache,
+# which zlib at its fastest level shrinks nearly as well as the slower codecs.
+CODECS : Dict[str, Tuple[Callable[[bytes], bytes], Callable[[bytes], bytes]]] = {
+    'none': (bytes, bytes),
+    'zlib': (lambda data: zlib.compress(data, 1), zlib.decompress),
+    'bz2': (lambda data: bz2.compress(data, 1), bz2.decompress),
+    'lzma': (lambda data: lzma.compress(data, preset=0), lzma.decompress),
+}
+# What a damaged or foreign file can raise while we read it back
+DECODE_ERRORS = (OSError, ValueError, KeyError, EOFError, zlib.error, lzma.LZMAError)
+
+
+class Checkpoint:
+    """A copy of the llama state, along with the sequence tokens that produced it"""
+    def __init__(self, name : str, state : bytearray, n_past : int, tokens : List[int]):
+        self.name = name
+        self.state = state
+        self.n_past = n_past
+        self.tokens = tokens
+
+    @property
+    def size(self) -> int:
+        return len(self.state)
+
+    def __repr__(self) -> str:
+        return f"Checkpoint({self.name}, n_past={self.n_past}, size={self.size})"
+
+
+class CheckpointStats:
+    """How our checkpoint lookups were served, and how much we have spilled to disk"""
+    def __init__(self):
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.bytes_written = 0
+        self.bytes_read = 0
+
+    @property
+    def lookups(self) -> int:
+        return self.hits + self.disk_hits + self.misses
+
+    def snapshot(self) -> Dict[str, int]:
+        return {'lookups': self.lookups, 'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses,
+                'evictions': self.evictions, 'expirations': self.expirations,
+                'bytes_written': self.bytes_written, 'bytes_read': self.bytes_read}
+
+    def __repr__(self) -> str:
+        return (f"CheckpointStats(hits={self.hits}, disk_hits={self.disk_hits}, misses={self.misses}, "
+                f"evictions={self.evictions}, expirations={self.expirations}, written={self.bytes_written}, "
+                f"read={self.bytes_read})")
+
+
+class CheckpointStore:
+    """
+        CheckpointStore keeps named llama states in two tiers.  Hot checkpoints are kept in memory under
+        a byte budget, and the least recently used are spilled to disk (compressed) when the budget is
+        exceeded, or when they haven't been used for max_age seconds.  Spilled checkpoints are read back
+        on demand.
+    """
+    def __init__(self, checkpoint_path : str = 'local', checkpoint_budget : int = 2 ** 31,
+                 checkpoint_max_age : Optional[float] = None, checkpoint_codec : str = 'zlib'):
+        if checkpoint_codec not in CODECS:
+            raise ValueError(f"Unknown checkpoint codec {checkpoint_codec}: {','.join(CODECS.keys())}")
+        self.path = checkpoint_path
+        self.budget = checkpoint_budget
+        self.max_age = checkpoint_max_age
+        self.codec = checkpoint_codec
+        self.total = 0
+        self.checkpoints : OrderedDict[str, Checkpoint] = OrderedDict()
+        # When each checkpoint in memory was last used
+        self.used : Dict[str, float] = {}
+        self.stats = CheckpointStats()
+
+    @classmethod
+    def from_config(cls, checkpoint_path : str = 'local', checkpoint_budget : int = 2 ** 31,
+                    checkpoint_max_age : Optional[float] = None, checkpoint_codec : str = 'zlib',
+                    **kwargs) -> 'CheckpointStore':
+        return cls(checkpoint_path=checkpoint_path, checkpoint_budget=checkpoint_budget,
+                   checkpoint_max_age=checkpoint_max_age, checkpoint_codec=checkpoint_codec)
+
+    def filename(self, name : str) -> str:
+        # Not .context.dat, which is what save_context writes its state files as
+        return os.path.join(self.path, f"{name}.checkpoint")
+
+    def put(self, checkpoint : Checkpoint):
+        """Store a checkpoint, spilling the least recently used to disk if we are over budget"""
+        self.drop(checkpoint.name)
+        self.checkpoints[checkpoint.name] = checkpoint
+        self.used[checkpoint.name] = time.monotonic()
+        self.total += checkpoint.size
+        # We always keep the newest checkpoint in memory, even if it is over budget on its own
+        while self.total > self.budget and len(self.checkpoints) > 1:
+            self.evict(next(iter(self.checkpoints)))
+            self.stats.evictions += 1
+        self.expire()
+
+    def evict(self, name : str):
+        """Spill a checkpoint from memory to disk"""
+        evicted = self.checkpoints[name]
+        logger.debug(f"Evicting checkpoint {evicted}")
+        self.write(evicted)
+        self.drop(name)
+
+    def expire(self, now : Optional[float] = None) -> int:
+        """Spill the checkpoints that haven't been used for max_age seconds, returning how many there were"""
+        if self.max_age is None:
+            return 0
+        now = time.monotonic() if now is None else now
+        expired = [name for name, used in self.used.items() if now - used > self.max_age]
+        for name in expired:
+            self.evict(name)
+        self.stats.expirations += len(expired)
+        return len(expired)
+
+    def get(self, name : str) -> Optional[Checkpoint]:
+        """Get a checkpoint from memory, or from disk if it was spilled"""
+        checkpoint = self.checkpoints.get(name, None)
+        if checkpoint is not None:
+            self.checkpoints.move_to_end(name)
+            self.used[name] = time.monotonic()
+            self.stats.hits += 1
+            return checkpoint
+        checkpoint = self.read(name)
+        if checkpoint is None:
+            self.stats.misses += 1
+            return None
+        self.stats.disk_hits += 1
+        self.put(checkpoint)
+        return checkpoint
+
+    def save(self, name : str) -> bool:
+        """Explicitly write a checkpoint to disk"""
+        checkpoint = self.checkpoints.get(name, None)
+        if checkpoint is None:
+            return False
+        self.write(checkpoint)
+        return True
+
+    def drop(self, name : str) -> bool:
+        """Remove a checkpoint from memory"""
+        checkpoint = self.checkpoints.pop(name, None)
+        if checkpoint is None:
+            return False
+        del self.used[name]
+        self.total -= checkpoint.size
+        return True
+
+    def discard(self, name : str) -> bool:
+        """Remove a checkpoint from memory and disk"""
+        dropped = self.drop(name)
+        save_file = self.filename(name)
+        for filename in (save_file, f"{save_file}.json"):
+            if os.path.exists(filename):
+                os.remove(filename)
+                dropped = True
+        return dropped
+
+    def clear(self):
+        self.checkpoints.clear()
+        self.used.clear()
+        self.total = 0
+
+    def write(self, checkpoint : Checkpoint) -> int:
+        """Write a checkpoint to disk with our codec, returning the number of bytes written"""
+        save_file = self.filename(checkpoint.name)
+        compress, _ = CODECS[self.codec]
+        data = compress(checkpoint.state)
+        with atomic_write(save_file, "wb") as fp:
+            fp.write(data)
+        with atomic_write(f"{save_file}.json", "w") as fp:
+            json.dump({'n_past': checkpoint.n_past, 'tokens': checkpoint.tokens, 'codec': self.codec,
+                       'size': checkpoint.size}, fp)
+        self.stats.bytes_written += len(data)
+        logger.debug(f"Wrote checkpoint {checkpoint} to {save_file} ({len(data)} bytes, {self.codec})")
+        return len(data)
+
+    def read(self, name : str) -> Optional[Checkpoint]:
+        save_file = self.filename(name)
+        if not os.path.exists(save_file) or not os.path.exists(f"{save_file}.json"):
+            return None
+        try:
+            with open(f"{save_file}.json", "r") as fp:
+                meta = json.load(fp)
+            # Checkpoints written before we compressed them have no codec
+            codec = meta.get('codec', 'none')
+            if codec not in CODECS:
+                logger.error(f"Unknown codec {codec} for checkpoint {name}")
+                return None
+            with open(save_file, "rb") as fp:
+                data = fp.read()
+            _, decompress = CODECS[codec]
+            state = bytearray(decompress(data))
+            checkpoint = Checkpoint(name=name, state=state, n_past=meta['n_past'], tokens=meta['tokens'])
+        except DECODE_ERRORS as e:
+            logger.warning(f"Can not read checkpoint {name} from {save_file}: {e}")
+            return None
+        self.stats.bytes_read += len(data)
+        logger.debug(f"Read checkpoint {name} from {save_file}")
+        return checkpoint
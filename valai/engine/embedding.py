@@ -0,0 +1,107 @@
+# valai/engine/embedding.py
+
+from ctypes import c_void_p
+import logging
+import threading
+from typing import List, Optional
+
+import llama_cpp
+import numpy as np
+
+from .registry import model_registry
+
+logger = logging.getLogger(__name__)
+
+
+class Embedder:
+    """
+        Embedder turns text into vectors with a context of its own, in embedding mode, so it never disturbs the
+        sequences of the engine sharing its model.  llama.cpp gives us the hidden state of the last token in a
+        batch, so each text is pooled to its last token.  Texts are embedded in sorted order, so each one only
+        decodes what differs from the one before; the KV cells of a shared token prefix are reused.
+    """
+    def __init__(self, model : c_void_p, ctx : c_void_p, n_ctx : int, n_batch : int = 512):
+        self.model = model
+        self.ctx = ctx
+        self.n_ctx = n_ctx
+        self.n_batch = min(n_ctx, n_batch)
+        self.n_embd = llama_cpp.llama_n_embd(self.model)
+        self.batch = llama_cpp.llama_batch_init(self.n_batch, 0, 1)
+        self.lock = threading.Lock()
+        # The tokens in our KV cache, from the last text we embedded
+        self.cache_tokens : List[int] = []
+
+    @classmethod
+    def from_model(cls, model : c_void_p, n_ctx : int = 512, n_batch : int = 512, **kwargs) -> 'Embedder':
+        """Create an embedding context on a model we (or another engine) already loaded through the registry"""
+        from .llamaflow import FlowEngine
+        cparams = FlowEngine.get_cparams(n_ctx=n_ctx, n_batch=n_batch, embedding=True, **kwargs)
+        ctx = llama_cpp.llama_new_context_with_model(model, cparams)
+        if not ctx:
+            raise ValueError("Failed to create an embedding context")
+        model_registry.retain(model)
+        return cls(model=model, ctx=ctx, n_ctx=n_ctx, n_batch=cparams.n_batch)
+
+    def tokenize(self, text : str) -> List[int]:
+        """Tokenize text the way FlowEngine.tokenize does, keeping at most n_ctx tokens"""
+        b_text = b" " + text.encode('ascii', 'ignore')
+        tokens = (llama_cpp.llama_token * (len(b_text) + 1))()
+        n_tokens = llama_cpp.llama_tokenize(model=self.model, text=b_text, text_len=len(b_text), tokens=tokens,
+                                            n_max_tokens=tokens._length_, add_bos=True, special=False)
+        if n_tokens > self.n_ctx:
+            logger.debug(f"Truncating text from {n_tokens} to {self.n_ctx} tokens for embedding")
+            n_tokens = self.n_ctx
+        return tokens[:n_tokens]
+
+    def embed_tokens(self, tokens : List[int]) -> Optional[np.ndarray]:
+        """The embedding of the last token, decoding only what isn't already in our KV cache"""
+        n_cached = 0
+        while n_cached < min(len(tokens), len(self.cache_tokens)) and tokens[n_cached] == self.cache_tokens[n_cached]:
+            n_cached += 1
+        # The last token always has to be decoded for its embedding
+        n_cached = min(n_cached, len(tokens) - 1)
+        llama_cpp.llama_kv_cache_seq_rm(self.ctx, 0, n_cached, -1)
+        del self.cache_tokens[n_cached:]
+        for start in range(n_cached, len(tokens), self.n_batch):
+            chunk = tokens[start:start + self.n_batch]
+            self.batch.n_tokens = len(chunk)
+            for i, token in enumerate(chunk):
+                self.batch.token[i] = token
+                self.batch.pos[i] = start + i
+                self.batch.n_seq_id[i] = 1
+                self.batch.seq_id[i][0] = 0
+                self.batch.logits[i] = i == len(chunk) - 1
+            rc = llama_cpp.llama_decode(self.ctx, self.batch)
+            if rc != 0:
+                logger.error(f"Failed to decode for embedding, return code {rc}")
+                llama_cpp.llama_kv_cache_seq_rm(self.ctx, 0, start, -1)
+                return None
+            self.cache_tokens.extend(chunk)
+        return np.ctypeslib.as_array(llama_cpp.llama_get_embeddings(self.ctx), shape=(self.n_embd,)).copy()
+
+    def embed(self, texts : List[str], normalize : bool = True) -> np.ndarray:
+        """
+        A (len(texts), n_embd) matrix of embeddings, one row per text (zeros for any text that failed)
+        normalize: If true, each row has unit length, so a dot product is the cosine similarity
+        """
+        result = np.zeros((len(texts), self.n_embd), dtype=np.single)
+        prompts = [self.tokenize(text) for text in texts]
+        with self.lock:
+            last : Optional[List[int]] = None
+            for i in sorted(range(len(texts)), key=lambda i: prompts[i]):
+                if prompts[i] == last:
+                    result[i] = result[previous]
+                    continue
+                vector = self.embed_tokens(prompts[i])
+                if vector is not None:
+                    result[i] = vector
+                last, previous = prompts[i], i
+        if normalize:
+            norms = np.linalg.norm(result, axis=1, keepdims=True)
+            np.divide(result, norms, out=result, where=norms > 0)
+        return result
+
+    def __del__(self):
+        llama_cpp.llama_batch_free(self.batch)
+        llama_cpp.llama_free(self.ctx)
+        model_registry.release(self.model)
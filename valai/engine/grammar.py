@@ -1,15 +1,172 @@
 # valai/engine/grammar.py
 
+from ctypes import c_void_p, pointer
 import llama_cpp
 from llama_cpp import LlamaGrammar
 import logging
+import numpy as np
 import os
+import threading
+from typing import Dict, List, Tuple
+
+from .vocab import Vocabulary
 
 logger = logging.getLogger(__name__)
 
-def load_grammar(grammar_file : str, grammar_path : str, **kwargs) -> LlamaGrammar:
-    """ Load a GBNF grammar from a file, returning a llama_cpp.LlamaGrammar object. """
-    return LlamaGrammar.from_file(os.path.join(grammar_path, grammar_file), verbose=False)
+# Mirrors llama_token_data, so a numpy array of these can be handed to the llama.cpp samplers
+TOKEN_DATA_DTYPE = np.dtype([('id', np.intc), ('logit', np.single), ('p', np.single)], align=True)
+# How many tokens of context forced text is tokenized along with, so it is split the way it would be in place
+FORCED_CONTEXT = 8
+
+def load_grammar(grammar_file : str, grammar_path : str, **kwargs) -> 'CachedGrammar':
+    """ Load a GBNF grammar from a file, parsing it only if it is new or has changed. """
+    return grammar_cache.load(os.path.join(grammar_path, grammar_file))
+
+
+class CachedGrammar(LlamaGrammar):
+    """
+        A LlamaGrammar whose state is copied from a parsed template.  It resets by copying the template
+        again, rather than rebuilding the rules.
+    """
+    def __init__(self, template : LlamaGrammar):
+        # llama_grammar_copy copies the rules, but we hold the template for as long as we use it anyway
+        self.template = template
+        self._grammar_rules = template._grammar_rules
+        self._n_rules = template._n_rules
+        self._start_rule_index = template._start_rule_index
+        self.grammar = llama_cpp.llama_grammar_copy(template.grammar)
+
+    def reset(self):
+        if self.grammar is not None:
+            llama_cpp.llama_grammar_free(self.grammar)
+        self.grammar = llama_cpp.llama_grammar_copy(self.template.grammar)
+
+
+class GrammarCache:
+    """
+        GrammarCache parses each GBNF file once per process, keeping the parsed grammar as a template
+        that is never advanced.  Templates are keyed by path and mtime, so an edited file is parsed again.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.templates : Dict[str, Tuple[int, LlamaGrammar]] = {}
+
+    def template(self, grammar_file : str) -> LlamaGrammar:
+        """The parsed template for a grammar file"""
+        path = os.path.realpath(grammar_file)
+        mtime = os.stat(path).st_mtime_ns
+        with self.lock:
+            entry = self.templates.get(path, None)
+            if entry is None or entry[0] != mtime:
+                logger.debug(f"Parsing grammar {path}")
+                template = LlamaGrammar.from_file(path, verbose=False)
+                if template.grammar is None:
+                    # llama_cpp only builds the grammar state on reset
+                    template.reset()
+                entry = (mtime, template)
+                self.templates[path] = entry
+            return entry[1]
+
+    def load(self, grammar_file : str) -> CachedGrammar:
+        """A fresh grammar for a file, at its start state"""
+        return CachedGrammar(self.template(grammar_file))
+
+    def clear(self):
+        with self.lock:
+            self.templates.clear()
+
+
+grammar_cache = GrammarCache()
+
+
+class GrammarFilter:
+    """
+        GrammarFilter checks a grammar against a handful of candidates at a time, rather than the whole
+        vocabulary; llama_sample_grammar has to decode and match every candidate it is given.  It also
+        finds text the grammar forces, by probing it with the single character tokens: when exactly one
+        character is allowed (and the grammar can't end), that character is forced.  Characters without a
+        token of their own are never probed, so a grammar allowing one of those alongside a single ASCII
+        character loses that option while jumping.
+    """
+    def __init__(self, ctx : c_void_p, vocab : Vocabulary, token_eos : int, size : int = 256):
+        self.ctx = ctx
+        self.model = llama_cpp.llama_get_model(ctx)
+        self.vocab = vocab
+        self.data = np.zeros(size, dtype=TOKEN_DATA_DTYPE)
+        self.candidates = llama_cpp.llama_token_data_array(
+            data=self.data.ctypes.data_as(llama_cpp.llama_token_data_p), size=0, sorted=False)
+        self.candidates_p = pointer(self.candidates)
+        char_ids = vocab.char_ids
+        self.probe_chars = list(char_ids.keys())
+        # EOS goes last, so we know when the grammar could end here
+        self.probe_ids = np.array(list(char_ids.values()) + [token_eos], dtype=np.intc)
+
+    def allowed(self, grammar : c_void_p, ids : np.ndarray) -> np.ndarray:
+        """Which of the given ids the grammar allows next, as a mask"""
+        n = len(ids)
+        if n > len(self.data):
+            self.data = np.zeros(n, dtype=TOKEN_DATA_DTYPE)
+            self.candidates.data = self.data.ctypes.data_as(llama_cpp.llama_token_data_p)
+        data = self.data[:n]
+        data['id'] = ids
+        data['logit'] = 0.0
+        data['p'] = 0.0
+        self.candidates.size = n
+        self.candidates.sorted = False
+        # Rejected candidates are set to -inf, in place and in order
+        llama_cpp.llama_sample_grammar(ctx=self.ctx, candidates=self.candidates_p, grammar=grammar)
+        return np.isfinite(data['logit'])
+
+    def forced_char(self, grammar : c_void_p) -> int:
+        """The probe index of the only character the grammar allows next, or -1"""
+        mask = self.allowed(grammar, self.probe_ids)
+        if mask[-1] or np.count_nonzero(mask) != 1:
+            return -1
+        return int(np.flatnonzero(mask)[0])
+
+    def forced_text(self, grammar : c_void_p, max_chars : int) -> str:
+        """The text the grammar forces from its current state, up to max_chars"""
+        # Checking doesn't change the grammar, so we only need a copy to advance once something is forced
+        i = self.forced_char(grammar) if max_chars > 0 else -1
+        if i < 0:
+            return ''
+        probe = llama_cpp.llama_grammar_copy(grammar)
+        chars = []
+        try:
+            while i >= 0:
+                chars.append(self.probe_chars[i])
+                llama_cpp.llama_grammar_accept_token(ctx=self.ctx, grammar=probe, token=llama_cpp.llama_token(self.probe_ids[i]))
+                i = self.forced_char(probe) if len(chars) < max_chars else -1
+        finally:
+            llama_cpp.llama_grammar_free(probe)
+        # The tokenizer attaches spaces to the word after them, so leave trailing spaces to be sampled
+        return ''.join(chars).rstrip(' ')
+
+    def tokenize(self, text : str) -> List[int]:
+        """Tokenize text with the model's tokenizer, which adds a leading space, without a BOS"""
+        b_text = text.encode('utf-8')
+        tokens = (llama_cpp.llama_token * (len(b_text) + 1))()
+        n_tokens = llama_cpp.llama_tokenize(model=self.model, text=b_text, text_len=len(b_text), tokens=tokens,
+                                            n_max_tokens=tokens._length_, add_bos=False, special=False)
+        return tokens[:max(n_tokens, 0)]
+
+    def forced_tokens(self, grammar : c_void_p, max_tokens : int, context : List[int] = []) -> List[int]:
+        """Tokens for the text the grammar forces after context, up to max_tokens"""
+        if max_tokens <= 0:
+            return []
+        text = self.forced_text(grammar, max_chars=max_tokens)
+        if len(text) == 0:
+            return []
+        # Split the text the way the tokenizer would following our context, by tokenizing the end of the
+        # context with and without it, and keeping the new tokens
+        tail = ''.join(self.vocab.pieces[id] for id in context[-FORCED_CONTEXT:])
+        before = self.tokenize(tail)
+        after = self.tokenize(tail + text)
+        n_before = len(before)
+        if after[:n_before] == before and ''.join(self.vocab.pieces[id] for id in after[n_before:]) == text:
+            return after[n_before:n_before + max_tokens]
+        # The text merged into the last token of the context (or there is no context to speak of)
+        return self.vocab.encode(text)[:max_tokens]
     
 if __name__ == "__main__":
-    grammar = load_grammar()
\ No newline at end of file
+    grammar = load_grammar()
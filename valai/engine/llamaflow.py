@@ -1,16 +1,39 @@
 # valai/engine/llamaflow.py
 
-from ctypes import c_float, c_size_t, c_void_p, c_char, c_int, c_uint8, c_int8, c_int32, pointer, byref
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from ctypes import c_float, c_size_t, c_void_p, c_uint8, pointer, sizeof
 import logging
+import mmap
 import os
 import multiprocessing
-from typing import Any, List, Optional, Dict
+import struct
+import threading
+from typing import Any, AsyncIterator, List, Optional, Dict, Tuple
 import llama_cpp
+import numpy as np
 
+from .checkpoint import Checkpoint, CheckpointStore
+from .embedding import Embedder
+from .grammar import GrammarFilter, TOKEN_DATA_DTYPE
+from .metrics import MetricsRegistry, timed
 from .output import OutputHandler
+from .promptcache import PromptCache
+from .registry import model_registry
+from .sampler import Sampler
+from .sequence import Candidate, FlowSequence, SequenceFork
+from .session import Session
+from .speculative import Drafter, DraftModel, PromptLookup, SpeculationStats
+from .statefile import StateHeader, model_fingerprint
+from .stream import TokenStream
+from .writer import StateWriter
 
 logger = logging.getLogger(__name__)
 
+# The llama state starts with the rng, followed by the logits capacity and size (size_t), and the logits
+STATE_LOGITS_OFFSET = sizeof(c_size_t) + llama_cpp.LLAMA_MAX_RNG_STATE
+STATE_LOGITS_HEADER = struct.Struct('@NN')
+
 class EngineException(Exception):
     """An exception for errors in the FlowEngine class"""
     def __init__(self, message, tokens):
@@ -43,13 +66,13 @@ void llama_batch_add(
 def llama_batch_clear(batch : llama_cpp.llama_batch):
     batch.n_tokens = 0
 
-def llama_batch_add(batch : llama_cpp.llama_batch, id : int, pos : int, seq_ids : list[int], logits : int):
-    batch.token[batch.n_tokens] = c_int32(id)
-    batch.pos[batch.n_tokens] = c_int32(pos)
-    batch.n_seq_id[batch.n_tokens] = c_int32(len(seq_ids))
-    #for i in range(len(seq_ids)):
-    #    batch.seq_id[batch.n_tokens][i] = c_int32(seq_ids[i])
-    #batch.logits[batch.n_tokens] = c_int8(logits)
+def llama_batch_add(batch : llama_cpp.llama_batch, id : int, pos : int, seq_ids : list[int], logits : bool):
+    batch.token[batch.n_tokens] = id
+    batch.pos[batch.n_tokens] = pos
+    batch.n_seq_id[batch.n_tokens] = len(seq_ids)
+    for i in range(len(seq_ids)):
+        batch.seq_id[batch.n_tokens][i] = seq_ids[i]
+    batch.logits[batch.n_tokens] = logits
 
     batch.n_tokens += 1
 
@@ -118,98 +141,482 @@ class FlowEngine:
         return cparams
 
     @classmethod
-    def from_config(cls, model_path : str, model_file : str, n_ctx : int, output : Optional[OutputHandler] = None, **kwargs):
-        """Create a new FlowEngine with the given parameters"""
-        llama_cpp.llama_backend_init(numa=False)
-
+    def from_config(cls, model_path : str, model_file : str, n_ctx : int, n_seq_max : int = 8, context_shift : bool = False,
+                    prompt_cache : bool = False, draft_model_file : Optional[str] = None, prompt_lookup : bool = False,
+                    n_draft : int = 5, output : Optional[OutputHandler] = None, session : Optional[Session] = None, **kwargs):
+        """
+        Create a new FlowEngine with the given parameters, sharing the model with any other engines using it
+        draft_model_file: A smaller model with the same vocabulary, to draft tokens for speculative decoding
+        prompt_lookup: Without a draft model, draft tokens by matching n-grams from the sequence itself
+        session: Where our context and checkpoint files go (by default, from session_id and session_path)
+        """
+        session = session or Session.from_config(**kwargs)
         model_loc = os.path.join(model_path, model_file)
 
         mparams = cls.get_mparams(**kwargs)
 
-        model = llama_cpp.llama_load_model_from_file(model_loc.encode('utf-8'), mparams)
+        model = model_registry.acquire(model_loc, mparams)
 
         cparams = cls.get_cparams(n_ctx=n_ctx, **kwargs)
 
         ctx = llama_cpp.llama_new_context_with_model(model, cparams)
-        return cls(model=model, ctx=ctx, n_ctx=n_ctx, output=output)
+        checkpoints = CheckpointStore.from_config(**{'checkpoint_path': session.path, **kwargs})
+        cache = PromptCache.from_config(model=model, n_ctx=n_ctx, **kwargs) if prompt_cache else None
+        sampler = Sampler.from_config(**kwargs)
+        drafter = None
+        if draft_model_file is not None:
+            draft = cls.from_config(model_path=model_path, model_file=draft_model_file, n_ctx=n_ctx, n_seq_max=1,
+                                    session=session, **kwargs)
+            if draft.n_vocab != llama_cpp.llama_n_vocab(model):
+                logger.warning(f"Draft model {draft_model_file} does not share our vocabulary, not speculating")
+            else:
+                drafter = DraftModel(draft)
+        elif prompt_lookup:
+            drafter = PromptLookup()
+        metrics = MetricsRegistry.from_config(**kwargs)
+        return cls(model=model, ctx=ctx, n_ctx=n_ctx, n_batch=cparams.n_batch, n_seq_max=n_seq_max,
+                   context_shift=context_shift, checkpoints=checkpoints, prompt_cache=cache, sampler=sampler,
+                   drafter=drafter, n_draft=n_draft, output=output, session=session, metrics=metrics)
     
-    def __init__(self, model : c_void_p, ctx : c_void_p, n_ctx : int, output : Optional[OutputHandler] = None):
+    def __init__(self, model : c_void_p, ctx : c_void_p, n_ctx : int, n_batch : int = 512, n_seq_max : int = 8,
+                 context_shift : bool = False, checkpoints : Optional[CheckpointStore] = None,
+                 prompt_cache : Optional[PromptCache] = None, sampler : Optional[Sampler] = None,
+                 drafter : Optional[Drafter] = None, n_draft : int = 5, output : Optional[OutputHandler] = None,
+                 session : Optional[Session] = None, metrics : Optional[MetricsRegistry] = None):
         self.model = model
+        self.session = session or Session()
+        # Token counts and phase timings, which cost (nearly) nothing unless enabled
+        self.metrics = metrics or MetricsRegistry()
         self.output = output
         self.ctx : llama_cpp.llama_context_p = ctx
         self.n_ctx = n_ctx
-        self.n_past = 0
-        self.n_prev =  0
+        self.n_batch = min(n_ctx, n_batch)
+        self.n_seq_max = n_seq_max
+        # When our context is full, slide the unpinned history instead of raising an EngineException
+        self.context_shift = context_shift
+        # One batch for the life of the engine; llama_decode only reads the first n_tokens entries
+        self.batch = llama_cpp.llama_batch_init(self.n_batch, 0, self.n_seq_max)
         self.last_n_size = 64
-        self.last_n_tokens_data = [0] * self.last_n_size
-        self.session_tokens: List[llama_cpp.llama_token] = []
+        # Each sequence is a llama.cpp seq_id in our shared KV cache.  The engine level n_past,
+        # session_tokens, etc. all refer to the current sequence.
+        self.sequences : Dict[str, FlowSequence] = {}
+        self.logits_owner : Optional[FlowSequence] = None
+        # Alternatives from our last read_candidates, best first, and the sequence they continue
+        self.alternatives : List[Candidate] = []
+        self.alternatives_source : Optional[str] = None
+        self.sequence = self.add_sequence('default')
+        self.checkpoints = checkpoints or CheckpointStore()
+        # Prompt prefixes we have decoded before, persisted across runs
+        self.prompt_cache = prompt_cache
+        self.metrics.collect('checkpoint', self.checkpoints.stats.snapshot)
+        if prompt_cache is not None:
+            self.metrics.collect('prompt_cache', prompt_cache.store.stats.snapshot)
+        # Our sampler is shared by every sequence; each sequence keeps its own recent tokens
+        self.sampler = sampler or Sampler()
+        # Proposes tokens for read to verify in one batch, and how that went on the last read
+        self.drafter = drafter
+        self.n_draft = n_draft
+        self.speculation = SpeculationStats()
+        # Streams decode on a single worker thread of our own, created on first use
+        self.worker : Optional[ThreadPoolExecutor] = None
+        # Our embedding context, created on first use
+        self.embedder : Optional[Embedder] = None
+        self.state_mem = None
+        # Saves are copied into one of its buffers, and written to disk in the background
+        self.writer = StateWriter()
         self.systems : Dict[str, str] = {}
         self.n_system : Dict[str, int] = {}
         self.system_tokens : Dict[str, List[llama_cpp.llama_token]] = {}
         self.current_system : Optional[str] = None
 
+        # Our candidate buffer is allocated once, and refilled from the logits on every sample
+        self.n_vocab = llama_cpp.llama_n_vocab(self.model)
+        self.candidates_ids = np.arange(self.n_vocab, dtype=np.intc)
+        self.candidates_data = np.zeros(self.n_vocab, dtype=TOKEN_DATA_DTYPE)
+        self.candidates = llama_cpp.llama_token_data_array(
+            data=self.candidates_data.ctypes.data_as(llama_cpp.llama_token_data_p),
+            size=self.n_vocab, sorted=False)
+        self.candidates_p = pointer(self.candidates)
+        # The numpy sampler works on a contiguous copy of the logits, rather than the candidate records
+        self.logits_buf = np.zeros(self.n_vocab, dtype=np.single)
+        # Every token piece, so we never decode pieces while sampling
+        self.vocab = model_registry.vocabulary(self.model)
+        self.token_eos = llama_cpp.llama_token_eos(self.ctx)
+        self.grammar_filter = GrammarFilter(self.ctx, self.vocab, self.token_eos)
+        # Our logits buffer starts out at n_vocab, and only grows; the state size grows with it
+        self.state_base = llama_cpp.llama_get_state_size(self.ctx) - self.n_vocab * sizeof(c_float)
+        # Identifies our model in the state files we save
+        self.model_hash = model_fingerprint(self.model)
+
     def set_output_handler(self, output : OutputHandler):
         self.output = output
+
+    @property
+    def n_past(self) -> int:
+        return self.sequence.n_past
+
+    @n_past.setter
+    def n_past(self, value : int):
+        self.sequence.n_past = value
+
+    @property
+    def n_prev(self) -> int:
+        return self.sequence.n_prev
+
+    @n_prev.setter
+    def n_prev(self, value : int):
+        self.sequence.n_prev = value
+
+    @property
+    def session_tokens(self) -> List[int]:
+        return self.sequence.session_tokens
+
+    @session_tokens.setter
+    def session_tokens(self, value : List[int]):
+        self.sequence.session_tokens = value
+
+    @property
+    def prev_tokens(self) -> List[int]:
+        return self.sequence.prev_tokens
+
+    @prev_tokens.setter
+    def prev_tokens(self, value : List[int]):
+        self.sequence.prev_tokens = value
+
+    @property
+    def last_n_tokens_data(self) -> List[int]:
+        return self.sequence.last_n_tokens_data
+
+    @last_n_tokens_data.setter
+    def last_n_tokens_data(self, value : List[int]):
+        self.sequence.last_n_tokens_data = value
+
+    @property
+    def n_used(self) -> int:
+        """The number of KV cells used across all of our sequences (shared prefixes are counted per sequence)"""
+        return sum(seq.n_past for seq in self.sequences.values())
+
+    def get_sequence(self, sequence : Optional[str] = None) -> FlowSequence:
+        """Get a sequence by name, or the current sequence"""
+        if sequence is None:
+            return self.sequence
+        if sequence not in self.sequences:
+            raise ValueError(f"Unknown sequence {sequence}: {','.join(self.sequences.keys())}")
+        return self.sequences[sequence]
+
+    def add_sequence(self, sequence : str) -> FlowSequence:
+        """Create a new empty sequence on the next free llama.cpp seq_id"""
+        if sequence in self.sequences:
+            return self.sequences[sequence]
+        used = set(seq.seq_id for seq in self.sequences.values())
+        free = [i for i in range(self.n_seq_max) if i not in used]
+        if len(free) == 0:
+            raise ValueError(f"No free sequence ids ({self.n_seq_max} in use)")
+        seq = FlowSequence(name=sequence, seq_id=free[0], last_n_size=self.last_n_size)
+        llama_cpp.llama_kv_cache_seq_rm(self.ctx, seq.seq_id, -1, -1)
+        self.sequences[sequence] = seq
+        logger.debug(f"Added sequence {seq}")
+        return seq
+
+    def use_sequence(self, sequence : str, create : bool = True) -> FlowSequence:
+        """Make the given sequence current, so the engine level calls operate on it"""
+        if create and sequence not in self.sequences:
+            self.add_sequence(sequence)
+        self.sequence = self.get_sequence(sequence)
+        return self.sequence
+
+    def drop_sequence(self, sequence : str):
+        """Remove a sequence and free its KV cells"""
+        seq = self.get_sequence(sequence)
+        if seq is self.sequence:
+            raise ValueError(f"Can not drop the current sequence {sequence}")
+        llama_cpp.llama_kv_cache_seq_rm(self.ctx, seq.seq_id, -1, -1)
+        if self.logits_owner is seq:
+            self.logits_owner = None
+        del self.sequences[sequence]
+
+    def truncate_sequence(self, n_keep : int, sequence : Optional[str] = None):
+        """Roll a sequence back to its first n_keep tokens"""
+        seq = self.get_sequence(sequence)
+        llama_cpp.llama_kv_cache_seq_rm(self.ctx, seq.seq_id, n_keep, -1)
+        seq.truncate(n_keep)
+
+    def pin(self, n_keep : Optional[int] = None, sequence : Optional[str] = None) -> int:
+        """Pin the first n_keep tokens (default, everything so far) so a context shift never discards them"""
+        seq = self.get_sequence(sequence)
+        seq.n_keep = seq.n_past if n_keep is None else min(n_keep, seq.n_past)
+        logger.debug(f"Pinned {seq.n_keep} tokens of {seq.name}")
+        return seq.n_keep
+
+    def shift_context(self, n_discard : int, sequence : Optional[str] = None) -> int:
+        """Drop the oldest n_discard unpinned tokens from the KV cache, sliding the rest back into place"""
+        seq = self.get_sequence(sequence)
+        n_discard = min(n_discard, seq.n_past - seq.n_keep)
+        if n_discard <= 0:
+            return 0
+        start, end = seq.n_keep, seq.n_keep + n_discard
+        logger.debug(f"Shifting context of {seq.name}: discarding {start} to {end} of {seq.n_past}")
+        llama_cpp.llama_kv_cache_seq_rm(self.ctx, seq.seq_id, seq.n_past, -1)
+        llama_cpp.llama_kv_cache_seq_rm(self.ctx, seq.seq_id, start, end)
+        llama_cpp.llama_kv_cache_seq_shift(self.ctx, seq.seq_id, end, seq.n_past, -n_discard)
+        seq.discard(start, n_discard)
+        return n_discard
+
+    def copy_sequence(self, source : str, target : str) -> FlowSequence:
+        """Copy a sequence; the KV cells are shared, not duplicated"""
+        src = self.get_sequence(source)
+        dst = self.add_sequence(target)
+        if dst is src:
+            return dst
+        llama_cpp.llama_kv_cache_seq_rm(self.ctx, dst.seq_id, -1, -1)
+        llama_cpp.llama_kv_cache_seq_cp(self.ctx, src.seq_id, dst.seq_id, 0, src.n_past)
+        dst.copy_from(src)
+        if self.logits_owner is src:
+            dst.logits = self.current_logits(src).copy()
+        elif self.logits_owner is dst:
+            self.logits_owner = None
+        return dst
     
-    def load_context(self, save_file : str, **kwargs) -> int:
-        if not os.path.exists(save_file):
+    def fork(self, name : str = 'turn', sequence : Optional[str] = None) -> SequenceFork:
+        """Mark where a sequence is now, so we can roll back to it without saving any state"""
+        seq = self.get_sequence(sequence)
+        logits = None
+        if not seq.needs_logits and (seq.logits is not None or self.logits_owner is seq):
+            logits = self.current_logits(seq).copy()
+        fork = SequenceFork(name=name, n_past=seq.n_past, n_prev=seq.n_prev, n_keep=seq.n_keep, logits=logits)
+        seq.forks[name] = fork
+        logger.debug(f"Forked {seq.name} at {fork}")
+        return fork
+
+    def rollback(self, name : str = 'turn', sequence : Optional[str] = None) -> int:
+        """
+        Roll a sequence back to a fork, returning the number of tokens dropped, or -1 if we have no such fork.
+        The KV cells after the fork are left for the next feed to reuse or replace, like any rewind.
+        """
+        seq = self.get_sequence(sequence)
+        fork = seq.forks.get(name, None)
+        if fork is None:
+            return -1
+        n_dropped = seq.n_past - fork.n_past
+        seq.rewind(fork.n_past)
+        seq.n_prev = fork.n_prev
+        seq.prev_tokens = seq.session_tokens[:fork.n_prev]
+        seq.n_keep = fork.n_keep
+        if fork.logits is not None:
+            seq.logits = fork.logits.copy()
+            seq.needs_logits = False
+        logger.debug(f"Rolled {seq.name} back {n_dropped} tokens to {fork}")
+        return n_dropped
+
+    @timed('load_context')
+    def load_context(self, save_file : Optional[str] = None, **kwargs) -> int:
+        """
+        Load a state file saved by save_context, which the current sequence takes the tokens of.  The file is
+        mapped rather than read, and checked against our model and context size before it is used.
+        """
+        save_file = save_file or self.session.filename('game.context.dat')
+        # Our last save of this file may still be on its way to disk
+        self.writer.flush(save_file)
+        if not os.path.exists(save_file) or os.path.getsize(save_file) == 0:
             logger.info(f"Error: {save_file} does not exist")
             return -1
 
-        # Load state from file
-        state_size = llama_cpp.llama_get_state_size(self.ctx)
-        logger.debug(f"Context: State size: {state_size}")
-        state_mem = (c_uint8 * state_size)()
-
-        with open(save_file, "rb") as fp_read:
-            bytes_read = fp_read.readinto(state_mem)
-            logger.debug(f"Context: Read {bytes_read} {state_size} bytes from {save_file}")
-            if bytes_read != state_size:
-                logger.error("Error: failed to read state")
-                return -1
+        with open(save_file, "rb") as fp_read, mmap.mmap(fp_read.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            data = memoryview(mapped)
+            try:
+                header = StateHeader.unpack(data)
+                if header is None:
+                    logger.error(f"Error: {save_file} is not a state file")
+                    return -1
+                ok, reason = header.check(self.model_hash, self.n_ctx)
+                if not ok:
+                    logger.error(f"Error: can not load {save_file}, {reason}")
+                    return -1
+                logger.debug(f"Context: Loading {header} ({len(data)} bytes) from {save_file}")
+                state_mem = self.unpack_state(data[header.size:])
+            finally:
+                data.release()
 
         rc = llama_cpp.llama_set_state_data(self.ctx, state_mem)
-
+        self.reset_sequences(header.tokens)
         return rc
 
-    def save_context(self, save_file : str = 'local/game.context.dat', **kwargs) -> int:
+    @timed('save_context')
+    def save_context(self, save_file : Optional[str] = None, **kwargs) -> int:
+        """
+        Copy our state into a buffer, which is written to save_file in the background.  Only the KV rows in use
+        are saved, without the logits, after a header with our model, context size and tokens.
+        """
         if len(self.session_tokens) > 0:
+            save_file = save_file or self.session.filename('game.context.dat')
             state_size = llama_cpp.llama_get_state_size(self.ctx)
-            state_mem = (c_uint8 * state_size)()
+            state_mem = self.writer.buffer(state_size)
 
             rc = llama_cpp.llama_copy_state_data(self.ctx, state_mem)
-            if rc < 0:
+            if rc <= 0:
                 logger.error("Failed to copy state data")
-                return rc
-
-            # Save the data to a binary file
-            with open(save_file, "wb") as fp:
-                fp.write(state_mem)
-        
-            llama_cpp.llama_set_state_data(self.ctx, state_mem)
+                self.writer.release(state_mem)
+                return -1
 
+            header = StateHeader(model_hash=self.model_hash, n_ctx=self.n_ctx, n_past=self.n_past,
+                                 tokens=self.session_tokens.copy())
+            head, tail = self.split_state(memoryview(state_mem).cast('B')[:rc])
+            self.writer.submit(save_file, state_mem, [header.pack(), head, STATE_LOGITS_HEADER.pack(0, 0), tail])
             return rc
         return 0
     
-    def clear_saved_context(self, save_file : str = 'local/game.context.dat', **kwargs) -> int:
-        """Delete our file"""
+    def clear_saved_context(self, save_file : Optional[str] = None, checkpoint : str = 'game', **kwargs) -> int:
+        """Delete our file, and our checkpoint"""
+        save_file = save_file or self.session.filename('game.context.dat')
+        self.writer.flush(save_file)
+        removed = self.checkpoints.discard(checkpoint)
         if os.path.exists(save_file):
             os.remove(save_file)
+            removed = True
+        return 0 if removed else 1
+
+    def logits_capacity(self) -> int:
+        """The capacity of the llama logits buffer, which is written into (and checked against) our state"""
+        return (llama_cpp.llama_get_state_size(self.ctx) - self.state_base) // sizeof(c_float)
+
+    def scratch_state(self) -> Any:
+        """Get a scratch buffer large enough for our llama state"""
+        state_size = llama_cpp.llama_get_state_size(self.ctx)
+        if self.state_mem is None or len(self.state_mem) < state_size:
+            # The state only grows with our logits buffer, so we can reuse this until it does
+            self.state_mem = (c_uint8 * state_size)()
+        return self.state_mem
+
+    def split_state(self, state : memoryview) -> Tuple[memoryview, memoryview]:
+        """The parts of a llama state before and after its logits (and their header)"""
+        capacity, _ = STATE_LOGITS_HEADER.unpack_from(state, STATE_LOGITS_OFFSET)
+        tail = STATE_LOGITS_OFFSET + STATE_LOGITS_HEADER.size + capacity * sizeof(c_float)
+        return state[:STATE_LOGITS_OFFSET], state[tail:]
+
+    def pack_state(self, state : memoryview) -> bytearray:
+        """
+        Copy a llama state without its logits.  Restoring always decodes the last token again, and the logits
+        capacity depends on the largest batch a context has decoded, so it would not restore into a fresh one.
+        """
+        head, tail = self.split_state(state)
+        packed = bytearray(len(head) + STATE_LOGITS_HEADER.size + len(tail))
+        packed[:STATE_LOGITS_OFFSET] = head
+        STATE_LOGITS_HEADER.pack_into(packed, STATE_LOGITS_OFFSET, 0, 0)
+        packed[STATE_LOGITS_OFFSET + STATE_LOGITS_HEADER.size:] = tail
+        return packed
+
+    def unpack_state(self, packed : bytearray) -> Any:
+        """Expand a packed state into our scratch buffer, with the logits capacity of our context"""
+        capacity = self.logits_capacity()
+        state_mem = self.scratch_state()
+        state = memoryview(state_mem).cast('B')
+        tail = STATE_LOGITS_OFFSET + STATE_LOGITS_HEADER.size + capacity * sizeof(c_float)
+        state[:STATE_LOGITS_OFFSET] = packed[:STATE_LOGITS_OFFSET]
+        STATE_LOGITS_HEADER.pack_into(state, STATE_LOGITS_OFFSET, capacity, 0)
+        state[tail:tail + len(packed) - STATE_LOGITS_OFFSET - STATE_LOGITS_HEADER.size] = \
+            packed[STATE_LOGITS_OFFSET + STATE_LOGITS_HEADER.size:]
+        return state_mem
+
+    @timed('checkpoint_save')
+    def snapshot(self, name : str) -> Optional[Checkpoint]:
+        """Copy the llama state into a new checkpoint for the current sequence"""
+        state_mem = self.scratch_state()
+        rc = llama_cpp.llama_copy_state_data(self.ctx, state_mem)
+        if rc <= 0:
+            logger.error("Failed to copy state data")
+            return None
+        state = self.pack_state(memoryview(state_mem)[:rc])
+        return Checkpoint(name=name, state=state, n_past=self.n_past, tokens=self.session_tokens.copy())
+
+    @timed('checkpoint_restore')
+    def restore(self, checkpoint : Checkpoint) -> int:
+        """
+        Restore the llama state from a checkpoint.  The KV cache for every sequence is restored, but only
+        the current sequence takes on the checkpoint tokens.  If the current sequence already has the
+        checkpoint tokens cached, we just rewind to them instead.
+        """
+        seq = self.sequence
+        n_tokens = len(checkpoint.tokens)
+        if n_tokens <= len(seq.cache_tokens) and seq.cache_tokens[:n_tokens] == checkpoint.tokens:
+            if n_tokens <= seq.n_past:
+                logger.debug(f"Rewinding to cached {checkpoint}")
+                seq.rewind(n_tokens)
+            else:
+                # Our session is a prefix of the cache (after a reset, say), so we move forward over the rest
+                logger.debug(f"Advancing to cached {checkpoint}")
+                seq.accept(seq.cache_tokens[seq.n_past:n_tokens], cached=True)
+            return checkpoint.size
+
+        state_mem = self.unpack_state(checkpoint.state)
+        rc = llama_cpp.llama_set_state_data(self.ctx, state_mem)
+        self.reset_sequences(checkpoint.tokens)
+        return rc
+
+    def reset_sequences(self, tokens : List[int]):
+        """
+        After the whole llama state has been replaced, the current sequence takes on the tokens it was saved
+        with.  The cells of every other sequence now hold whatever they held when the state was saved, so they
+        are freed, and the sequences emptied.
+        """
+        self.drop_candidates()
+        for seq in self.sequences.values():
+            if seq is not self.sequence:
+                llama_cpp.llama_kv_cache_seq_rm(self.ctx, seq.seq_id, -1, -1)
+                seq.reset()
+        # The restored state has no logits
+        self.logits_owner = None
+        self.sequence.truncate(0)
+        self.sequence.accept(tokens)
+
+    def load_prompt_cache(self, tokens : List[int], sequence : Optional[str] = None) -> int:
+        """
+        Restore the longest cached prefix of our session plus tokens, if it is longer than what our KV cache
+        already holds.  Restoring replaces the whole llama state, so this only applies when the current
+        sequence is the only one in use.  Returns the number of tokens that were restored.
+        """
+        seq = self.get_sequence(sequence)
+        if self.prompt_cache is None or seq is not self.sequence:
             return 0
-        return 1
+        if any(other.n_past > 0 for other in self.sequences.values() if other is not seq):
+            return 0
+        n_cached = seq.n_past + seq.cached_prefix(tokens)
+        checkpoint = self.prompt_cache.lookup(seq.session_tokens + tokens, n_min=n_cached + 1)
+        if checkpoint is None:
+            return 0
+        n_past, n_prev, n_keep = seq.n_past, seq.n_prev, seq.n_keep
+        rc = self.restore(checkpoint)
+        if rc < 0:
+            logger.error(f"Failed to restore prompt cache {checkpoint}")
+            return 0
+        # The checkpoint tokens are now cached, and our feed will skip over them
+        seq.rewind(n_past)
+        seq.n_prev, seq.n_keep = n_prev, n_keep
+        seq.prev_tokens = seq.session_tokens[:n_prev]
+        logger.info(f"Restored {checkpoint.n_past - n_cached} tokens from the prompt cache")
+        return checkpoint.n_past - n_cached
+
+    def save_prompt_cache(self, sequence : Optional[str] = None) -> bool:
+        """Write the current state to the prompt cache, keyed on our session tokens"""
+        seq = self.get_sequence(sequence)
+        if self.prompt_cache is None or seq is not self.sequence or seq.n_past == 0:
+            return False
+        if self.prompt_cache.contains(seq.session_tokens):
+            return True
+        snapshot = self.snapshot(name='prompt')
+        if snapshot is None:
+            return False
+        self.prompt_cache.put(snapshot)
+        return True
 
     def token_clearance(self, new_tokens : int = 0, padding : int = 0, **kwargs) -> int:
         """Get the number of tokens remaining"""
-        result = self.n_ctx - self.n_past - new_tokens - padding
-        logger.debug(f"Token Clearance: {self.n_ctx} - {self.n_past} - {new_tokens} - {padding} = {result}")
+        result = self.n_ctx - self.n_used - new_tokens - padding
+        logger.debug(f"Token Clearance: {self.n_ctx} - {self.n_used} - {new_tokens} - {padding} = {result}")
         return result
 
     def reset(self, system : bool = True, **kwargs):
-        self.last_n_tokens_data = [0] * self.last_n_size
-        self.session_tokens = []
-        self.prev_tokens = []
-        self.n_past = 0
-        self.n_prev = 0
+        # Our KV cache is left in place, so a following feed can reuse any matching prefix
+        self.sequence.rewind(0)
         if system:
             self.n_system = {}
             self.system_tokens = {}
@@ -218,27 +625,47 @@ class FlowEngine:
         
     def set_checkpoint(self, checkpoint : str, **kwargs) -> bool:
         """Set a checkpoint for the current state"""
-        return self.save_context(save_file=f"local/{checkpoint}.context.dat", **kwargs)
-
-    def execute(self, prompt : str, retry : bool = False, scope : Optional[str] = None, checkpoint : Optional[str] = None, **kwargs) -> int:
-        """Execute the given prompt with the model"""
+        snapshot = self.snapshot(name=str(checkpoint))
+        if snapshot is None:
+            return False
+        self.checkpoints.put(snapshot)
+        return True
+
+    def save_checkpoint(self, checkpoint : str, **kwargs) -> bool:
+        """Write a checkpoint through to disk"""
+        return self.checkpoints.save(str(checkpoint))
+
+    def execute(self, prompt : str, retry : bool = False, scope : Optional[str] = None, checkpoint : Optional[str] = None,
+                cache_prompt : bool = False, **kwargs) -> int:
+        """
+        Execute the given prompt with the model
+        cache_prompt: If true, restore the prompt from (and save it to) our prompt cache
+        """
 
+        # Any candidates continue the state we are about to move on from
+        self.drop_candidates()
         self.prev_tokens = self.session_tokens.copy()
         self.n_prev = self.n_past
         if checkpoint is not None:
-            self.set_checkpoint(checkpoint=checkpoint, **kwargs)
+            self.fork(name=str(checkpoint))
 
-        rc = self.feed(prompt=prompt, scope=scope, **kwargs)
+        rc = self.feed(prompt=prompt, scope=scope, cache_prompt=cache_prompt, **kwargs)
         return rc
 
     def reload_turn(self, checkpoint : str = 'turn', **kwargs) -> int:
-        """Reset our turn data"""
-        rc = self.load_context(save_file=f"local/{checkpoint}.context.dat", **kwargs)
+        """Reset our turn data, rolling back to the fork from execute, or else restoring a saved checkpoint"""
+        if self.rollback(str(checkpoint)) >= 0:
+            logger.info(f"Rolled back to {checkpoint}")
+            self.prev_tokens = self.session_tokens.copy()
+            self.n_prev = self.n_past
+            return 0
+        snapshot = self.checkpoints.get(str(checkpoint))
+        if snapshot is None:
+            logger.info(f"Error: no {checkpoint} checkpoint")
+            return -1
+        rc = self.restore(snapshot)
         if rc >= 0:
             logger.info(f"Using previous {checkpoint} context")
-            self.session_tokens = self.system_tokens.get(checkpoint, []).copy()
-            self.n_past = self.n_system.get(checkpoint, 0)
-
             self.prev_tokens = self.session_tokens.copy()
             self.n_prev = self.n_past
         return rc
@@ -247,6 +674,7 @@ class FlowEngine:
         self.systems[system_context] = prompt
         logger.debug(f"Set system {system_context}")
 
+    @timed('prepare')
     def prepare(self, system_context : str, restart : bool = True, **kwargs) -> int:
         """
         Execute the given system prompt
@@ -265,36 +693,31 @@ class FlowEngine:
         if restart:
             self.reset(system=False, **kwargs)
             if len(system) > 0:
-                rc = self.feed(prompt=system, scope=system_context, show_progress=True, **kwargs)
+                rc = self.feed(prompt=system, scope=system_context, show_progress=True, cache_prompt=True, **kwargs)
                 if rc < 0:
                     logger.error("Failed to feed system prompt")
                     return rc
                 self.n_system[system_context] = self.n_past
                 self.system_tokens[system_context] = self.session_tokens.copy()
-            rc = self.save_context(**kwargs)
-            if rc < 0:
+            if not self.set_checkpoint('game', **kwargs):
                 logger.error("Failed to save our context")
-                return rc
+                return -1
+            rc = 0
         else:
             # Load our saved system
-            rc = self.load_context(save_file=f"local/game.context.dat", **kwargs)
-            if rc < 0:
+            snapshot = self.checkpoints.get('game')
+            if snapshot is None:
                 logger.error("Failed to load our context")
-                return rc
-            self.n_past = self.n_system.get(system_context, 0)
-            self.session_tokens = self.system_tokens.get(system_context, []).copy()
+                return -1
+            rc = self.restore(snapshot)
 
         self.prev_tokens = self.session_tokens.copy()
         self.n_prev = self.n_past
         self.current_system = system_context
         return rc
 
-    def feed(self, prompt : str, n_batch : int, n_ctx : int, scope : Optional[str] = None, show_progress : bool = False, **kwargs) -> int:
-        """Feed the given prompt to the model"""
-        if prompt is None:
-            logger.warning(f"Feeding empty prompt")
-            return -1
-        kwargs['n_ctx'] = n_ctx
+    def tokenize(self, prompt : str) -> List[int]:
+        """Tokenize a prompt the way feed does"""
         b_prompt = prompt.encode('ascii', 'ignore')
         b_prompt = b" " + b_prompt
         pl = len(b_prompt)
@@ -305,9 +728,28 @@ class FlowEngine:
             model=self.model, text=b_prompt, text_len=pl, tokens=embd_inp, n_max_tokens=embd_inp._length_,
             add_bos=True, special=False)
 
-        embd_inp = embd_inp[:n_of_tok]
+        return embd_inp[:n_of_tok]
+
+    @timed('prefill')
+    def feed(self, prompt : str, n_batch : int, n_ctx : int, scope : Optional[str] = None, show_progress : bool = False,
+             sequence : Optional[str] = None, cache_prompt : bool = False, **kwargs) -> int:
+        """
+        Feed the given prompt to the model
+        cache_prompt: If true, restore the longest prefix we have in our prompt cache, and cache the result
+        """
+        seq = self.get_sequence(sequence)
+        if prompt is None:
+            logger.warning(f"Feeding empty prompt")
+            return -1
+        kwargs['n_ctx'] = n_ctx
+        embd_inp = self.tokenize(prompt)
+        n_of_tok = len(embd_inp)
 
         clearance = self.token_clearance(n_of_tok, 100)
+        if clearance < 0 and self.context_shift and -clearance <= seq.n_past - seq.n_keep:
+            # Discard at least half of our history, so we aren't shifting again on the next turn
+            self.shift_context(max(-clearance, (seq.n_past - seq.n_keep) // 2), sequence=seq.name)
+            clearance = self.token_clearance(n_of_tok, 100)
         if clearance < 0:
             raise EngineException("Too many tokens in prompt", clearance)
 
@@ -317,168 +759,234 @@ class FlowEngine:
         n_ctx_floor = n_ctx_floor if n_of_tok > n_ctx_floor else n_of_tok
         embd_inp = embd_inp[-n_ctx_floor:]
 
-        input_consumed = 0
+        if cache_prompt:
+            self.load_prompt_cache(embd_inp, sequence=seq.name)
 
-        first_n = self.n_past
-        logger.debug(f"Feeding ({pl} chars -> {n_of_tok} tokens), {input_consumed} consumed, {len(embd_inp)} remaining")
+        # Skip over whatever is already in our KV cache; if that is everything, the logits are decoded on demand
+        input_consumed = seq.cached_prefix(embd_inp)
+        if input_consumed > 0:
+            seq.accept(embd_inp[:input_consumed], cached=True)
+        self.metrics.count('prefill_cached_tokens', input_consumed)
+
+        first_n = seq.n_past - input_consumed
+        logger.debug(f"Feeding ({len(prompt)} chars -> {n_of_tok} tokens), {input_consumed} consumed, {len(embd_inp)} remaining")
         logger.debug(f"```{prompt}```")
         if self.output is not None and show_progress:
             if scope is not None:
                 self.output.handle_token(f"{scope} - ")
-            self.output.handle_progress(0.0)
-
-        if True:
-            embd = []
-
-            while len(embd_inp) > input_consumed:
-                while len(embd_inp) > input_consumed:
-                    if len(embd) >= n_batch:
-                        break
-
-                    embd.append(embd_inp[input_consumed])
-                    self.last_n_tokens_data = self.last_n_tokens_data[1:] + [embd_inp[input_consumed]]
-                    input_consumed += 1
-
-                if len(embd) > 0:
-                    # Docs say to use llama_decode and llama_batch
-                    tokens = (llama_cpp.llama_token * len(embd))(*embd)
-                    logger.debug(f"Writing to model {len(embd)} tokens, {input_consumed} consumed")
-                    return_code = llama_cpp.llama_eval(ctx=self.ctx, tokens=tokens, n_tokens=len(embd), n_past=self.n_past)
-                    if return_code != 0:
-                        logger.error(f"Break - Model Eval return code {return_code}")
-                        break
-                    
-                    self.session_tokens += tokens
-                    self.n_past += len(embd)
-                    embd = []
-                    if self.output is not None and show_progress:
-                        self.output.handle_progress(float(input_consumed) / len(embd_inp))
-        else:
-            # TODO this is from the master branch of llama-cpp-python, so beware on 0.2.11
-            embed_size = len(embd_inp)
-            batch_size = min(n_batch, embed_size)
-            llama_batch = llama_cpp.llama_batch_init(c_int32(batch_size), 0, c_int32(1))
-            #llama_batch = llama_cpp.llama_batch_init(c_int32(n_batch), 0, c_int32(n_batch))
-            batch_ix = 0
-
-            while embed_size > input_consumed:
-                while embed_size > input_consumed:
-                    if batch_ix >= batch_size:
-                        break
-
-                    llama_batch_add(batch=llama_batch, id=embd_inp[input_consumed], pos=batch_ix, seq_ids=[], logits=False)
-
-                    self.last_n_tokens_data = self.last_n_tokens_data[1:] + [embd_inp[input_consumed]]
-                    input_consumed += 1
-                    batch_ix += 1
-
-                if batch_ix > 0:
-                    # Docs say to use llama_decode and llama_batch
-                    #tokens = (llama_cpp.llama_token * len(embd))(*embd)
-                    logger.debug(f"Writing to model {batch_ix} tokens")
-                    llama_batch.logits[llama_batch.n_tokens - 1] = True
-                    #return_code = llama_cpp.llama_eval(ctx=self.ctx, tokens=tokens, n_tokens=len(embd), n_past=self.n_past)
-                    rc = llama_cpp.llama_decode(self.ctx, llama_batch)
-                    if rc != 0:
-                        logger.error(f"Break - Model Decode return code {rc}")
-                        break
-                    
-                    self.n_past += llama_batch.n_tokens
-                    self.session_tokens += llama_batch.token[:llama_batch.n_tokens]
-                    batch_ix = 0
-                    llama_batch_clear(llama_batch)
-
-            llama_cpp.llama_batch_free(llama_batch)
+            self.output.handle_progress(float(input_consumed) / len(embd_inp))
+
+        n_batch = min(n_batch, self.n_batch)
+        while len(embd_inp) > input_consumed:
+            embd = embd_inp[input_consumed:input_consumed + n_batch]
+            input_consumed += len(embd)
+            logger.debug(f"Writing to model {len(embd)} tokens, {input_consumed} consumed")
+            # We only need logits for the very last token of the prompt
+            rc = self.decode(embd, logits=input_consumed == len(embd_inp), sequence=seq.name)
+            if rc != 0:
+                logger.error(f"Break - Model Decode return code {rc}")
+                break
+            self.metrics.count('prefill_tokens', len(embd))
+
+            if self.output is not None and show_progress:
+                self.output.handle_progress(float(input_consumed) / len(embd_inp))
+
+        if cache_prompt:
+            self.save_prompt_cache(sequence=seq.name)
+
+        return seq.n_past - first_n
+
+    def decode(self, tokens : List[int], logits : bool = True, sequence : Optional[str] = None,
+               draft : List[int] = []) -> int:
+        """
+        Decode a run of tokens (at most n_batch) at n_past, optionally requesting logits for the last token
+        draft: Tokens to decode after ours, with logits for each of them, but which are not accepted into the sequence
+        """
+        seq = self.get_sequence(sequence)
+        n_tokens = len(tokens)
+        # Anything cached past n_past is stale, as it was with llama_eval
+        llama_cpp.llama_kv_cache_seq_rm(self.ctx, seq.seq_id, seq.n_past, -1)
+        llama_batch_clear(self.batch)
+        for i, token in enumerate(tokens + draft):
+            llama_batch_add(self.batch, token, seq.n_past + i, [seq.seq_id], logits and i >= n_tokens - 1)
+
+        # Decoding overwrites the logits, so keep a copy if they belong to another sequence
+        owner = self.logits_owner
+        if owner is not None and owner is not seq and owner.logits is None:
+            owner.logits = self.current_logits(owner).copy()
+
+        rc = llama_cpp.llama_decode(self.ctx, self.batch)
+        if rc != 0:
+            return rc
 
+        seq.accept(tokens)
+        seq.needs_logits = not logits
+        if logits:
+            seq.logits_ix = n_tokens - 1
+            seq.logits = None
+            self.logits_owner = seq
+        return rc
 
-        return self.n_past - first_n
+    def ensure_logits(self, seq : FlowSequence) -> int:
+        """Decode the last token of a sequence again if its logits were skipped or lost"""
+        if not seq.needs_logits or seq.n_past == 0:
+            return 0
+        last = seq.session_tokens[-1]
+        seq.rewind(seq.n_past - 1)
+        return self.decode([last], sequence=seq.name)
+
+    def current_logits(self, seq : FlowSequence) -> np.ndarray:
+        """The logits from the last token decoded into the given sequence"""
+        if seq.logits is not None:
+            return seq.logits
+        return np.ctypeslib.as_array(llama_cpp.llama_get_logits_ith(self.ctx, seq.logits_ix), shape=(self.n_vocab,))
+
+    def load_logits(self, seq : Optional[FlowSequence] = None) -> np.ndarray:
+        """Copy the current logits into our logits buffer, for the sampler to work on in place"""
+        np.copyto(self.logits_buf, self.current_logits(seq or self.sequence))
+        return self.logits_buf
+
+    def load_candidates(self, seq : Optional[FlowSequence] = None, logits : Optional[np.ndarray] = None) -> Any:
+        """Fill our candidate buffer from the current (or given) logits, returning a pointer for the samplers"""
+        if logits is None:
+            logits = self.current_logits(seq or self.sequence)
+        # The samplers sort and truncate in place, so every field has to be reset
+        self.candidates_data['id'] = self.candidates_ids
+        self.candidates_data['logit'] = logits
+        self.candidates_data['p'] = 0.0
+        self.candidates.size = self.n_vocab
+        self.candidates.sorted = False
+        return self.candidates_p
+
+    def mask_grammar(self, logits : np.ndarray, grammar : c_void_p, n_keep : int) -> bool:
+        """
+        Mask logits to the grammar, checking only the best candidates.  If at least n_keep of them pass, they
+        include the n_keep best tokens the grammar allows, so a top-k (k <= n_keep) sample is unchanged.
+        Returns False, leaving the logits alone, if too few passed.
+        """
+        ids, best = self.sampler.top_k(logits, max(4 * n_keep, 64))
+        mask = self.grammar_filter.allowed(grammar, ids)
+        if np.count_nonzero(mask) < n_keep:
+            return False
+        logits.fill(-np.inf)
+        logits[ids[mask]] = best[mask]
+        return True
 
     def read(self, max_tokens : int = 512, abort_tokens : list = [], stop_tokens : list = [],
               sequence_tokens : list = [], log_chunk_length : int = 25, n_temp: float = 0.7,
               mirostat: int = 0, mirostat_tau : float = 0, mirostat_eta : float = 0, top_k: int = 40,
-              n_tfs_z: float = 0.0, n_typical_p: float = 0.0, n_top_p: float = 0.0,
-              grammar: Optional[llama_cpp.LlamaGrammar] = None,
-                **kwargs) -> Optional[List[Any]]:
-        """Read from the model until the given number of tokens is reached"""
+              n_tfs_z: float = 0.0, n_typical_p: float = 0.0, n_top_p: float = 0.0, n_min_p: float = 0.0,
+              grammar: Optional[llama_cpp.LlamaGrammar] = None, sequence : Optional[str] = None,
+              mask_abort : bool = False, n_draft : Optional[int] = None, jump_forward : bool = True,
+              token_handler : Optional[OutputHandler] = None, cancel : Optional[threading.Event] = None,
+              **kwargs) -> Optional[List[Any]]:
+        """
+        Read from the model until the given number of tokens is reached
+        mask_abort: If true, abort tokens are masked out of the logits instead of aborting the read when sampled
+        n_draft: How many tokens our drafter may propose per decode (0 to disable speculation)
+        jump_forward: If true, text the grammar forces is decoded in one batch, without sampling
+        token_handler: Where our tokens go, instead of our output handler
+        cancel: When set, we stop before the next token
+        """
+        metrics = self.metrics
+        t_read = metrics.now()
+        seq = self.get_sequence(sequence)
+        rc = self.ensure_logits(seq)
+        if rc != 0:
+            logger.error(f"Failed to decode logits, return code {rc}")
+            return []
         remaining_tokens = max_tokens
-        last_n_repeat = 64
-        repeat_penalty = 1.08
-        frequency_penalty = 0.0
-        presence_penalty = 0.0
-        stop_set = set(stop_tokens)
-        abort_set = set(abort_tokens)
-        sequence_set = set([tuple(o) for o in sequence_tokens])
+        matcher = self.vocab.compile(abort_tokens=abort_tokens, stop_tokens=stop_tokens, sequence_tokens=sequence_tokens)
+        decoder = self.vocab.decoder()
 
         response_tokens = []
         n_generated = 0
 
-        buf = (c_char * 32)()
         log_chunks = []
         log_ids = []
-        last_piece = ''
-        last_id = 0
+        last_id = -1
+        # The last token we sampled, which differs from last_id when we swap in a newline for EOS
+        last_token = -1
+
+        # Drafted tokens are decoded along with each sampled token.  Each one we then sample ourselves is
+        # already in the KV cache, with its logits in the same batch, so our output is exactly what we would
+        # have sampled without speculating.
+        n_draft = self.n_draft if n_draft is None else n_draft
+        drafter = self.drafter if n_draft > 0 else None
+        self.speculation = SpeculationStats()
+        pending : List[int] = []
+        n_drafted = 0
+        # Tokens the grammar forces, which lead pending when they are decoded
+        forced : List[int] = []
+        has_grammar = grammar is not None and grammar.grammar is not None
+        output = token_handler or self.output
+        n_texts = 0
 
         try:
             while remaining_tokens > 0:
-                # Mirroring llama.cpp/common/sampling.cpp
-                logits = llama_cpp.llama_get_logits(self.ctx)
-                n_vocab = llama_cpp.llama_n_vocab(self.model)
-
-                _arr = (llama_cpp.llama_token_data * n_vocab)(*[
-                    llama_cpp.llama_token_data(token_id, logits[token_id], 0.0)
-                    for token_id in range(n_vocab)
-                ])
-                candidates_p = pointer(llama_cpp.llama_token_data_array(_arr, len(_arr), False))
-
-                _arr = (c_int * len(self.last_n_tokens_data))(*self.last_n_tokens_data)
-                llama_cpp.llama_sample_repetition_penalties(ctx=self.ctx, candidates=candidates_p, last_tokens_data=_arr, 
-                                            penalty_last_n=c_size_t(last_n_repeat), penalty_repeat=c_float(repeat_penalty),
-                                            penalty_freq=c_float(frequency_penalty), penalty_present=c_float(presence_penalty))
-
-                if grammar is not None and grammar.grammar is not None:
-                    llama_cpp.llama_sample_grammar(ctx=self.ctx, candidates=candidates_p, grammar=grammar.grammar)
-
-                if n_temp < 0.0:
-                    id = llama_cpp.llama_sample_softmax(ctx=self.ctx, candidates=candidates_p)
-                elif n_temp == 0:
-                    # Greedy sampling
-                    id = llama_cpp.llama_sample_token_greedy(self.ctx, candidates_p)
-                elif mirostat == 1:
-                    mirostat_mu = 2.0 * mirostat_tau
-                    mirostat_m = 100
-                    llama_cpp.llama_sample_temperature(ctx=self.ctx, candidates=candidates_p, temp=c_float(n_temp))
-                    id = llama_cpp.llama_sample_token_mirostat(ctx=self.ctx, candidates=candidates_p,
-                        tau=c_float(mirostat_tau), eta=c_float(mirostat_eta), m=c_size_t(mirostat_m), mu=c_float(mirostat_mu))
-                elif mirostat == 2:
-                    mirostat_mu = 2.0 * mirostat_tau
-                    llama_cpp.llama_sample_temperature(ctx=self.ctx, candidates=candidates_p, temp=c_float(n_temp))
-                    id = llama_cpp.llama_sample_token_mirostat_v2(ctx=self.ctx, candidates=candidates_p,
-                        tau=c_float(mirostat_tau), eta=c_float(mirostat_eta), mu=c_float(mirostat_mu))
+                if cancel is not None and cancel.is_set():
+                    logger.debug(f"Break ({len(log_chunks)}): Cancelled")
+                    break
+                if has_grammar and jump_forward and len(forced) == 0:
+                    t_grammar = metrics.now()
+                    forced = self.grammar_filter.forced_tokens(grammar.grammar, min(remaining_tokens, self.n_batch - 1,
+                                                                                    self.token_clearance(1)),
+                                                               context=seq.session_tokens)
+                    metrics.elapsed('grammar', t_grammar)
+                    metrics.count('forced_tokens', len(forced))
+                if len(forced) > 0:
+                    # Forced tokens are decoded along with the first of them, so there is nothing to sample
+                    id = forced.pop(0)
                 else:
-                    # Temperature sampling
-                    min_keep = c_size_t(1)
-                    llama_cpp.llama_sample_top_k(ctx=self.ctx, candidates=candidates_p,
-                                                 k=top_k, min_keep=min_keep)
-                    llama_cpp.llama_sample_tail_free(ctx=self.ctx, candidates=candidates_p,
-                                                     z=c_float(n_tfs_z), min_keep=min_keep)
-                    llama_cpp.llama_sample_typical(ctx=self.ctx, candidates=candidates_p,
-                                                   p=c_float(n_typical_p), min_keep=min_keep)
-                    llama_cpp.llama_sample_top_p(ctx=self.ctx, candidates=candidates_p,
-                                                 p=c_float(n_top_p), min_keep=min_keep)
-                    llama_cpp.llama_sample_min_p(ctx=self.ctx, candidates=candidates_p,
-                                                 p=c_float(n_top_p), min_keep=min_keep)
-                    llama_cpp.llama_sample_temperature(ctx=self.ctx, candidates=candidates_p,
-                                                 temp=c_float(n_temp))
-                    id = llama_cpp.llama_sample_token(self.ctx, candidates_p)
-
-                n = llama_cpp.llama_token_to_piece(
-                    self.model, llama_cpp.llama_token(id), buf, 32
-                )
-                piece = buf[:n].decode('utf-8', 'ignore')
-
-                self.last_n_tokens_data = self.last_n_tokens_data[1:] + [id]
+                    # Mirroring llama.cpp/common/sampling.cpp
+                    t_sample = metrics.now()
+                    logits = self.load_logits(seq)
+                    if mask_abort:
+                        logits += matcher.abort_bias
+
+                    self.sampler.penalize(logits, seq.last_n.tokens())
+
+                    # Greedy and temperature sampling only look at the top k, so the grammar only needs to check those
+                    top_only = n_temp == 0 or (n_temp > 0 and mirostat not in (1, 2))
+                    t_grammar = metrics.now()
+                    if has_grammar and not (top_only and self.mask_grammar(logits, grammar.grammar, 1 if n_temp == 0 else max(top_k, 1))):
+                        candidates_p = self.load_candidates(logits=logits)
+                        llama_cpp.llama_sample_grammar(ctx=self.ctx, candidates=candidates_p, grammar=grammar.grammar)
+                        # The grammar only masks candidates, so they are still in vocabulary order
+                        np.copyto(logits, self.candidates_data['logit'])
+                    if has_grammar:
+                        metrics.elapsed('grammar', t_grammar)
+                    if n_temp < 0.0 or (n_temp > 0 and mirostat in (1, 2)):
+                        candidates_p = self.load_candidates(logits=logits)
+
+                    if n_temp < 0.0:
+                        id = llama_cpp.llama_sample_softmax(ctx=self.ctx, candidates=candidates_p)
+                    elif n_temp == 0:
+                        # Greedy sampling
+                        id = self.sampler.greedy(logits)
+                    elif mirostat == 1:
+                        mirostat_mu = 2.0 * mirostat_tau
+                        mirostat_m = 100
+                        llama_cpp.llama_sample_temperature(ctx=self.ctx, candidates=candidates_p, temp=c_float(n_temp))
+                        id = llama_cpp.llama_sample_token_mirostat(ctx=self.ctx, candidates=candidates_p,
+                            tau=c_float(mirostat_tau), eta=c_float(mirostat_eta), m=c_size_t(mirostat_m), mu=c_float(mirostat_mu))
+                    elif mirostat == 2:
+                        mirostat_mu = 2.0 * mirostat_tau
+                        llama_cpp.llama_sample_temperature(ctx=self.ctx, candidates=candidates_p, temp=c_float(n_temp))
+                        id = llama_cpp.llama_sample_token_mirostat_v2(ctx=self.ctx, candidates=candidates_p,
+                            tau=c_float(mirostat_tau), eta=c_float(mirostat_eta), mu=c_float(mirostat_mu))
+                    else:
+                        # Temperature sampling
+                        id = self.sampler.sample(logits, temp=n_temp, top_k=top_k, tfs_z=n_tfs_z,
+                                                 typical_p=n_typical_p, top_p=n_top_p, min_p=n_min_p)
+                    # Including any time spent on the grammar
+                    metrics.elapsed('sample', t_sample)
+
+                token = id
+                piece = self.vocab.pieces[id]
+
                 running = True
-                if piece in abort_set:
+                if id in matcher.abort_ids:
                     logger.debug(f"Break ({len(log_chunks)}): Aborting on {piece} ({id})")
                     running = False
                     # TODO Do I need to inject a newline in-context here?
@@ -489,46 +997,69 @@ class FlowEngine:
                     running = False
                     id = None
                     return response_tokens
-                elif (last_piece, piece) in sequence_set:
-                    logger.debug(f"Break ({len(log_chunks)}): sequence {last_piece}, {piece} ({id})")
+                elif matcher.is_sequence(last_token, id):
+                    logger.debug(f"Break ({len(log_chunks)}): sequence {self.vocab.pieces[last_token]}, {piece} ({id})")
                     running = False
                     id = None
-                elif piece == '\n' and last_piece == '\n':
+                elif id in self.vocab.newline_ids and last_token in self.vocab.newline_ids:
                     logger.debug(f"Break ({len(log_chunks)}): Double Newline ({id})")
                     running = False
                     id = None
-                elif id == llama_cpp.llama_token_eos(self.ctx):
+                elif id == self.token_eos:
                     logger.debug(f"Break ({len(log_chunks)}): EOS ({id})")
                     running = False
                     # TODO Do I need to inject a newline in-context here?
                     id = 13
 
                 if id is not None:
-                    #tokens = (llama_cpp.llama_token * 1)(id)
-                    #return_code = llama_cpp.llama_decode(ctx=self.ctx, batch=llama_cpp.llama_batch_get_one(tokens=tokens, n_tokens=1, pos_0=self.n_past, seq_id=0))
-
-                    tokens = (llama_cpp.llama_token * 1)(id)
-                    return_code = llama_cpp.llama_eval(ctx=self.ctx, tokens=tokens, n_tokens=1, n_past=self.n_past)
+                    if len(pending) > 0 and id == pending[0]:
+                        # Our draft was right, so this token is already decoded
+                        pending.pop(0)
+                        seq.accept([id])
+                        seq.logits_ix += 1
+                        return_code = 0
+                    else:
+                        if n_drafted > 0:
+                            self.speculation.record(n_drafted, n_drafted - len(pending))
+                        if self.context_shift and self.token_clearance(1) < 0:
+                            self.shift_context((seq.n_past - seq.n_keep) // 2, sequence=seq.name)
+                        pending = list(forced)
+                        if drafter is not None and running and token not in matcher.stop_ids:
+                            n_room = min(n_draft, remaining_tokens - 1 - len(forced), self.n_batch - 1 - len(forced),
+                                         self.token_clearance(1 + len(forced)))
+                            if n_room > 0:
+                                pending += drafter.propose(seq.session_tokens + [id] + forced, n_room)
+                        n_drafted = len(pending) - len(forced)
+                        t_decode = metrics.now()
+                        return_code = self.decode([id], sequence=seq.name, draft=pending)
+                        metrics.elapsed('decode', t_decode)
+                        metrics.count('decode_batches')
                     log_chunks.append(piece)
                     log_ids.append(id)
                     if return_code != 0:
-                        logger.error(f"Break - Model Eval return code {return_code}")
+                        logger.error(f"Break - Model Decode return code {return_code}")
                         running = False
                     else:
-                        self.n_past += 1
                         n_generated += 1
 
-                    self.session_tokens.append(id)
-                    response_tokens.append(piece)
-                    if self.output is not None:
-                        self.output.handle_token(piece)
+                    # Characters split across tokens are held back until they are complete
+                    text = decoder.decode(self.vocab.piece_bytes[token])
+                    if len(text) > 0:
+                        if n_texts == 0:
+                            metrics.elapsed('time_to_first_token', t_read)
+                        n_texts += 1
+                        response_tokens.append(text)
+                        if output is not None:
+                            output.handle_token(text)
                     remaining_tokens -= 1
-                    last_piece = piece
                     last_id = id
-                    if grammar is not None:
+                    last_token = token
+                    if has_grammar:
+                        t_grammar = metrics.now()
                         llama_cpp.llama_grammar_accept_token(ctx=self.ctx, token=llama_cpp.llama_token(id), grammar=grammar.grammar)
+                        metrics.elapsed('grammar', t_grammar)
 
-                if piece in stop_set:
+                if token in matcher.stop_ids:
                     running = False
 
                 if len(log_chunks) > 0 and (not running or len(log_chunks) % log_chunk_length == 0):
@@ -539,13 +1070,292 @@ class FlowEngine:
 
                 if not running:
                     break
-        finally: 
-            #llama_cpp.llama_batch_free(llama_batch)
-            pass
+        finally:
+            if n_drafted > 0:
+                self.speculation.record(n_drafted, max(n_drafted - len(pending), 0))
+            if drafter is not None:
+                logger.debug(f"Speculation: {self.speculation}")
+            if metrics.enabled:
+                metrics.count('generated_tokens', n_generated)
+                metrics.count('drafted_tokens', self.speculation.n_drafted)
+                metrics.count('accepted_draft_tokens', self.speculation.n_accepted)
+                metrics.elapsed('read', t_read)
 
 
         return response_tokens
 
+    def read_candidates(self, n_candidates : int = 3, max_tokens : int = 512, abort_tokens : list = [],
+                        stop_tokens : list = [], sequence_tokens : list = [], n_temp : float = 0.7, top_k : int = 40,
+                        n_tfs_z : float = 1.0, n_typical_p : float = 1.0, n_top_p : float = 0.95, n_min_p : float = 0.05,
+                        grammar : Optional[llama_cpp.LlamaGrammar] = None, sequence : Optional[str] = None,
+                        mask_abort : bool = False, **kwargs) -> List[Candidate]:
+        """
+        Read several alternative continuations at once, ranked best first by their mean log probability.  Each
+        candidate is a copy of the sequence sharing its KV cells, and each step decodes the next token of every
+        candidate in one batch.  The sequence itself is unchanged until a candidate is accepted.
+        Unlike read, tail free and typical sampling default to off, as they leave (nearly) one choice at each step.
+        """
+        seq = self.get_sequence(sequence)
+        self.drop_candidates()
+        rc = self.ensure_logits(seq)
+        if rc != 0:
+            logger.error(f"Failed to decode logits, return code {rc}")
+            return []
+        n_candidates = min(n_candidates, self.n_batch, self.n_seq_max - len(self.sequences))
+        matcher = self.vocab.compile(abort_tokens=abort_tokens, stop_tokens=stop_tokens, sequence_tokens=sequence_tokens)
+        has_grammar = grammar is not None and grammar.grammar is not None
+
+        candidates = [Candidate(self.copy_sequence(seq.name, f"{seq.name}/candidate{i}").name) for i in range(n_candidates)]
+        self.alternatives = candidates
+        self.alternatives_source = seq.name
+        decoders = [self.vocab.decoder() for _ in candidates]
+        for candidate in candidates:
+            candidate.grammar = llama_cpp.llama_grammar_copy(grammar.grammar) if has_grammar else None
+        grammars = [candidate.grammar for candidate in candidates]
+        last_tokens = [-1] * n_candidates
+        live = list(range(n_candidates))
+        try:
+            for _ in range(max_tokens):
+                if len(live) == 0:
+                    break
+                llama_batch_clear(self.batch)
+                stepped = []
+                for i in live:
+                    cseq = self.sequences[candidates[i].sequence]
+                    logits = self.load_logits(cseq)
+                    top = logits.max()
+                    log_z = top + np.log(np.exp(logits - top).sum())
+                    raw = logits.copy()
+                    if mask_abort:
+                        logits += matcher.abort_bias
+                    self.sampler.penalize(logits, cseq.last_n.tokens())
+                    if grammars[i] is not None and not self.mask_grammar(logits, grammars[i], 1 if n_temp <= 0 else max(top_k, 1)):
+                        candidates_p = self.load_candidates(logits=logits)
+                        llama_cpp.llama_sample_grammar(ctx=self.ctx, candidates=candidates_p, grammar=grammars[i])
+                        np.copyto(logits, self.candidates_data['logit'])
+                    if n_temp <= 0:
+                        id = self.sampler.greedy(logits)
+                    else:
+                        id = self.sampler.sample(logits, temp=n_temp, top_k=top_k, tfs_z=n_tfs_z,
+                                                 typical_p=n_typical_p, top_p=n_top_p, min_p=n_min_p)
+                    token = id
+                    # The same breaks as read
+                    if id in matcher.abort_ids or (id == 2 and (len(candidates[i].ids) == 0 or last_tokens[i] == 13)):
+                        id = None
+                    elif matcher.is_sequence(last_tokens[i], id):
+                        id = None
+                    elif id in self.vocab.newline_ids and last_tokens[i] in self.vocab.newline_ids:
+                        id = None
+                    elif id == self.token_eos:
+                        id = 13
+                    if id is None:
+                        continue
+                    candidates[i].logprob += float(raw[token] - log_z)
+                    llama_batch_add(self.batch, id, cseq.n_past, [cseq.seq_id], True)
+                    stepped.append((i, id, token))
+
+                # Our batch overwrites the logits of whoever decoded last
+                owner = self.logits_owner
+                if owner is not None and owner.logits is None:
+                    owner.logits = self.current_logits(owner).copy()
+                self.logits_owner = None
+                if len(stepped) == 0 or llama_cpp.llama_decode(self.ctx, self.batch) != 0:
+                    break
+
+                live = []
+                for row, (i, id, token) in enumerate(stepped):
+                    candidate = candidates[i]
+                    cseq = self.sequences[candidate.sequence]
+                    cseq.accept([id])
+                    cseq.logits_ix = row
+                    cseq.logits = None
+                    cseq.needs_logits = False
+                    candidate.ids.append(id)
+                    text = decoders[i].decode(self.vocab.piece_bytes[token])
+                    if len(text) > 0:
+                        candidate.tokens.append(text)
+                    last_tokens[i] = token
+                    if grammars[i] is not None:
+                        llama_cpp.llama_grammar_accept_token(ctx=self.ctx, token=llama_cpp.llama_token(id), grammar=grammars[i])
+                    if token not in matcher.stop_ids and token != self.token_eos:
+                        live.append(i)
+        finally:
+            # Our logits are shared by every candidate, so each one decodes its last token again when it is next read
+            for candidate in candidates:
+                self.sequences[candidate.sequence].needs_logits = True
+
+        candidates.sort(key=lambda c: c.score, reverse=True)
+        # Identical candidates are no use as alternatives
+        unique = {}
+        for candidate in candidates:
+            unique.setdefault(tuple(candidate.ids), candidate)
+        for candidate in candidates:
+            if unique[tuple(candidate.ids)] is not candidate:
+                self.drop_candidate(candidate)
+        candidates = list(unique.values())
+        self.alternatives = candidates
+        logger.debug(f"Read candidates: {candidates}")
+        return candidates
+
+    def accept_candidate(self, index : int = 0, grammar : Optional[llama_cpp.LlamaGrammar] = None) -> Optional[Candidate]:
+        """
+        Make one of our candidates the continuation of the sequence it was read from
+        grammar: The grammar the candidates were read with, which is moved on to the candidate's grammar state
+        """
+        if index >= len(self.alternatives) or self.alternatives_source not in self.sequences:
+            return None
+        candidate = self.alternatives[index]
+        self.copy_sequence(candidate.sequence, self.alternatives_source)
+        if grammar is not None and candidate.grammar is not None:
+            if grammar.grammar is not None:
+                llama_cpp.llama_grammar_free(grammar.grammar)
+            grammar.grammar = llama_cpp.llama_grammar_copy(candidate.grammar)
+        return candidate
+
+    def drop_candidate(self, candidate : Candidate):
+        if candidate.sequence in self.sequences and self.sequences[candidate.sequence] is not self.sequence:
+            self.drop_sequence(candidate.sequence)
+        if candidate.grammar is not None:
+            llama_cpp.llama_grammar_free(candidate.grammar)
+            candidate.grammar = None
+
+    def drop_candidates(self):
+        """Free the sequences holding our candidates"""
+        for candidate in self.alternatives:
+            self.drop_candidate(candidate)
+        self.alternatives = []
+        self.alternatives_source = None
+
+    def score(self, prefix : str, options : List[str], sequence : Optional[str] = None, **kwargs) -> List[float]:
+        """
+        The total log probability of each option following the prefix, in the context of the sequence.  The
+        prefix is decoded once, into a copy of the sequence, and then every option is decoded in one batch
+        (more, if they don't fit), each in its own copy sharing the prefix cells.  The sequence is unchanged.
+        """
+        seq = self.get_sequence(sequence)
+        if len(options) == 0:
+            return []
+        # Tokenize each option with the prefix, as a word can merge with (or split) the token before it
+        prompts = [self.tokenize(prefix + option) for option in options]
+        shared = self.tokenize(prefix)
+        n_shared = len(shared)
+        for tokens in prompts:
+            n_common = 0
+            while n_common < min(n_shared, len(tokens)) and tokens[n_common] == shared[n_common]:
+                n_common += 1
+            n_shared = n_common
+        tails = [tokens[n_shared:] for tokens in prompts]
+        if max(len(tail) for tail in tails) > self.n_batch:
+            raise ValueError(f"An option is longer than our batch ({self.n_batch} tokens)")
+
+        scores = [0.0] * len(options)
+        base = self.copy_sequence(seq.name, f"{seq.name}/score")
+        slots = [base]
+        try:
+            rc = 0
+            for i in range(0, n_shared, self.n_batch):
+                rc = self.decode(shared[i:min(i + self.n_batch, n_shared)], logits=i + self.n_batch >= n_shared,
+                                 sequence=base.name)
+                if rc != 0:
+                    break
+            if rc == 0:
+                rc = self.ensure_logits(base)
+            if rc != 0:
+                logger.error(f"Failed to decode prefix, return code {rc}")
+                return [float('-inf')] * len(options)
+            first = self.current_logits(base).astype(np.float64)
+            first -= first.max() + np.log(np.exp(first - first.max()).sum())
+            n_base = base.n_past
+
+            # Our batches overwrite the logits of whoever decoded last
+            owner = self.logits_owner
+            if owner is not None and owner.logits is None:
+                owner.logits = self.current_logits(owner).copy()
+            self.logits_owner = None
+            n_slots = max(1, self.n_seq_max - len(self.sequences) + 1)
+            while len(slots) < min(n_slots, len(options)):
+                slots.append(self.copy_sequence(base.name, f"{seq.name}/score{len(slots)}"))
+
+            pending = [i for i, tail in enumerate(tails) if len(tail) > 0]
+            while len(pending) > 0:
+                llama_batch_clear(self.batch)
+                group = []
+                for i in pending:
+                    if len(group) == len(slots) or self.batch.n_tokens + len(tails[i]) > self.n_batch:
+                        break
+                    slot = slots[len(group)]
+                    for j, token in enumerate(tails[i]):
+                        llama_batch_add(self.batch, token, n_base + j, [slot.seq_id], True)
+                    group.append((i, self.batch.n_tokens - len(tails[i])))
+                pending = pending[len(group):]
+                rc = llama_cpp.llama_decode(self.ctx, self.batch)
+                for slot in slots:
+                    llama_cpp.llama_kv_cache_seq_rm(self.ctx, slot.seq_id, n_base, -1)
+                if rc != 0:
+                    logger.error(f"Failed to decode options, return code {rc}")
+                    for i, _ in group:
+                        scores[i] = float('-inf')
+                    continue
+                for i, row in group:
+                    tail = tails[i]
+                    total = first[tail[0]]
+                    for j in range(1, len(tail)):
+                        logits = np.ctypeslib.as_array(llama_cpp.llama_get_logits_ith(self.ctx, row + j - 1),
+                                                       shape=(self.n_vocab,)).astype(np.float64)
+                        top = logits.max()
+                        total += logits[tail[j]] - top - np.log(np.exp(logits - top).sum())
+                    scores[i] = float(total)
+        finally:
+            for slot in slots:
+                self.drop_sequence(slot.name)
+        logger.debug(f"Scored {len(options)} options: {scores}")
+        return scores
+
+    def embed(self, texts : List[str], normalize : bool = True, n_ctx_embed : int = 512) -> np.ndarray:
+        """
+        Embed texts with our model, returning a (len(texts), n_embd) matrix.  This runs on a context of its own
+        (of n_ctx_embed tokens), so none of our sequences are disturbed.
+        """
+        if self.embedder is None:
+            self.embedder = Embedder.from_model(self.model, n_ctx=n_ctx_embed, n_batch=self.n_batch)
+        return self.embedder.embed(texts, normalize=normalize)
+
+    async def stream(self, prompt : Optional[str] = None, max_queue : int = 16, **kwargs) -> AsyncIterator[str]:
+        """
+        Read tokens as they are generated, without blocking the event loop.  The prompt (if any) is executed,
+        and the read run, on our worker thread.  Leaving the iteration early cancels the read at the next
+        token, and we only finish once the engine is idle again.
+        """
+        if self.worker is None:
+            self.worker = ThreadPoolExecutor(max_workers=1, thread_name_prefix='flow')
+        loop = asyncio.get_running_loop()
+        stream = TokenStream(loop, max_queue=max_queue)
+
+        def work():
+            try:
+                if prompt is not None:
+                    self.execute(prompt=prompt, **kwargs)
+                self.read(token_handler=stream, cancel=stream.cancelled, **kwargs)
+            finally:
+                stream.finish()
+
+        future = loop.run_in_executor(self.worker, work)
+        try:
+            while True:
+                token = await stream.get()
+                if token is None:
+                    break
+                yield token
+        finally:
+            stream.cancel()
+            await future
+
     def __del__(self):
+        self.writer.close()
+        if self.worker is not None:
+            self.worker.shutdown(wait=False)
+        llama_cpp.llama_batch_free(self.batch)
         llama_cpp.llama_free(self.ctx)
+        # Models we loaded through the registry are freed with their last engine
+        model_registry.release(self.model)
 
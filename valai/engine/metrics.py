@@ -0,0 +1,173 @@
+# valai/engine/metrics.py
+
+from bisect import bisect_left
+import functools
+import json
+import logging
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Seconds, from a single sampled token up to a long prefill or a save to a slow disk
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Histogram:
+    """Counts of observations falling under each bucket bound, along with their count, sum and max"""
+    def __init__(self, buckets : Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        # The last count is for everything over our largest bucket
+        self.counts : List[int] = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value : float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q : float) -> float:
+        """An upper bound on the q quantile: the first bucket bound holding it"""
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            if total >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self) -> dict:
+        return {'count': self.count, 'sum': self.sum, 'max': self.max, 'p50': self.quantile(0.5),
+                'p95': self.quantile(0.95), 'buckets': dict(zip([str(b) for b in self.buckets] + ['+Inf'], self.counts))}
+
+
+def timed(name : str) -> Callable:
+    """Time a method into the {name}_seconds histogram of its object's metrics registry"""
+    def decorator(method : Callable) -> Callable:
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            metrics = self.metrics
+            if not metrics.enabled:
+                return method(self, *args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                metrics.elapsed(name, start)
+        return wrapper
+    return decorator
+
+
+class MetricsRegistry:
+    """
+        MetricsRegistry collects counters and timing histograms from an engine, totalled since it was created
+        and for the current turn.  The engine never ends a turn itself; whoever drives it (a wizard, once per
+        player input) calls end_turn, which logs the turn's summary and starts the next.  Everything can be
+        exported as JSON, or as Prometheus text.  A disabled registry returns before touching a clock or a
+        lock, so instrumented code costs little more than the method call.
+    """
+    def __init__(self, enabled : bool = False, prefix : str = 'valai'):
+        self.enabled = enabled
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.counters : Dict[str, float] = {}
+        self.histograms : Dict[str, Histogram] = {}
+        # Counters and timing sums since the last end_turn
+        self.turn : Dict[str, float] = {}
+        self.n_turns = 0
+        # Counters kept elsewhere (checkpoint stats, say), which are read when we are exported, enabled or not
+        self.collectors : Dict[str, Callable[[], Dict[str, float]]] = {}
+
+    @classmethod
+    def from_config(cls, metrics : bool = False, **kwargs) -> 'MetricsRegistry':
+        return cls(enabled=metrics)
+
+    def now(self) -> float:
+        """A start time for elapsed, or 0 if we are disabled"""
+        return time.perf_counter() if self.enabled else 0.0
+
+    def count(self, name : str, n : float = 1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+            self.turn[name] = self.turn.get(name, 0) + n
+
+    def observe(self, name : str, value : float):
+        if not self.enabled:
+            return
+        with self.lock:
+            histogram = self.histograms.get(name, None)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(value)
+            self.turn[name] = self.turn.get(name, 0) + value
+
+    def elapsed(self, name : str, start : float):
+        """Record the seconds since start (from now) in the {name}_seconds histogram"""
+        if not self.enabled:
+            return
+        self.observe(f"{name}_seconds", time.perf_counter() - start)
+
+    def collect(self, name : str, collector : Callable[[], Dict[str, float]]):
+        """Export the counters a collector returns as {name}_{counter}"""
+        self.collectors[name] = collector
+
+    def collected(self) -> Dict[str, Dict[str, float]]:
+        return {name: collector() for name, collector in self.collectors.items()}
+
+    def end_turn(self) -> Dict[str, float]:
+        """Log a summary of this turn, and start the next one, returning what the turn recorded"""
+        if not self.enabled:
+            return {}
+        with self.lock:
+            turn, self.turn = self.turn, {}
+            self.n_turns += 1
+        if len(turn) > 0:
+            summary = ', '.join(f"{name}={value:.3f}" if name.endswith('_seconds') else f"{name}={value:g}"
+                                for name, value in sorted(turn.items()))
+            logger.info(f"Turn {self.n_turns}: {summary}")
+        return turn
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+            self.turn.clear()
+            self.n_turns = 0
+
+    def snapshot(self) -> dict:
+        collected = self.collected()
+        with self.lock:
+            return {'turns': self.n_turns, 'counters': dict(self.counters),
+                    'histograms': {name: histogram.snapshot() for name, histogram in self.histograms.items()},
+                    'collected': collected}
+
+    def to_json(self, indent : Optional[int] = None) -> str:
+        return json.dumps(self.snapshot(), indent=indent)
+
+    def to_prometheus(self) -> str:
+        """Our metrics in the Prometheus text exposition format"""
+        counters = {f"{name}_{counter}": value for name, values in self.collected().items()
+                    for counter, value in values.items()}
+        lines = []
+        with self.lock:
+            counters.update(self.counters)
+            for name, value in sorted(counters.items()):
+                metric = f"{self.prefix}_{name}_total"
+                lines += [f"# TYPE {metric} counter", f"{metric} {value:g}"]
+            for name, histogram in sorted(self.histograms.items()):
+                metric = f"{self.prefix}_{name}"
+                lines.append(f"# TYPE {metric} histogram")
+                total = 0
+                for bound, count in zip(list(histogram.buckets) + ['+Inf'], histogram.counts):
+                    total += count
+                    lines.append(f'{metric}_bucket{{le="{bound}"}} {total}')
+                lines += [f"{metric}_sum {histogram.sum:g}", f"{metric}_count {histogram.count}"]
+        return '\n'.join(lines) + '\n'
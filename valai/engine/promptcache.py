@@ -0,0 +1,146 @@
+# valai/engine/promptcache.py
+
+from contextlib import contextmanager
+from ctypes import c_void_p
+import hashlib
+import json
+import logging
+import os
+import time
+from typing import Dict, Iterator, List, Optional
+
+import numpy as np
+
+from .checkpoint import Checkpoint, CheckpointStore
+from .session import atomic_write, file_lock
+from .statefile import model_fingerprint
+
+logger = logging.getLogger(__name__)
+
+
+class PromptCache:
+    """
+        PromptCache keeps llama states on disk, keyed by a hash of the model and the token prefix that
+        produced them.  A restarted engine can restore the longest cached prefix of a prompt instead of
+        decoding it again.  The cache is shared by every session, so the index is only ever changed under a
+        file lock, read fresh from disk and written straight back.
+    """
+    def __init__(self, fingerprint : str, prompt_cache_path : str = 'local/prompt_cache', prompt_cache_budget : int = 2 ** 33,
+                 prompt_cache_codec : str = 'zlib'):
+        self.fingerprint = fingerprint
+        self.path = prompt_cache_path
+        # Our budget is for the (compressed) bytes on disk
+        self.budget = prompt_cache_budget
+        self.store = CheckpointStore(checkpoint_path=self.path, checkpoint_budget=0, checkpoint_codec=prompt_cache_codec)
+        self.index_file = os.path.join(self.path, 'index.json')
+        self.lock_file = os.path.join(self.path, 'index.lock')
+        self.index : Dict[str, dict] = self.read_index()
+
+    @classmethod
+    def from_config(cls, model : c_void_p, n_ctx : int, prompt_cache_path : str = 'local/prompt_cache',
+                    prompt_cache_budget : int = 2 ** 33, prompt_cache_codec : str = 'zlib', **kwargs) -> 'PromptCache':
+        # The same model fingerprint our state files are checked against, along with the context size
+        fingerprint = f"{model_fingerprint(model).hex()}:{n_ctx}"
+        return cls(fingerprint=fingerprint, prompt_cache_path=prompt_cache_path, prompt_cache_budget=prompt_cache_budget,
+                   prompt_cache_codec=prompt_cache_codec)
+
+    @property
+    def total(self) -> int:
+        return sum(entry['size'] for entry in self.index.values())
+
+    def key(self, tokens : List[int]) -> str:
+        h = hashlib.sha256(self.fingerprint.encode('utf-8'))
+        h.update(np.asarray(tokens, dtype=np.int32).tobytes())
+        return h.hexdigest()[:32]
+
+    def lookup(self, tokens : List[int], n_min : int = 1) -> Optional[Checkpoint]:
+        """Find the longest cached prefix of tokens, with at least n_min tokens"""
+        # Other processes may have added to the cache since we last looked
+        self.index = self.read_index()
+        lengths = sorted({entry['n_tokens'] for entry in self.index.values()
+                          if n_min <= entry['n_tokens'] <= len(tokens)}, reverse=True)
+        for n_tokens in lengths:
+            key = self.key(tokens[:n_tokens])
+            if key not in self.index:
+                continue
+            checkpoint = self.store.read(key)
+            if checkpoint is None or checkpoint.tokens != tokens[:n_tokens]:
+                logger.warning(f"Dropping bad prompt cache entry {key}")
+                self.remove(key)
+                continue
+            with self.locked() as index:
+                if key in index:
+                    index[key]['used'] = time.time()
+            logger.debug(f"Prompt cache hit {key} for {n_tokens}/{len(tokens)} tokens")
+            return checkpoint
+        return None
+
+    def contains(self, tokens : List[int]) -> bool:
+        return self.key(tokens) in self.index
+
+    def put(self, checkpoint : Checkpoint):
+        """Write a checkpoint to the cache, keyed on its tokens"""
+        key = self.key(checkpoint.tokens)
+        checkpoint.name = key
+        # The file is written under the lock too, so every file outside the index is one we can sweep up
+        with self.locked() as index:
+            size = self.store.write(checkpoint)
+            index[key] = {'n_tokens': len(checkpoint.tokens), 'size': size, 'used': time.time()}
+            # Keep the entry we just wrote, even if it is over budget on its own
+            while self.total > self.budget and len(index) > 1:
+                oldest = min(index, key=lambda k: index[k]['used'])
+                logger.debug(f"Evicting prompt cache entry {oldest}")
+                self.discard(oldest)
+            self.sweep()
+        logger.debug(f"Prompt cache stored {key} for {len(checkpoint.tokens)} tokens")
+
+    def remove(self, key : str):
+        with self.locked():
+            self.discard(key)
+
+    def clear(self):
+        with self.locked() as index:
+            for key in list(index.keys()):
+                self.discard(key)
+            self.sweep()
+
+    @contextmanager
+    def locked(self) -> Iterator[Dict[str, dict]]:
+        """Hold the index lock, with the index read fresh from disk, writing it back when we are done"""
+        with file_lock(self.lock_file):
+            self.index = self.read_index()
+            yield self.index
+            self.write_index()
+
+    def discard(self, key : str):
+        """Remove an entry and its files; only under our lock"""
+        self.index.pop(key, None)
+        self.store.discard(key)
+
+    def sweep(self) -> int:
+        """Remove the files of entries that are missing from our index; only under our lock"""
+        suffix = os.path.basename(self.store.filename(''))
+        orphans = [name[:-len(suffix)] for name in os.listdir(self.path) if name.endswith(suffix)]
+        orphans = [key for key in orphans if key not in self.index]
+        for key in orphans:
+            logger.debug(f"Removing orphaned prompt cache entry {key}")
+            self.store.discard(key)
+        # Entries from before spilled checkpoints had a suffix of their own can never be found again
+        for name in os.listdir(self.path):
+            if name.endswith(('.context.dat', '.context.dat.json')):
+                os.remove(os.path.join(self.path, name))
+        return len(orphans)
+
+    def read_index(self) -> Dict[str, dict]:
+        if not os.path.exists(self.index_file):
+            return {}
+        try:
+            with open(self.index_file, 'r') as fp:
+                return json.load(fp)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable prompt cache index {self.index_file}: {e}")
+            return {}
+
+    def write_index(self):
+        with atomic_write(self.index_file, 'w') as fp:
+            json.dump(self.index, fp)
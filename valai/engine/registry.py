@@ -0,0 +1,105 @@
+# valai/engine/registry.py
+
+from ctypes import c_void_p
+import logging
+import os
+import threading
+from typing import Dict, Optional, Tuple
+
+import llama_cpp
+
+from .vocab import Vocabulary
+
+logger = logging.getLogger(__name__)
+
+
+class ModelEntry:
+    """A loaded model, and how many engines are using it"""
+    def __init__(self, key : Tuple, model : c_void_p):
+        self.key = key
+        self.model = model
+        self.refs = 0
+        self.vocab : Optional[Vocabulary] = None
+
+    def __repr__(self) -> str:
+        return f"ModelEntry({self.key[0]}, refs={self.refs})"
+
+
+class ModelRegistry:
+    """
+        ModelRegistry loads each gguf file once per process, and reference counts it.  Every FlowEngine
+        gets its own context (with its own n_ctx and n_batch), but engines on the same model share its
+        weights.  The model is freed when the last engine releases it.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.backend_ready = False
+        self.entries : Dict[Tuple, ModelEntry] = {}
+        # Keyed by the model pointer value, so we can release without knowing how a model was loaded
+        self.models : Dict[int, ModelEntry] = {}
+
+    @staticmethod
+    def model_key(model_loc : str, mparams : llama_cpp.llama_model_params) -> Tuple:
+        return (os.path.realpath(model_loc), mparams.n_gpu_layers, mparams.main_gpu, mparams.vocab_only,
+                mparams.use_mmap, mparams.use_mlock)
+
+    def acquire(self, model_loc : str, mparams : llama_cpp.llama_model_params) -> c_void_p:
+        """Get a model, loading it if this is the first reference"""
+        key = self.model_key(model_loc, mparams)
+        with self.lock:
+            if not self.backend_ready:
+                llama_cpp.llama_backend_init(numa=False)
+                self.backend_ready = True
+            entry = self.entries.get(key, None)
+            if entry is None:
+                logger.debug(f"Loading model {model_loc}")
+                model = llama_cpp.llama_load_model_from_file(model_loc.encode('utf-8'), mparams)
+                if not model:
+                    raise ValueError(f"Failed to load model {model_loc}")
+                entry = ModelEntry(key=key, model=model)
+                self.entries[key] = entry
+                self.models[model] = entry
+            entry.refs += 1
+            logger.debug(f"Acquired {entry}")
+            return entry.model
+
+    def retain(self, model : c_void_p) -> bool:
+        """Take another reference to a model we loaded, for a context created on it directly"""
+        with self.lock:
+            entry = self.models.get(model, None)
+            if entry is None:
+                return False
+            entry.refs += 1
+            logger.debug(f"Acquired {entry}")
+            return True
+
+    def release(self, model : c_void_p) -> bool:
+        """Release a reference to a model, freeing it with the last reference"""
+        with self.lock:
+            entry = self.models.get(model, None)
+            if entry is None:
+                return False
+            entry.refs -= 1
+            logger.debug(f"Released {entry}")
+            if entry.refs <= 0:
+                del self.entries[entry.key]
+                del self.models[model]
+                llama_cpp.llama_free_model(entry.model)
+            return True
+
+    def vocabulary(self, model : c_void_p) -> Vocabulary:
+        """The vocabulary for a model, built once and shared by every engine using it"""
+        with self.lock:
+            entry = self.models.get(model, None)
+            if entry is None:
+                return Vocabulary.from_model(model)
+            if entry.vocab is None:
+                entry.vocab = Vocabulary.from_model(model)
+            return entry.vocab
+
+    def refs(self, model : c_void_p) -> int:
+        entry = self.models.get(model, None)
+        return 0 if entry is None else entry.refs
+
+
+model_registry = ModelRegistry()
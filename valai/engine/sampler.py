@@ -0,0 +1,157 @@
+# valai/engine/sampler.py
+
+import logging
+from typing import List, Optional, Tuple
+
+import llama_cpp
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class TokenRing:
+    """A fixed size ring buffer of the most recent tokens in a sequence, padded with zeros like llama.cpp"""
+    def __init__(self, size : int = 64):
+        self.data = np.zeros(size, dtype=np.intc)
+        self.pos = 0
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def push(self, tokens : List[int]):
+        size = len(self.data)
+        if len(tokens) >= size:
+            self.data[:] = tokens[-size:]
+            self.pos = 0
+            return
+        end = self.pos + len(tokens)
+        if end <= size:
+            self.data[self.pos:end] = tokens
+        else:
+            split = size - self.pos
+            self.data[self.pos:] = tokens[:split]
+            self.data[:end - size] = tokens[split:]
+        self.pos = end % size
+
+    def fill(self, tokens : List[int]):
+        """Replace our contents with the tail of the given tokens"""
+        self.reset()
+        self.push(tokens)
+
+    def reset(self):
+        self.data[:] = 0
+        self.pos = 0
+
+    def tokens(self) -> np.ndarray:
+        """Our tokens, oldest first"""
+        return np.roll(self.data, -self.pos)
+
+    def copy(self) -> 'TokenRing':
+        ring = TokenRing(len(self.data))
+        ring.data[:] = self.data
+        ring.pos = self.pos
+        return ring
+
+
+class Sampler:
+    """
+        Sampler applies the llama.cpp repetition penalties and sampler chain (top-k, tail free, typical, top-p,
+        min-p, temperature) with numpy.  Everything after top-k works on the top-k selection, rather than
+        re-sorting the whole vocabulary at each step.  A sampler holds no sequence state, so one can be
+        shared by every sequence in an engine.
+    """
+    def __init__(self, repeat_penalty : float = 1.08, frequency_penalty : float = 0.0, presence_penalty : float = 0.0,
+                 penalty_last_n : int = 64, seed : Optional[int] = None):
+        self.repeat_penalty = repeat_penalty
+        self.frequency_penalty = frequency_penalty
+        self.presence_penalty = presence_penalty
+        self.penalty_last_n = penalty_last_n
+        self.rng = np.random.default_rng(seed)
+        # How sparsely we sample the logits when estimating the top-k threshold
+        self.stride = 16
+
+    @classmethod
+    def from_config(cls, seed : int = llama_cpp.LLAMA_DEFAULT_SEED, **kwargs) -> 'Sampler':
+        return cls(seed=None if seed == llama_cpp.LLAMA_DEFAULT_SEED else seed)
+
+    def seed(self, seed : Optional[int] = None):
+        self.rng = np.random.default_rng(seed)
+
+    def penalize(self, logits : np.ndarray, last_tokens : np.ndarray):
+        """Apply the repetition, frequency and presence penalties to logits in place"""
+        if self.penalty_last_n == 0 or (self.repeat_penalty == 1.0 and self.frequency_penalty == 0.0
+                                        and self.presence_penalty == 0.0):
+            return
+        ids, counts = np.unique(last_tokens[-self.penalty_last_n:], return_counts=True)
+        penalized = logits[ids]
+        penalized = np.where(penalized <= 0, penalized * self.repeat_penalty, penalized / self.repeat_penalty)
+        penalized -= counts * self.frequency_penalty + self.presence_penalty
+        logits[ids] = penalized
+
+    def top_k(self, logits : np.ndarray, k : int) -> Tuple[np.ndarray, np.ndarray]:
+        """Select the k best candidates, sorted, without sorting the whole vocabulary"""
+        n_vocab = len(logits)
+        k = min(max(k, 1), n_vocab)
+        ids = np.arange(n_vocab)
+        if k < n_vocab:
+            sample = logits[::self.stride]
+            if len(sample) > k:
+                # The k-th best of a sample can't beat the k-th best overall, so this keeps all of the top k
+                threshold = np.partition(sample, len(sample) - k)[len(sample) - k]
+                ids = np.flatnonzero(logits >= threshold)
+            ids = ids[np.argpartition(logits[ids], len(ids) - k)[len(ids) - k:]]
+        ids = ids[np.argsort(-logits[ids], kind='stable')]
+        return ids, logits[ids]
+
+    def sample(self, logits : np.ndarray, temp : float = 0.7, top_k : int = 40, tfs_z : float = 1.0,
+               typical_p : float = 1.0, top_p : float = 1.0, min_p : float = 0.0, min_keep : int = 1) -> int:
+        """Sample a token from the full vocabulary logits, with the same semantics as the llama.cpp samplers"""
+        ids, p = self.distribution(logits, temp=temp, top_k=top_k, tfs_z=tfs_z, typical_p=typical_p,
+                                   top_p=top_p, min_p=min_p, min_keep=min_keep)
+        cdf = np.cumsum(p)
+        return int(ids[min(np.searchsorted(cdf, self.rng.random() * cdf[-1], side='right'), len(ids) - 1)])
+
+    def distribution(self, logits : np.ndarray, temp : float = 0.7, top_k : int = 40, tfs_z : float = 1.0,
+                     typical_p : float = 1.0, top_p : float = 1.0, min_p : float = 0.0,
+                     min_keep : int = 1) -> Tuple[np.ndarray, np.ndarray]:
+        """The candidate ids left by our sampler chain, and their probabilities"""
+        ids, logits = self.top_k(logits, top_k)
+        # Each sampler works on the softmax of what is left, which is just our (unnormalized) p, renormalized
+        p = np.exp(logits.astype(np.float64) - logits[0])
+
+        if tfs_z < 1.0 and len(p) > 2:
+            second = np.abs(np.diff(p / p.sum(), n=2))
+            cum_sum = np.cumsum(second)
+            if cum_sum[-1] > 0:
+                last = max(np.searchsorted(cum_sum / cum_sum[-1], tfs_z, side='right'), min_keep)
+                if last < len(cum_sum):
+                    ids, logits, p = ids[:last], logits[:last], p[:last]
+
+        if typical_p < 1.0:
+            q = p / p.sum()
+            log_q = np.log(q)
+            shifted = np.abs(-log_q + (q * log_q).sum())
+            # llama.cpp leaves the candidates flagged as sorted after this, so the samplers after us keep this order
+            order = np.argsort(shifted, kind='stable')
+            last = max(np.searchsorted(np.cumsum(q[order]), typical_p, side='right'), min_keep - 1)
+            if last < len(order):
+                order = order[:last + 1]
+            ids, logits, p = ids[order], logits[order], p[order]
+
+        if top_p < 1.0:
+            last = max(np.searchsorted(np.cumsum(p / p.sum()), top_p, side='left'), min_keep - 1)
+            if last < len(p):
+                ids, logits, p = ids[:last + 1], logits[:last + 1], p[:last + 1]
+
+        if min_p > 0.0 and len(p) > 0:
+            first = max(min_keep, 1)
+            drop = np.flatnonzero(p[first:] < min_p * p[0])
+            if len(drop) > 0:
+                last = first + drop[0]
+                ids, logits, p = ids[:last], logits[:last], p[:last]
+
+        p = np.exp((logits.astype(np.float64) - logits.max()) / temp)
+        return ids, p / p.sum()
+
+    def greedy(self, logits : np.ndarray) -> int:
+        return int(np.argmax(logits))
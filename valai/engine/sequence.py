@@ -0,0 +1,179 @@
+# valai/engine/sequence.py
+
+import logging
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from .sampler import TokenRing
+
+logger = logging.getLogger(__name__)
+
+
+class SequenceFork:
+    """
+        A point in a sequence we can roll back to.  Everything before it stays in the sequence's own KV cells,
+        so a fork only records where it was, and the logits there.
+    """
+    def __init__(self, name : str, n_past : int, n_prev : int, n_keep : int, logits : Optional[np.ndarray] = None):
+        self.name = name
+        self.n_past = n_past
+        self.n_prev = n_prev
+        self.n_keep = n_keep
+        self.logits = logits
+
+    def __repr__(self) -> str:
+        return f"SequenceFork({self.name}, n_past={self.n_past})"
+
+
+class FlowSequence:
+    """
+        FlowSequence tracks the tokens and sampler state for a single llama.cpp sequence id, allowing
+        several conversations to share one context (and one set of weights).
+    """
+    def __init__(self, name : str, seq_id : int, last_n_size : int = 64):
+        self.name = name
+        self.seq_id = seq_id
+        self.n_past = 0
+        self.n_prev = 0
+        # Tokens before n_keep are pinned, and never discarded when shifting the context
+        self.n_keep = 0
+        self.last_n_size = last_n_size
+        self.last_n = TokenRing(last_n_size)
+        self.session_tokens : List[int] = []
+        self.prev_tokens : List[int] = []
+        # The tokens actually held in the KV cache; session_tokens is always a prefix of these, and
+        # anything past n_past can be reused if the next feed matches it.
+        self.cache_tokens : List[int] = []
+        # Where our logits live in the last batch we decoded, or a copy if another sequence has decoded since
+        self.logits_ix = 0
+        self.logits : Optional[np.ndarray] = None
+        # Set when our last token came from the cache, so its logits still need to be decoded
+        self.needs_logits = False
+        # Forks are dropped as soon as anything before them changes, so any we hold can be rolled back to
+        self.forks : Dict[str, SequenceFork] = {}
+
+    @property
+    def last_n_tokens_data(self) -> List[int]:
+        return self.last_n.tokens().tolist()
+
+    @last_n_tokens_data.setter
+    def last_n_tokens_data(self, value : List[int]):
+        self.last_n.fill(value)
+
+    def reset(self):
+        self.n_past = 0
+        self.n_prev = 0
+        self.n_keep = 0
+        self.last_n.reset()
+        self.session_tokens = []
+        self.prev_tokens = []
+        self.cache_tokens = []
+        self.logits_ix = 0
+        self.logits = None
+        self.needs_logits = False
+        self.forks = {}
+
+    def drop_forks(self, n_past : int):
+        """Drop our forks past n_past, where our tokens are changing"""
+        for name in [name for name, fork in self.forks.items() if fork.n_past > n_past]:
+            del self.forks[name]
+
+    def accept(self, tokens : List[int], cached : bool = False):
+        """Record tokens that have been decoded into this sequence, or that were already cached"""
+        if not cached:
+            del self.cache_tokens[self.n_past:]
+            self.cache_tokens.extend(tokens)
+        else:
+            self.needs_logits = True
+        self.n_past += len(tokens)
+        self.session_tokens += tokens
+        self.last_n.push(tokens)
+
+    def cached_prefix(self, tokens : List[int]) -> int:
+        """How many of the given tokens are already in the KV cache at n_past"""
+        n_match = 0
+        for cached, token in zip(self.cache_tokens[self.n_past:], tokens):
+            if cached != token:
+                break
+            n_match += 1
+        return n_match
+
+    def rewind(self, n_keep : int):
+        """Move n_past back to n_keep, leaving the KV cache (and cache_tokens) in place for reuse"""
+        n_keep = max(0, min(n_keep, self.n_past))
+        self.drop_forks(n_keep)
+        self.session_tokens = self.session_tokens[:n_keep]
+        self.n_past = n_keep
+        self.n_prev = min(self.n_prev, n_keep)
+        self.n_keep = min(self.n_keep, n_keep)
+        self.prev_tokens = self.prev_tokens[:self.n_prev]
+        self.last_n.fill(self.session_tokens)
+        self.logits = None
+        self.needs_logits = True
+
+    def truncate(self, n_keep : int):
+        """Drop our tokens from n_keep onward"""
+        self.rewind(n_keep)
+        del self.cache_tokens[self.n_past:]
+
+    def discard(self, start : int, n_discard : int):
+        """Remove n_discard tokens from start, sliding the tokens after them back"""
+        end = start + n_discard
+        self.drop_forks(start)
+        del self.cache_tokens[self.n_past:]
+        del self.cache_tokens[start:end]
+        del self.session_tokens[start:end]
+        self.n_past -= n_discard
+        if self.n_prev >= end:
+            self.n_prev -= n_discard
+        else:
+            self.n_prev = min(self.n_prev, start)
+        self.prev_tokens = self.session_tokens[:self.n_prev]
+
+    def copy_from(self, other : 'FlowSequence'):
+        """Take on the token and sampler state of another sequence"""
+        # Our forks within the prefix we share with other still hold, as those cells are unchanged
+        n_common = 0
+        for ours, theirs in zip(self.session_tokens, other.session_tokens):
+            if ours != theirs:
+                break
+            n_common += 1
+        self.drop_forks(n_common)
+        self.n_past = other.n_past
+        self.n_prev = other.n_prev
+        self.n_keep = other.n_keep
+        self.last_n = other.last_n.copy()
+        self.session_tokens = other.session_tokens.copy()
+        self.prev_tokens = other.prev_tokens.copy()
+        self.cache_tokens = other.session_tokens.copy()
+        self.logits_ix = other.logits_ix
+        self.logits = None if other.logits is None else other.logits.copy()
+        self.needs_logits = other.needs_logits
+
+    def __repr__(self) -> str:
+        return f"FlowSequence({self.name}, seq_id={self.seq_id}, n_past={self.n_past})"
+
+
+class Candidate:
+    """One of several alternative continuations read at once, living in its own sequence until accepted or dropped"""
+    def __init__(self, sequence : str):
+        self.sequence = sequence
+        self.tokens : List[str] = []
+        self.ids : List[int] = []
+        # The sum of the model's log probabilities for our ids, before any penalties or sampling
+        self.logprob = 0.0
+        # Our own copy of the grammar state, if we were read with one
+        self.grammar = None
+
+    @property
+    def text(self) -> str:
+        return ''.join(self.tokens)
+
+    @property
+    def score(self) -> float:
+        """Our mean log probability per token, so shorter candidates aren't favoured"""
+        return self.logprob / max(len(self.ids), 1)
+
+    def __repr__(self) -> str:
+        return f"Candidate({self.sequence}, n_tokens={len(self.ids)}, score={self.score:.3f})"
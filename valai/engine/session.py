@@ -0,0 +1,117 @@
+# valai/engine/session.py
+
+from contextlib import contextmanager
+import logging
+import os
+import re
+import tempfile
+from typing import IO, Iterator, Optional
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+SESSION_ID = re.compile(r'^[A-Za-z0-9_.-]+$')
+
+
+class SessionLocked(Exception):
+    """Another process is using this session"""
+    def __init__(self, message, path):
+        super().__init__(message)
+        self.path = path
+
+
+@contextmanager
+def atomic_write(path : str, mode : str = 'wb') -> Iterator[IO]:
+    """Write a file beside path and rename it into place, so readers only ever see a whole file"""
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    # A name of our own, as another thread (or process) may be writing the same path
+    fd, temp_file = tempfile.mkstemp(dir=directory, prefix=f"{os.path.basename(path)}.", suffix='.tmp')
+    try:
+        with os.fdopen(fd, mode) as fp:
+            yield fp
+        os.replace(temp_file, path)
+    except BaseException:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+        raise
+
+
+@contextmanager
+def file_lock(path : str) -> Iterator[None]:
+    """Hold an exclusive lock on path (creating it if need be), waiting for any other process holding it"""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'a') as fp:
+        if fcntl is not None:
+            fcntl.flock(fp.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(fp.fileno(), fcntl.LOCK_UN)
+
+
+class Session:
+    """
+        Session is where a game keeps its files: saves, context states and checkpoints.  Without an id, that is
+        the session_path itself (local/, as always); with one, it is a directory of its own under
+        session_path/sessions.  A process takes the session's lock before using it, so two games can never
+        write over each other's states.
+    """
+    def __init__(self, session_id : Optional[str] = None, session_path : str = 'local'):
+        if session_id is not None and (SESSION_ID.match(session_id) is None or session_id in ('.', '..')):
+            raise ValueError(f"Invalid session id {session_id}: only letters, digits, '.', '_' and '-'")
+        self.session_id = session_id
+        self.root = session_path
+        self.path = session_path if session_id is None else os.path.join(session_path, 'sessions', session_id)
+        self.lock_fp : Optional[IO] = None
+
+    @classmethod
+    def from_config(cls, session_id : Optional[str] = None, session_path : str = 'local', **kwargs) -> 'Session':
+        return cls(session_id=session_id, session_path=session_path)
+
+    def filename(self, name : str) -> str:
+        return os.path.join(self.path, name)
+
+    @property
+    def locked(self) -> bool:
+        return self.lock_fp is not None
+
+    def lock(self) -> 'Session':
+        """Take this session for our process, raising SessionLocked if another process has it"""
+        if self.lock_fp is not None:
+            return self
+        os.makedirs(self.path, exist_ok=True)
+        lock_file = self.filename('session.lock')
+        fp = open(lock_file, 'a+')
+        if fcntl is None:
+            logger.warning(f"No file locking on this platform, {self.path} is not protected")
+        else:
+            try:
+                fcntl.flock(fp.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                fp.close()
+                raise SessionLocked(f"Session {self.path} is in use by another process", self.path)
+        fp.seek(0)
+        fp.truncate()
+        fp.write(f"{os.getpid()}\n")
+        fp.flush()
+        self.lock_fp = fp
+        logger.debug(f"Locked session {self.path}")
+        return self
+
+    def unlock(self):
+        if self.lock_fp is None:
+            return
+        if fcntl is not None:
+            fcntl.flock(self.lock_fp.fileno(), fcntl.LOCK_UN)
+        self.lock_fp.close()
+        self.lock_fp = None
+        logger.debug(f"Unlocked session {self.path}")
+
+    def __repr__(self) -> str:
+        return f"Session({self.session_id}, path={self.path}, locked={self.locked})"
@@ -0,0 +1,130 @@
+# valai/engine/speculative.py
+
+import logging
+from typing import List, TYPE_CHECKING
+
+import numpy as np
+
+if TYPE_CHECKING:
+    from .llamaflow import FlowEngine
+
+logger = logging.getLogger(__name__)
+
+
+class SpeculationStats:
+    """How many drafted tokens were accepted, for each verification step of a read"""
+    def __init__(self):
+        self.accepted : List[int] = []
+        self.n_drafted = 0
+
+    def record(self, n_drafted : int, n_accepted : int):
+        self.n_drafted += n_drafted
+        self.accepted.append(n_accepted)
+
+    @property
+    def n_steps(self) -> int:
+        return len(self.accepted)
+
+    @property
+    def n_accepted(self) -> int:
+        return sum(self.accepted)
+
+    @property
+    def acceptance(self) -> float:
+        return self.n_accepted / self.n_drafted if self.n_drafted > 0 else 0.0
+
+    @property
+    def per_step(self) -> float:
+        return self.n_accepted / self.n_steps if self.n_steps > 0 else 0.0
+
+    def __repr__(self) -> str:
+        return (f"SpeculationStats(steps={self.n_steps}, drafted={self.n_drafted}, accepted={self.n_accepted}, "
+                f"per_step={self.per_step:.2f})")
+
+
+class Drafter:
+    """A source of draft tokens, to be verified by the main model"""
+    def propose(self, tokens : List[int], n_draft : int) -> List[int]:
+        """Propose up to n_draft tokens to follow the given tokens"""
+        return []
+
+
+class DraftModel(Drafter):
+    """
+        DraftModel proposes greedy continuations from a smaller model sharing our vocabulary.  The draft
+        engine keeps its own KV cache in step with the main sequence, only decoding what has changed.
+    """
+    def __init__(self, engine : 'FlowEngine'):
+        self.engine = engine
+        # How much of the draft sequence we know matches the main sequence
+        self.n_synced = 0
+
+    def sync(self, tokens : List[int]) -> int:
+        """Bring the draft sequence in line with the given tokens, returning a decode return code"""
+        engine = self.engine
+        seq = engine.sequence
+        cached = seq.session_tokens
+        n_common = min(self.n_synced, len(cached), len(tokens))
+        if cached[:n_common] != tokens[:n_common]:
+            n_common = 0
+        while n_common < len(cached) and n_common < len(tokens) and cached[n_common] == tokens[n_common]:
+            n_common += 1
+        if n_common < seq.n_past:
+            engine.truncate_sequence(n_common)
+        for i in range(n_common, len(tokens), engine.n_batch):
+            rc = engine.decode(tokens[i:i + engine.n_batch])
+            if rc != 0:
+                self.n_synced = 0
+                return rc
+        self.n_synced = len(tokens)
+        return engine.ensure_logits(seq)
+
+    def propose(self, tokens : List[int], n_draft : int) -> List[int]:
+        if n_draft <= 0 or self.sync(tokens) != 0:
+            return []
+        engine = self.engine
+        draft = []
+        for _ in range(n_draft):
+            if engine.token_clearance(1) < 0:
+                break
+            id = int(np.argmax(engine.current_logits(engine.sequence)))
+            draft.append(id)
+            if len(draft) == n_draft or engine.decode([id]) != 0:
+                break
+        return draft
+
+
+class PromptLookup(Drafter):
+    """
+        PromptLookup drafts without a second model, by finding the most recent earlier occurrence of our last
+        few tokens in the sequence and proposing whatever followed it.  Character names, symbol tags and
+        phrases repeated from the history are drafted for (nearly) free.
+    """
+    def __init__(self, n_gram_max : int = 3, n_gram_min : int = 1):
+        self.n_gram_max = n_gram_max
+        self.n_gram_min = n_gram_min
+
+    def match(self, history : np.ndarray) -> int:
+        """Where the continuation of the longest (then most recent) earlier match of our tail starts, or -1"""
+        n_tokens = len(history)
+        # Candidate match ends, which must leave at least one token to propose
+        ends = np.flatnonzero(history[:-1] == history[-1])
+        best = -1
+        for n in range(1, min(self.n_gram_max, n_tokens - 1) + 1):
+            if n > 1:
+                ends = ends[ends >= n - 1]
+                ends = ends[history[ends - (n - 1)] == history[-n]]
+            if len(ends) == 0:
+                break
+            if n >= self.n_gram_min:
+                best = int(ends[-1]) + 1
+        return best
+
+    def propose(self, tokens : List[int], n_draft : int) -> List[int]:
+        if n_draft <= 0 or len(tokens) < 2:
+            return []
+        history = np.asarray(tokens, dtype=np.intc)
+        start = self.match(history)
+        if start < 0:
+            return []
+        return history[start:start + n_draft].tolist()
@@ -0,0 +1,70 @@
+# valai/engine/statefile.py
+
+from ctypes import c_void_p, create_string_buffer
+import hashlib
+import logging
+import struct
+from typing import List, Optional, Tuple
+
+import llama_cpp
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+STATE_MAGIC = b'VALS'
+STATE_VERSION = 1
+
+
+def model_fingerprint(model : c_void_p) -> bytes:
+    """A short hash identifying a model's architecture and weights, without reading the weights"""
+    desc = create_string_buffer(256)
+    llama_cpp.llama_model_desc(model, desc, len(desc))
+    fields = (desc.value, llama_cpp.llama_model_size(model), llama_cpp.llama_model_n_params(model),
+              llama_cpp.llama_n_vocab(model), llama_cpp.llama_n_embd(model), llama_cpp.llama_n_ctx_train(model))
+    return hashlib.blake2b(repr(fields).encode('utf-8'), digest_size=16).digest()
+
+
+class StateHeader:
+    """
+        The header of a compact state file: which model and context size it was saved from, and the tokens
+        in the sequence.  It is followed by the packed llama state, which has no logits and only the KV rows
+        in use, so a file is only as large as the context that was saved.
+    """
+    LAYOUT = struct.Struct('<4sI16sIII')
+
+    def __init__(self, model_hash : bytes, n_ctx : int, n_past : int, tokens : List[int]):
+        self.model_hash = model_hash
+        self.n_ctx = n_ctx
+        self.n_past = n_past
+        self.tokens = tokens
+
+    @property
+    def size(self) -> int:
+        return self.LAYOUT.size + 4 * len(self.tokens)
+
+    def pack(self) -> bytes:
+        tokens = np.asarray(self.tokens, dtype='<i4').tobytes()
+        return self.LAYOUT.pack(STATE_MAGIC, STATE_VERSION, self.model_hash, self.n_ctx, self.n_past,
+                                len(self.tokens)) + tokens
+
+    @classmethod
+    def unpack(cls, data : memoryview) -> Optional['StateHeader']:
+        """Read a header from the start of a state file, or None if it isn't one we can read"""
+        if len(data) < cls.LAYOUT.size:
+            return None
+        magic, version, model_hash, n_ctx, n_past, n_tokens = cls.LAYOUT.unpack_from(data)
+        if magic != STATE_MAGIC or version != STATE_VERSION or len(data) < cls.LAYOUT.size + 4 * n_tokens:
+            return None
+        tokens = np.frombuffer(data, dtype='<i4', count=n_tokens, offset=cls.LAYOUT.size).tolist()
+        return cls(model_hash=model_hash, n_ctx=n_ctx, n_past=n_past, tokens=tokens)
+
+    def check(self, model_hash : bytes, n_ctx : int) -> Tuple[bool, str]:
+        """Whether a context with this model and size can load our state, and why not"""
+        if self.model_hash != model_hash:
+            return False, "saved from a different model"
+        if self.n_ctx != n_ctx:
+            return False, f"saved with n_ctx {self.n_ctx}, we have {n_ctx}"
+        return True, ""
+
+    def __repr__(self) -> str:
+        return f"StateHeader(n_ctx={self.n_ctx}, n_past={self.n_past}, tokens={len(self.tokens)})"
@@ -0,0 +1,49 @@
+# valai/engine/stream.py
+
+import asyncio
+import logging
+import threading
+from typing import Optional
+
+from .output import OutputHandler
+
+logger = logging.getLogger(__name__)
+
+
+class TokenStream(OutputHandler):
+    """
+        TokenStream is the output handler for a read on our worker thread, handing each token to an asyncio
+        queue on the consumer's loop.  At most max_queue tokens wait in the queue; past that the reader
+        blocks until the consumer catches up, or the stream is cancelled.
+    """
+    def __init__(self, loop : asyncio.AbstractEventLoop, max_queue : int = 16):
+        self.loop = loop
+        self.queue : asyncio.Queue = asyncio.Queue()
+        self.slots = threading.Semaphore(max_queue)
+        self.cancelled = threading.Event()
+
+    def handle_progress(self, progress : float):
+        pass
+
+    def handle_token(self, token : str):
+        while not self.slots.acquire(timeout=0.1):
+            if self.cancelled.is_set():
+                return
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, token)
+
+    def handle_system(self, message : str):
+        pass
+
+    def finish(self):
+        """Called from the worker when the read is done, however it ended"""
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, None)
+
+    def cancel(self):
+        self.cancelled.set()
+
+    async def get(self) -> Optional[str]:
+        """The next token, or None at the end of the stream"""
+        token = await self.queue.get()
+        if token is not None:
+            self.slots.release()
+        return token
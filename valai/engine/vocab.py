@@ -0,0 +1,134 @@
+# valai/engine/vocab.py
+
+import codecs
+import string
+from ctypes import c_char, c_void_p
+import logging
+from typing import Dict, FrozenSet, List, Optional, Tuple
+
+import llama_cpp
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class TokenMatcher:
+    """
+        Guidance tokens compiled down to token ids.  abort_tokens and stop_tokens become id sets, and
+        sequence_tokens become a table of (previous id -> next ids) transitions.
+    """
+    def __init__(self, n_vocab : int, abort_ids : FrozenSet[int], stop_ids : FrozenSet[int],
+                 transitions : Dict[int, FrozenSet[int]]):
+        self.n_vocab = n_vocab
+        self.abort_ids = abort_ids
+        self.stop_ids = stop_ids
+        self.transitions = transitions
+        self._abort_bias : Optional[np.ndarray] = None
+
+    @property
+    def abort_bias(self) -> np.ndarray:
+        """A logit bias of -inf for our abort tokens, so they are never sampled"""
+        if self._abort_bias is None:
+            self._abort_bias = np.zeros(self.n_vocab, dtype=np.single)
+            self._abort_bias[list(self.abort_ids)] = -np.inf
+        return self._abort_bias
+
+    def is_sequence(self, last_id : int, id : int) -> bool:
+        return id in self.transitions.get(last_id, ())
+
+    def __repr__(self) -> str:
+        return f"TokenMatcher(abort={len(self.abort_ids)}, stop={len(self.stop_ids)}, transitions={len(self.transitions)})"
+
+
+class Vocabulary:
+    """
+        Vocabulary holds the piece for every token in a model, built once at load, so we never have
+        to call into llama_token_to_piece while sampling.
+    """
+    def __init__(self, piece_bytes : List[bytes]):
+        self.piece_bytes = piece_bytes
+        # Pieces are matched the way read always has; each token on its own, dropping partial characters
+        self.pieces = [p.decode('utf-8', 'ignore') for p in piece_bytes]
+        self.ids : Dict[str, List[int]] = {}
+        for id, piece in enumerate(self.pieces):
+            self.ids.setdefault(piece, []).append(id)
+        self.newline_ids = self.token_ids(['\n'])
+        self.max_piece = max((len(piece) for piece in self.pieces), default=1)
+        self.matchers : Dict[Tuple, TokenMatcher] = {}
+
+    @classmethod
+    def from_model(cls, model : c_void_p) -> 'Vocabulary':
+        n_vocab = llama_cpp.llama_n_vocab(model)
+        buf_size = 32
+        buf = (c_char * buf_size)()
+        piece_bytes = []
+        for id in range(n_vocab):
+            n = llama_cpp.llama_token_to_piece(model, llama_cpp.llama_token(id), buf, buf_size)
+            if n < 0:
+                # The buffer was too small, and we are told how much we need
+                buf_size = -n
+                buf = (c_char * buf_size)()
+                n = llama_cpp.llama_token_to_piece(model, llama_cpp.llama_token(id), buf, buf_size)
+            piece_bytes.append(buf[:max(n, 0)])
+        return cls(piece_bytes)
+
+    def __len__(self) -> int:
+        return len(self.piece_bytes)
+
+    def token_ids(self, pieces : List[str]) -> FrozenSet[int]:
+        """All of the token ids whose piece is one of the given strings"""
+        return frozenset(id for piece in pieces for id in self.ids.get(piece, []))
+
+    def piece_id(self, piece : str) -> Optional[int]:
+        """The id of a piece, preferring the regular token over the byte fallback tokens, which come first"""
+        ids = self.ids.get(piece, None)
+        return ids[-1] if ids else None
+
+    @property
+    def char_ids(self) -> Dict[str, int]:
+        """A token id for each printable ASCII character (and newline and tab)"""
+        chars = {}
+        for c in string.digits + string.ascii_letters + string.punctuation + ' \t\n':
+            id = self.piece_id(c)
+            if id is not None:
+                chars[c] = id
+        return chars
+
+    def encode(self, text : str) -> List[int]:
+        """
+        Tokenize text by greedy longest match against our pieces, stopping at anything we can't match.
+        Unlike llama_tokenize there is no leading space added, so this suits text continuing a sequence.
+        """
+        tokens = []
+        pos = 0
+        while pos < len(text):
+            for end in range(min(len(text), pos + self.max_piece), pos, -1):
+                id = self.piece_id(text[pos:end])
+                if id is not None:
+                    tokens.append(id)
+                    pos = end
+                    break
+            else:
+                break
+        return tokens
+
+    def compile(self, abort_tokens : List[str] = [], stop_tokens : List[str] = [],
+                sequence_tokens : List[List[str]] = []) -> TokenMatcher:
+        """Compile (and cache) guidance tokens into a TokenMatcher"""
+        key = (tuple(abort_tokens), tuple(stop_tokens), tuple(tuple(s) for s in sequence_tokens))
+        matcher = self.matchers.get(key, None)
+        if matcher is None:
+            transitions : Dict[int, FrozenSet[int]] = {}
+            for first, second in key[2]:
+                second_ids = self.token_ids([second])
+                for id in self.token_ids([first]):
+                    transitions[id] = transitions.get(id, frozenset()) | second_ids
+            matcher = TokenMatcher(n_vocab=len(self), abort_ids=self.token_ids(abort_tokens), stop_ids=self.token_ids(stop_tokens),
+                                   transitions=transitions)
+            logger.debug(f"Compiled {matcher}")
+            self.matchers[key] = matcher
+        return matcher
+
+    def decoder(self) -> codecs.IncrementalDecoder:
+        """A decoder that reassembles multi-byte characters split across tokens"""
+        return codecs.getincrementaldecoder('utf-8')(errors='ignore')
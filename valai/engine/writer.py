@@ -0,0 +1,92 @@
+# valai/engine/writer.py
+
+from ctypes import c_uint8
+import logging
+import queue
+import threading
+from typing import Any, Dict, List, Optional
+
+from .session import atomic_write
+
+logger = logging.getLogger(__name__)
+
+
+class StateWriter:
+    """
+        StateWriter writes llama states to disk on a background thread, so a save never waits on the disk.
+        States are copied into a small pool of preallocated buffers (two, by default: one being filled while
+        the other is written), and each file is written beside its target and renamed into place, so a
+        reader never sees half a file.  A save only blocks if every buffer is still being written.
+    """
+    def __init__(self, n_buffers : int = 2):
+        self.free : queue.Queue = queue.Queue()
+        for _ in range(n_buffers):
+            self.free.put(None)
+        self.jobs : queue.Queue = queue.Queue()
+        self.lock = threading.Condition()
+        # How many writes are queued or in progress for each file
+        self.pending : Dict[str, int] = {}
+        self.thread : Optional[threading.Thread] = None
+
+    def buffer(self, size : int) -> Any:
+        """Take a buffer of at least size bytes from our pool, waiting for one to be written if we must"""
+        buffer = self.free.get()
+        if buffer is None or len(buffer) < size:
+            buffer = (c_uint8 * size)()
+        return buffer
+
+    def release(self, buffer : Any):
+        """Return a buffer we didn't end up submitting"""
+        self.free.put(buffer)
+
+    def submit(self, path : str, buffer : Any, chunks : List[Any]):
+        """Write chunks (views of a buffer from our pool, or bytes) to path, returning the buffer when done"""
+        with self.lock:
+            self.pending[path] = self.pending.get(path, 0) + 1
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='state-writer', daemon=True)
+                self.thread.start()
+        self.jobs.put((path, buffer, chunks))
+
+    def write(self, path : str, chunks : List[Any]):
+        size = 0
+        with atomic_write(path, "wb") as fp:
+            for chunk in chunks:
+                size += fp.write(chunk)
+        logger.debug(f"Wrote {size} bytes to {path}")
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            path, buffer, chunks = job
+            try:
+                self.write(path, chunks)
+            except OSError as e:
+                logger.error(f"Failed to write {path}: {e}")
+            finally:
+                self.free.put(buffer)
+                with self.lock:
+                    self.pending[path] -= 1
+                    if self.pending[path] == 0:
+                        del self.pending[path]
+                    self.lock.notify_all()
+
+    def busy(self, path : Optional[str] = None) -> bool:
+        with self.lock:
+            return len(self.pending) > 0 if path is None else path in self.pending
+
+    def flush(self, path : Optional[str] = None):
+        """Wait for our writes (to path, or to every file) to finish"""
+        with self.lock:
+            self.lock.wait_for(lambda: len(self.pending) == 0 if path is None else path not in self.pending)
+
+    def close(self):
+        """Finish our writes, and stop the writer thread"""
+        self.flush()
+        with self.lock:
+            thread, self.thread = self.thread, None
+        if thread is not None:
+            self.jobs.put(None)
+            thread.join()
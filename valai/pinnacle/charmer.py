@@ -5,6 +5,7 @@ import logging
 import os
 from typing import List, Optional, Dict
 
+from ..engine.session import Session, atomic_write
 from .director import SceneDirector, sample_response
 from .exception import DirectorError
 from .guidance import GuidanceStrategy
@@ -20,7 +21,7 @@ class DirectorCharmer:
     managing the game state, and the interaction between the player and the system.
     """
     def __init__(self, director : SceneDirector, library : Librarian, shadow : ContextShadowing,
-                  guidance : GuidanceStrategy, history_threshold : int = 100) -> None:
+                  guidance : GuidanceStrategy, history_threshold : int = 100, session : Optional[Session] = None) -> None:
         self.director = director
         self.library = library
         self.shadow = shadow
@@ -32,11 +33,13 @@ class DirectorCharmer:
         self.char_dialog = defaultdict(list)
         self.guidance = guidance
         self.character_dialog = director.sym.character_dialog
+        # Where our save game goes
+        self.session = session or Session()
 
     def init_history(self, load : bool = False, **kwargs) -> bool:
         history = None
         if load: 
-            history = self.load_game_text()
+            history = self.load_game_text(save_file=self.session.filename('pinnacle_savegame.txt'))
         initial_q = "$player (to ZxdrOS, restart): New Game"
         initial_a = "ZxdrOS (to $player, announcing): *Nodding*  The world is made new again.  Welcome to Novara."
         initial_l = [ loc.travel_line(self.director.roster.player.sheet) for k, loc in self.director.sym.locations.items() if loc.start ]
@@ -387,17 +390,18 @@ class DirectorCharmer:
         return items
 
     @classmethod
-    def from_config(cls, **kwargs) -> 'Charmer':
+    def from_config(cls, session : Optional[Session] = None, **kwargs) -> 'Charmer':
         character_dialog = DirectorDialog()
         director = SceneDirector.from_config(character_dialog=character_dialog, **kwargs)
         library = Librarian.from_config(**kwargs)
         shadow = ContextShadowing.from_config(character_dialog=character_dialog, **kwargs)
         guidance = GuidanceStrategy.from_config(**kwargs)
-        return cls(director=director, library=library, shadow=shadow, guidance=guidance)
+        return cls(director=director, library=library, shadow=shadow, guidance=guidance,
+                   session=session or Session.from_config(**kwargs))
     
     def save_game(self, **kwargs) -> str:
         history = self.past_history + self.current_history
-        return self.save_game_text(history, **kwargs)
+        return self.save_game_text(history, **{'save_file': self.session.filename('pinnacle_savegame.txt'), **kwargs})
 
     @classmethod
     def save_game_text(cls, history: list[str], **kwargs) -> str:
@@ -407,7 +411,7 @@ class DirectorCharmer:
         }
 
         save_file = config['save_file']
-        with open(save_file, 'w') as f:
+        with atomic_write(save_file, 'w') as f:
             for h in history:
                 f.write(h + '\n')
 
@@ -440,7 +444,7 @@ class DirectorCharmer:
             **kwargs
         }
 
-        with open(config['save_file'], 'wb') as f:
+        with atomic_write(config['save_file'], 'wb') as f:
             separator = b'\x1E'  # custom separator byte
             for entry in history:
                 f.write(entry.encode() + separator)
@@ -3,11 +3,12 @@
 import asyncio
 import logging
 import os
-from typing import Optional
+from typing import List, Optional
 
 from ..analysis.summarizer import ChainOfAnalysis
 from ..engine import EngineException, FlowEngine, OutputHandler
 from ..engine.grammar import load_grammar
+from ..engine.session import Session, SessionLocked
 from ..ioutil import CaptureFD
 
 from .charmer import DirectorCharmer
@@ -49,13 +50,15 @@ class DirectorWizard:
     @classmethod
     def from_config(cls, **kwargs):
         output = OutputHandler()
+        # Our game files are ours alone while we run
+        session = Session.from_config(**kwargs).lock()
 
-        charmer = DirectorCharmer.from_config(**kwargs)
+        charmer = DirectorCharmer.from_config(session=session, **kwargs)
         if not kwargs.get('verbose', False):
             with CaptureFD() as co:
-                engine = FlowEngine.from_config(output=output, **kwargs)
+                engine = FlowEngine.from_config(output=output, session=session, **kwargs)
         else:
-            engine = FlowEngine.from_config(output=output, **kwargs)
+            engine = FlowEngine.from_config(output=output, session=session, **kwargs)
         
         return cls(charmer=charmer, engine=engine, output=output)
 
@@ -73,10 +76,13 @@ class DirectorWizard:
                 # The scene header could potentially be injected into the stream in some more
                 # elegant way as well.
                 logger.debug(f"Sending prompt: {len(prompt)}")
-                self.engine.execute(prompt=prompt, checkpoint=None, scope='scene', show_progress = True, **kwargs)
-                self.engine.set_checkpoint('scene', **kwargs)
+                self.engine.execute(prompt=prompt, checkpoint=None, scope='scene', show_progress = True, cache_prompt=True, **kwargs)
+                self.engine.fork('scene')
             elif level == 'scene':
-                self.engine.reload_turn(checkpoint='scene', **kwargs)
+                if self.engine.reload_turn(checkpoint='scene', **kwargs) < 0:
+                    return self.reset_engine(restart=restart, level='game', **kwargs)
+            # The system and scene header stay in context if the engine has to shift out old history
+            self.engine.pin()
 
             prompt = self.charmer(**kwargs)
             self.engine.execute(prompt=prompt, checkpoint='turn', scope='history', show_progress = True, **kwargs)
@@ -145,6 +151,8 @@ class DirectorWizard:
         self.println('  scene - analyze the scene')
         self.println('  renew - reload the game configuration')
         self.println('  restart - restart the game')
+        self.println('  retry - show the next alternative for the last line (with --candidates)')
+        self.println('  metrics <prom (optional)> - show engine timings and checkpoint stats')
         self.println('  quit - exit the game')
         self.println('  help - show this help')
         self.println('Cheats:')
@@ -160,12 +168,23 @@ class DirectorWizard:
             data = f.read()
         return data
 
-    async def run_wizard(self, r_length : int, r_temp : float, refresh_threshold : int = 10, **kwargs):
+    def read_line(self, prefix : str, grammar, n_candidates : int, **kwargs) -> List[str]:
+        """Read alternatives for a speaker's line, continuing with the best of them"""
+        self.engine.execute(prompt=prefix, checkpoint=None, show_progress=False, **kwargs)
+        self.engine.read_candidates(n_candidates=n_candidates, grammar=grammar, **kwargs)
+        candidate = self.engine.accept_candidate(0, grammar=grammar)
+        return [] if candidate is None else candidate.tokens
+
+    async def run_wizard(self, r_length : int, r_temp : float, refresh_threshold : int = 10, n_candidates : int = 1,
+                         **kwargs):
         self.println("Starting Director...")
         self.init(**kwargs)
 
         running = True
         retry = False
+        # The last line we read, with its prefix and grammar, and which of the engine's alternatives it is
+        last_line = None
+        candidate_ix = 0
         self.println("Game Starting")
         self.show_history(**kwargs)
         refresh = refresh_threshold
@@ -189,6 +208,35 @@ class DirectorWizard:
                         grammar_s = load_grammar(grammar_file="pinnacle_turn_s.gbnf", **kwargs)
                         grammar_d = load_grammar(grammar_file="pinnacle_turn_d.gbnf", **kwargs)
                         continue
+                    elif action == 'retry':
+                        if last_line is None or candidate_ix + 1 >= len(self.engine.alternatives):
+                            self.println("No alternatives for the last line" if n_candidates > 1 else
+                                         "Run with --candidates to retry lines")
+                            continue
+                        line, line_prefix, line_grammar = last_line
+                        if len(self.charmer.current_history) == 0 or self.charmer.current_history[-1] != line:
+                            self.println("The last line has moved out of our history")
+                            continue
+                        # Show the next alternative we read for the last line, rather than reading again.  The
+                        # director has already acted on the line, so we only replace its text.
+                        candidate_ix += 1
+                        candidate = self.engine.accept_candidate(candidate_ix, grammar=line_grammar)
+                        line = f"{line_prefix}{candidate.text.strip()}"
+                        self.charmer.current_history[-1] = line
+                        last_line = (line, line_prefix, line_grammar)
+                        self.println(f"Alternative {candidate_ix + 1} of {len(self.engine.alternatives)}:")
+                        self.output.handle_token(line_prefix)
+                        self.output.handle_token(candidate.text)
+                        continue
+                    elif a2split[0] == 'metrics':
+                        metrics = self.engine.metrics
+                        if not metrics.enabled:
+                            self.println("Timings are disabled, run with --metrics")
+                        if len(a2split) > 1 and a2split[1].strip() == 'prom':
+                            self.println(metrics.to_prometheus())
+                        else:
+                            self.println(metrics.to_json(indent=2))
+                        continue
                     elif a2split[0] == 'speak' or a2split[0] == 'talk' or a2split[0] == 'say' or a2split[0] == 't':
                         if len(a2split) != 3:
                             self.println("Invalid talk command: talk <character> <prompt>")
@@ -473,22 +521,19 @@ class DirectorWizard:
                         prompt = f'{prompt}\n'
                     self.reset_engine(restart=False, level='scene', **kwargs)
                     #self.engine.prepare(system_context='system', restart=False, **kwargs)
-                    self.engine.execute(prompt=prompt, checkpoint=True, scope='refresh', show_progress = True, **kwargs)
+                    self.engine.execute(prompt=prompt, checkpoint='turn', scope='refresh', show_progress = True, **kwargs)
                     refresh = refresh_threshold
                 elif player_input is not None:
                     turn = self.charmer.last_turn(**kwargs)
                     turn += lines
                     expanded_input = self.charmer.turn(turn, **kwargs)
-                    self.engine.execute(prompt=f"{expanded_input}\n", checkpoint=True, show_progress = False, **kwargs)
+                    self.engine.execute(prompt=f"{expanded_input}\n", checkpoint='turn', show_progress = False, **kwargs)
                     refresh -= 1
                     retry = False
 
                 if ne == False:
                     iters = 0
                     while True:
-                        grammar_s.reset()
-                        grammar_d.reset()
-                
                         iters += 1
                         traited = self.charmer.director.trait is not None
                         current_speaker = self.charmer.director.speaker_turn()
@@ -498,25 +543,38 @@ class DirectorWizard:
                         logger.debug(f"Current Speaker: {current_speaker.split('(')[0]}")
                         prefix = f"{current_speaker}"
                         self.output.handle_token(current_speaker)
-                        self.engine.execute(prompt=prefix, checkpoint=False, show_progress=False, **kwargs)
                         if traited:
                             t_grammar = grammar_s
                         else:
                             t_grammar = grammar_d
-                        result = self.engine.read(max_tokens=r_length, n_temp=r_temp, token_handler=self.output,
-                                                  grammar=t_grammar, **self.charmer.guidance.tokens, **kwargs)
-                        if result is None:
-                            # Rollback?
-                            self.println("No response from engine.")
-                            continue
+                        # A copy of the parsed grammar, so this is cheap
+                        t_grammar.reset()
+                        last_line = None
+                        if n_candidates > 1:
+                            # Alternatives are read together, so a retry can show the next one straight away
+                            result = await asyncio.to_thread(self.read_line, prefix=prefix, grammar=t_grammar,
+                                                             n_candidates=n_candidates, max_tokens=r_length,
+                                                             n_temp=r_temp, **self.charmer.guidance.tokens, **kwargs)
+                            candidate_ix = 0
+                            self.output.handle_token(''.join(result))
                         else:
-                            response = ''.join(result).strip()
-                            if len(response) <= 1:
-                                # End of turn
-                                break
-                            response = f"{prefix}{response}"
-                            #self.println(f"{response}")
-                            self.charmer.add_history('model', response)
+                            # The prefix and response are decoded on the engine's worker, leaving our loop free
+                            result = []
+                            async for token in self.engine.stream(prompt=prefix, checkpoint=None, show_progress=False,
+                                                                  max_tokens=r_length, n_temp=r_temp, grammar=t_grammar,
+                                                                  **self.charmer.guidance.tokens, **kwargs):
+                                self.output.handle_token(token)
+                                result.append(token)
+                        response = ''.join(result).strip()
+                        if len(response) <= 1:
+                            # End of turn
+                            break
+                        response = f"{prefix}{response}"
+                        #self.println(f"{response}")
+                        self.charmer.add_history('model', response)
+                        last_line = (response, prefix, t_grammar)
+                # Everything since the player's input, from any refresh to the last speaker's line
+                self.engine.metrics.end_turn()
                 check_input = True
 
             except EngineException as e:
@@ -528,7 +586,11 @@ class DirectorWizard:
 
 def run_director(**kwargs):
     config = DirectorWizard.expand_config(config=kwargs)
-    app = DirectorWizard.from_config(**config)
+    try:
+        app = DirectorWizard.from_config(**config)
+    except SessionLocked as e:
+        logger.error(f"{e}, pick another with --session")
+        return
     asyncio.run(app.run_wizard(**config))
 
 if __name__ == "__main__":